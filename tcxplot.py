@@ -6,9 +6,86 @@ optional arguments:
   --output_dir: the output folder to save results (default: NONE)
   --gt: Ground Truth device (default: Polar)
   --ref: Ground Truth device (default: Apple)
+  --power_gt: Ground Truth device for power (default: --gt when it records
+              power, else the device with the most power samples)
+  --cadence_gt: Ground Truth device for cadence (default: --gt when it records
+                cadence, else the device with the most cadence samples)
   --key: Google Maps API key (default: None)
   --no_browser: disables the launch the webview on the resulting HTML file
   --units: determine the unit of measure; imperial or metric (default: imperial)
+  --max_offset: largest clock offset in seconds to correct between devices,
+                0 disables the alignment (default: 30)
+  --outlier_window: width in seconds of the rolling outlier window (default: 30)
+  --outlier_threshold: scaled MADs from the rolling median to be an outlier
+                       (default: 3.5)
+  --metrics_only: only compute the metric tables and write them as JSON/CSV,
+                  skipping every figure, map and HTML output
+  --metrics_format: json or csv (default: json)
+  --metrics_file: file to write the metrics to (default: stdout)
+  --aggregate: treat data_folder as a campaign of sessions and write a
+               per-device leaderboard to output_dir
+  --batch: treat data_folder as a campaign of sessions and write a report of
+           each to output_dir, reading, parsing, analyzing, rendering and
+           writing different sessions at once
+  --stage_jobs: sessions each --batch stage works on at once, eg.
+                parse=4,render=3 (default: 2 per stage)
+  --jobs: number of worker processes for --aggregate (default: CPU count) and
+          for rendering the report sections (default: one per section)
+  --serve: serve the report from a local HTTP server, loading the trace data
+           for the current zoom range on demand
+  --port: the port used by --serve (default: 8000)
+  --list: list the data files below data_folder grouped into sessions, reading
+          only the start of each file
+  --pyramid: embed min/max/mean trace aggregates at 1s, 10s, 60s and 10min
+             and swap in finer levels when a plot is zoomed
+  --catalog: SQLite catalog database every parsed file is recorded in
+  --index: record every data file below data_folder in the --catalog and
+           --store
+  --query: list the --catalog sessions matching --sport, --device, --since and
+           --until, and write a report of each to output_dir when set
+  --sport: sport of the queried sessions, eg. Biking
+  --device: text contained in the name of a device in the queried sessions
+  --since: queried sessions start on or after this UTC date, eg. 2024-03-01
+  --until: queried sessions start before this UTC date, eg. 2024-04-01
+  --route: TCX/GPX file of a route; lists the segments of the --catalog
+           tracks that follow it, matching --sport, --device, --since and
+           --until, with their distance and speed vs the route
+  --route_segment: compare only this part of the --route, eg. 2,5 for
+                   between 2 and 5 km or mi per --units
+  --route_meters: largest distance of a fix from the --route (default: 25)
+  --binary_traces: embed the trace times and values and the map locations as
+                   base64 typed arrays instead of decimal and date text
+  --no_render_cache: render every report section, instead of reusing the
+                     sections cached in output_dir/.render_cache whose data,
+                     options and code are unchanged
+  --store: folder of a memory-mapped columnar store that parsed files are
+           appended to and read back from instead of being parsed again
+  --smooth_gps: smooth the GPS tracks with a Kalman filter and RTS pass before
+                distance and speed are derived, reporting the raw distance too
+  --gps_noise: standard deviation of a GPS fix in meters used by --smooth_gps
+               (default: 5)
+  --stationary: keep, drop or collapse to its first and last point each run
+               of stationary points, eg. stops at traffic lights; moving and
+               elapsed time are reported either way (default: keep)
+  --max_hr: max heart rate the HR zones are 50, 60, 70, 80 and 90% of
+            (default: 190)
+  --hr_zones: explicit lower bounds in BPM of the HR zones, eg. 100,120,140,
+              160,175, used instead of --max_hr
+  --distance_model: equirectangular, haversine or vincenty (WGS-84 ellipsoid)
+                    distances between GPS points (default: haversine)
+  --distance_3d: include the climb between points from their altitude in the
+                 distance
+  --benchmark_distance: time each --distance_model on the tracks in
+                        data_folder and print its error vs vincenty
+  --duplicates: keep the first or last sample of a repeated timestamp, or
+                average them: first, last or mean (default: first)
+  --split_activities: write a report per activity when the TCX files record
+                      several, eg. the legs of a triathlon; each report has
+                      a Laps tab when a device records several laps
+  --memory_limit: memory budget, eg. 2G or 512M; reports the peak memory of
+                  each stage and, when the projected peak exceeds it, matches
+                  the metrics in time windows and renders the report sections
+                  one at a time from trace pyramids
 """
 
 
@@ -16,7 +93,23 @@ import argparse
 import os
 import sys
 
-from utils.process_files import process_files
+from utils import aggregate
+from utils import pipeline
+from utils import catalog
+from utils import memory_budget
+from utils import align_devices
+from utils import metrics
+from utils import outliers
+from utils import probe
+from utils import smooth_track
+from utils import stationary
+from utils import hr_zones
+from utils import calc_distance
+from utils import normalize_time
+from utils import render_cache
+from utils import report_server
+from utils import route_index
+from utils import process_files
 
 # Get the directory of the current file
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -30,16 +123,87 @@ from utils import utils
 
 
 def main():
+    # The library logs its progress, the command line prints it
+    utils.print_progress()
     parser = argparse.ArgumentParser(description='Process xml files for sensor testing activities.')
-    parser.add_argument('data_folder', type=str, help='Path to folder containing TCX/GPX files')
-    parser.add_argument('--output_dir', type=str, required=True, help='the output folder to save results')
+    parser.add_argument('data_folder', type=str, nargs='?', help='Path to folder containing TCX/GPX files, not used by --query')
+    parser.add_argument('--output_dir', type=str, help='the output folder to save results, required unless --metrics_only, --serve, --route or --list is set')
     parser.add_argument('--key', type=str, help='Google maps API key, alternatively set env GOOGLE_MAPS_API_KEY')
     parser.add_argument('--gt', type=str, default='Polar', help='Specifies the ground truth device for heart rate (default: Polar)')
     parser.add_argument('--ref', type=str, default='Apple', help='Specifies the reference device (default: Apple)')
+    parser.add_argument('--power_gt', type=str, help='Specifies the ground truth device for power (default: --gt when it records power, else the device with the most power samples)')
+    parser.add_argument('--cadence_gt', type=str, help='Specifies the ground truth device for cadence (default: --gt when it records cadence, else the device with the most cadence samples)')
     parser.add_argument('--no_browser', dest='launch_browser', action='store_false', help='Do not launch the webview on the resulting html file')
     parser.add_argument('--units', type=str, default='imperial', help='Specifies the units of measure. Options are metric or imperial (default: imperial)')
+    parser.add_argument('--max_offset', type=int, default=align_devices.DEFAULT_MAX_LAG_SECONDS, help=f'Largest clock offset in seconds to correct between devices, 0 disables the alignment (default: {align_devices.DEFAULT_MAX_LAG_SECONDS})')
+    parser.add_argument('--outlier_window', type=int, default=outliers.DEFAULT_WINDOW_SECONDS, help=f'Width in seconds of the rolling outlier window (default: {outliers.DEFAULT_WINDOW_SECONDS})')
+    parser.add_argument('--outlier_threshold', type=float, default=outliers.DEFAULT_THRESHOLD, help=f'Scaled MADs from the rolling median to be flagged as an outlier (default: {outliers.DEFAULT_THRESHOLD})')
+    parser.add_argument('--metrics_only', action='store_true', help='Only compute the metric tables and write them as JSON/CSV, skipping every figure, map and HTML output')
+    parser.add_argument('--metrics_format', type=str, default='json', choices=metrics.METRICS_FORMATS, help='Format of the metrics written by --metrics_only (default: json)')
+    parser.add_argument('--metrics_file', type=str, help='File to write the metrics to (default: stdout)')
+    parser.add_argument('--aggregate', action='store_true', help='Treat data_folder as a campaign of sessions and write a per-device leaderboard to output_dir')
+    parser.add_argument('--batch', action='store_true', help='Treat data_folder as a campaign of sessions and write a report of each to output_dir, reading, parsing, analyzing, rendering and writing different sessions at once')
+    parser.add_argument('--stage_jobs', type=pipeline.parse_stage_jobs, help='Sessions each --batch stage (read, parse, analyze, render, write) works on at once, eg. parse=4,render=3 (default: 2 per stage)')
+    parser.add_argument('--jobs', type=int, help='Number of worker processes for --aggregate (default: CPU count) and for rendering the report sections (default: one per section)')
+    parser.add_argument('--serve', action='store_true', help='Serve the report from a local HTTP server, loading the trace data for the current zoom range on demand')
+    parser.add_argument('--port', type=int, default=report_server.DEFAULT_PORT, help=f'The port used by --serve (default: {report_server.DEFAULT_PORT})')
+    parser.add_argument('--pyramid', action='store_true', help='Embed min/max/mean trace aggregates at 1s, 10s, 60s and 10min and swap in finer levels when a plot is zoomed')
+    parser.add_argument('--list', action='store_true', help='List the data files below data_folder grouped into sessions, reading only the start of each file')
+    parser.add_argument('--catalog', type=str, help='SQLite catalog database every parsed file is recorded in')
+    parser.add_argument('--index', action='store_true', help='Record every data file below data_folder in the --catalog and --store')
+    parser.add_argument('--query', action='store_true', help='List the --catalog sessions matching --sport, --device, --since and --until, and write a report of each to output_dir when set')
+    parser.add_argument('--sport', type=str, help='Sport of the queried sessions, eg. Biking')
+    parser.add_argument('--device', type=str, help='Text contained in the name of a device in the queried sessions')
+    parser.add_argument('--since', type=str, help='Queried sessions start on or after this UTC date, eg. 2024-03-01')
+    parser.add_argument('--until', type=str, help='Queried sessions start before this UTC date, eg. 2024-04-01')
+    parser.add_argument('--route', type=str, help='TCX/GPX file of a route. Lists the segments of the --catalog tracks that follow it, matching --sport, --device, --since and --until, with their distance and speed vs the route')
+    parser.add_argument('--route_segment', type=str, help='Compare only this part of the --route, eg. 2,5 for between 2 and 5 km or mi per --units')
+    parser.add_argument('--route_meters', type=float, default=route_index.DEFAULT_MATCH_METERS, help=f'Largest distance of a fix from the --route (default: {route_index.DEFAULT_MATCH_METERS:g})')
+    parser.add_argument('--binary_traces', action='store_true', help='Embed the trace times and values and the map locations as base64 typed arrays instead of decimal and date text')
+    parser.add_argument('--no_render_cache', dest='render_cache', action='store_false', help='Render every report section, instead of reusing the sections cached in output_dir/.render_cache whose data, options and code are unchanged')
+    parser.add_argument('--store', type=str, help='Folder of a memory-mapped columnar store that parsed files are appended to and read back from instead of being parsed again')
+    parser.add_argument('--smooth_gps', action='store_true', help='Smooth the GPS tracks with a constant velocity Kalman filter and RTS pass before distance and speed are derived, reporting the raw distance too')
+    parser.add_argument('--gps_noise', type=float, default=smooth_track.DEFAULT_GPS_NOISE_METERS, help=f'Standard deviation of a GPS fix in meters used by --smooth_gps (default: {smooth_track.DEFAULT_GPS_NOISE_METERS:g})')
+    parser.add_argument('--stationary', type=str, default='keep', choices=stationary.STATIONARY_MODES, help='Keep, drop or collapse to its first and last point each run of stationary points, eg. stops at traffic lights. Moving and elapsed time are reported either way (default: keep)')
+    parser.add_argument('--max_hr', type=float, help=f'Max heart rate the HR zones are {", ".join(map(str, hr_zones.ZONE_PERCENTS))}%% of (default: {hr_zones.DEFAULT_MAX_HR})')
+    parser.add_argument('--hr_zones', type=hr_zones.parse_bounds, help='Explicit lower bounds in BPM of the HR zones, eg. 100,120,140,160,175, used instead of --max_hr')
+    parser.add_argument('--distance_model', type=str, default=calc_distance.DEFAULT_DISTANCE_MODEL, choices=list(calc_distance.DISTANCE_MODELS), help=f'Model of the distance between GPS points: equirectangular, haversine or vincenty on the WGS-84 ellipsoid (default: {calc_distance.DEFAULT_DISTANCE_MODEL})')
+    parser.add_argument('--distance_3d', action='store_true', help='Include the climb between points from their altitude in the distance')
+    parser.add_argument('--benchmark_distance', action='store_true', help='Time each --distance_model on the tracks in data_folder and print its error vs vincenty')
+    parser.add_argument('--duplicates', type=str, default=normalize_time.DEFAULT_DUPLICATE_POLICY, choices=normalize_time.DUPLICATE_POLICIES, help=f'Keep the first or last sample of a repeated timestamp, or average them (default: {normalize_time.DEFAULT_DUPLICATE_POLICY})')
+    parser.add_argument('--split_activities', action='store_true', help='Write a report per activity when the TCX files record several, eg. the legs of a triathlon')
+    parser.add_argument('--memory_limit', type=memory_budget.memory_size, help='Memory budget, eg. 2G or 512M. Reports the peak memory of each stage and, when the projected peak exceeds it, matches the metrics in time windows and renders the report sections one at a time from trace pyramids')
 
     args = parser.parse_args()
+    if args.query and not args.catalog:
+        parser.error('--catalog is required by --query')
+    if args.route and not args.catalog:
+        parser.error('--catalog is required by --route')
+    if args.index and not (args.catalog or args.store):
+        parser.error('--catalog or --store is required by --index')
+    if not (args.query or args.route) and not args.data_folder:
+        parser.error('data_folder is required unless --query or --route is set')
+    if args.index:
+        process_files.index_folder(args.data_folder, args.catalog,
+                                   store_path=args.store)
+        return
+    if args.list:
+        probe.list_sessions(args.data_folder)
+        return
+    if args.benchmark_distance:
+        combined_df, _, _ = process_files.load_session(
+            process_files.find_data_files(args.data_folder),
+            duplicates=args.duplicates)
+        print(calc_distance.benchmark_models(combined_df).to_string(index=False))
+        return
+    if args.query:
+        activities = catalog.query_activities(args.catalog, args.sport,
+                                              args.device, args.since,
+                                              args.until)
+        sessions = catalog.query_sessions(args.catalog, activities)
+        catalog.print_sessions(sessions)
+    elif not (args.metrics_only or args.serve or args.route) and not args.output_dir:
+        parser.error('--output_dir is required unless --metrics_only, --serve, --route or --list is set')
 
     # Set variables based on command line arguments
     data_folder = args.data_folder
@@ -49,6 +213,20 @@ def main():
     ref_device = args.ref
     launch_browser = args.launch_browser
     unit_of_measure_string = args.units
+    max_offset = args.max_offset
+    outlier_window = args.outlier_window
+    outlier_threshold = args.outlier_threshold
+    metrics_only = args.metrics_only
+    metrics_format = args.metrics_format
+    metrics_file = args.metrics_file
+    if metrics_only and not metrics_file:
+        # Keep progress messages out of metrics written to stdout
+        utils.print_progress(sys.stderr)
+    hr_zone_bounds = hr_zones.zone_bounds(args.max_hr, args.hr_zones)
+    render_cache_dir = None
+    if args.render_cache and output_dir:
+        render_cache_dir = os.path.join(output_dir,
+                                        render_cache.RENDER_CACHE_DIRNAME)
 
     # Convert the unit of measure string to a UnitOfMeasure enum value
     try:
@@ -58,9 +236,102 @@ def main():
         print('Using default...')
         unit_of_measure = utils.UnitOfMeasure.IMPERIAL
 
+    if args.route:
+        segment = None
+        if args.route_segment:
+            segment = route_index.parse_segment(args.route_segment,
+                                                unit_of_measure)
+        table = route_index.compare_route(
+            args.catalog, args.route, unit_of_measure, segment, args.sport,
+            args.device, args.since, args.until, args.route_meters,
+            store_path=args.store, duplicates=args.duplicates)
+        if metrics_file:
+            metrics.write_metrics({'route': table}, metrics_format,
+                                  metrics_file, {'route': args.route})
+        elif table.empty:
+            print('No catalogued track follows the route')
+        else:
+            print(table.to_string(index=False))
+        return
+
+    if args.serve:
+        report_server.serve_report(
+            data_folder, google_maps_api_key, ground_truth_device, ref_device,
+            unit_of_measure, args.port,
+            {'max_offset': max_offset, 'outlier_window': outlier_window,
+             'outlier_threshold': outlier_threshold,
+             'smooth_gps': args.smooth_gps, 'gps_noise': args.gps_noise,
+             'stationary_mode': args.stationary,
+             'distance_model': args.distance_model,
+             'distance_3d': args.distance_3d},
+            args.power_gt, args.cadence_gt, hr_zone_bounds, args.duplicates)
+        return
+
+    if args.aggregate:
+        aggregate.aggregate_sessions(data_folder, output_dir,
+                                     ground_truth_device, ref_device,
+                                     unit_of_measure, max_offset,
+                                     outlier_window, outlier_threshold,
+                                     args.jobs, args.catalog, args.store,
+                                     args.power_gt, args.cadence_gt,
+                                     args.memory_limit, args.smooth_gps,
+                                     args.gps_noise, args.stationary,
+                                     hr_zone_bounds, args.distance_model,
+                                     args.distance_3d, args.duplicates)
+        return
+
+    if args.batch:
+        pipeline.report_sessions(
+            data_folder, output_dir, google_maps_api_key,
+            ground_truth_device, ref_device, unit_of_measure,
+            {'max_offset': max_offset, 'outlier_window': outlier_window,
+             'outlier_threshold': outlier_threshold,
+             'smooth_gps': args.smooth_gps, 'gps_noise': args.gps_noise,
+             'stationary_mode': args.stationary,
+             'distance_model': args.distance_model,
+             'distance_3d': args.distance_3d},
+            args.power_gt, args.cadence_gt, hr_zone_bounds, args.duplicates,
+            args.pyramid, args.binary_traces, args.stage_jobs)
+        return
+
+    if args.query:
+        # Report each queried session straight from its catalogued files
+        if output_dir:
+            for session in sessions:
+                process_files.process_files(
+                    args.catalog, output_dir, google_maps_api_key,
+                    launch_browser, ground_truth_device, ref_device,
+                    unit_of_measure, max_offset, outlier_window,
+                    outlier_threshold, pyramid=args.pyramid,
+                    catalog_path=args.catalog,
+                    file_paths=[a['path'] for a in session],
+                    store_path=args.store, jobs=args.jobs,
+                    render_cache_dir=render_cache_dir,
+                    binary=args.binary_traces, power_gt=args.power_gt,
+                    cadence_gt=args.cadence_gt,
+                    memory_limit=args.memory_limit,
+                    smooth_gps=args.smooth_gps, gps_noise=args.gps_noise,
+                    stationary_mode=args.stationary,
+                    hr_zone_bounds=hr_zone_bounds,
+                    distance_model=args.distance_model,
+                    distance_3d=args.distance_3d,
+                    duplicates=args.duplicates,
+                    split_activities=args.split_activities)
+        return
+
     # Call the function that processes the files and creates the output
-    process_files(data_folder, output_dir, google_maps_api_key, launch_browser,
-                  ground_truth_device, ref_device, unit_of_measure)
+    process_files.process_files(
+        data_folder, output_dir, google_maps_api_key, launch_browser,
+        ground_truth_device, ref_device, unit_of_measure, max_offset,
+        outlier_window, outlier_threshold, metrics_only, metrics_format,
+        metrics_file, args.pyramid, args.catalog, store_path=args.store,
+        jobs=args.jobs, render_cache_dir=render_cache_dir,
+        binary=args.binary_traces, power_gt=args.power_gt,
+        cadence_gt=args.cadence_gt, memory_limit=args.memory_limit,
+        smooth_gps=args.smooth_gps, gps_noise=args.gps_noise,
+        stationary_mode=args.stationary, hr_zone_bounds=hr_zone_bounds,
+        distance_model=args.distance_model, distance_3d=args.distance_3d,
+        duplicates=args.duplicates, split_activities=args.split_activities)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,71 @@
+"""Tests probing the metadata of data files."""
+
+import datetime as dt
+import os
+import tempfile
+import unittest
+
+from utils import probe
+
+POINTS = 2000
+
+START = dt.datetime(2023, 4, 1, 14, 0, 0)
+
+CREATOR = (
+    '<Creator xsi:type="Device_t"><Name>Polar H10</Name>'
+    '<UnitId>1234</UnitId><ProductID>99</ProductID></Creator>')
+AUTHOR = (
+    '<Author xsi:type="Application_t"><Name>Polar Flow</Name>'
+    '<Build><Version><VersionMajor>1</VersionMajor>'
+    '<VersionMinor>0</VersionMinor></Version></Build>'
+    '<LangID>en</LangID><PartNumber>000-00000-00</PartNumber></Author>')
+
+
+def _tcx_file(creator):
+  # Enough points that the Creator is well past the probed start of the file
+  points = ''.join(
+      f'<Trackpoint><Time>{START + dt.timedelta(seconds=i):%Y-%m-%dT%H:%M:%SZ}'
+      f'</Time><HeartRateBpm><Value>{120 + i % 20}</Value></HeartRateBpm>'
+      '</Trackpoint>' for i in range(POINTS))
+  return (
+      '<?xml version="1.0" encoding="UTF-8"?>\n'
+      '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/'
+      'TrainingCenterDatabase/v2" '
+      'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+      '<Activities><Activity Sport="Biking">'
+      f'<Id>{START:%Y-%m-%dT%H:%M:%SZ}</Id>'
+      f'<Lap StartTime="{START:%Y-%m-%dT%H:%M:%SZ}"><Track>{points}</Track>'
+      f'</Lap>{creator}</Activity></Activities>{AUTHOR}'
+      '</TrainingCenterDatabase>\n')
+
+
+class ProbeFileTest(unittest.TestCase):
+
+  def _probe(self, contents):
+    with tempfile.TemporaryDirectory() as folder:
+      path = os.path.join(folder, 'Polar.tcx')
+      with open(path, 'w', encoding='utf-8') as f:
+        f.write(contents)
+      self.assertGreater(os.path.getsize(path), probe.PROBE_BYTES)
+      return probe.probe_file(path)
+
+  def test_tcx_creator_follows_the_laps(self):
+    info = self._probe(_tcx_file(CREATOR))
+    self.assertEqual(info['creator'], 'Polar H10')
+    self.assertEqual(info['device'], 'Polar')
+    self.assertEqual(info['sport'], 'Biking')
+    self.assertEqual(info['start_time'], START)
+
+  def test_tcx_author_is_not_the_creator(self):
+    info = self._probe(_tcx_file(''))
+    self.assertIsNone(info['creator'])
+    self.assertEqual(info['start_time'], START)
+
+  def test_tcx_creator_outside_the_activity_is_ignored(self):
+    contents = _tcx_file('').replace(
+        '</Activities>', '</Activities>' + CREATOR)
+    self.assertIsNone(self._probe(contents)['creator'])
+
+
+if __name__ == '__main__':
+  unittest.main()
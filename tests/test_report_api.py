@@ -0,0 +1,128 @@
+"""Stress tests building reports from many threads at once."""
+
+import concurrent.futures
+import contextlib
+import datetime as dt
+import io
+import math
+import re
+import unittest
+
+from utils import report_api
+
+POINTS = 300
+THREADS = 16
+BUILDS = 32
+
+START = dt.datetime(2023, 4, 1, 14, 0, 0)
+
+# Plotly gives every figure div a random id
+PLOTLY_ID = re.compile(
+    rb'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
+def _track(i, noise):
+  """Returns the time, position, altitude and heart rate of a loop point."""
+  angle = 2 * math.pi * i / POINTS
+  time = (START + dt.timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+  lat = 37.0 + 0.005 * math.sin(angle) + noise * math.sin(7 * i)
+  lon = -122.0 + 0.005 * math.cos(angle) + noise * math.cos(5 * i)
+  alt = 50.0 + 20.0 * math.sin(angle) + noise * 1e4 * math.sin(3 * i)
+  heart_rate = 120 + int(20 * math.sin(angle)) + int(noise * 1e5) % 3
+  return time, lat, lon, alt, heart_rate
+
+
+def _tcx_file(noise):
+  points = []
+  for i in range(POINTS):
+    time, lat, lon, alt, heart_rate = _track(i, noise)
+    points.append(
+        f'<Trackpoint><Time>{time}</Time><Position>'
+        f'<LatitudeDegrees>{lat:.7f}</LatitudeDegrees>'
+        f'<LongitudeDegrees>{lon:.7f}</LongitudeDegrees></Position>'
+        f'<AltitudeMeters>{alt:.2f}</AltitudeMeters>'
+        f'<HeartRateBpm><Value>{heart_rate}</Value></HeartRateBpm>'
+        '</Trackpoint>')
+  return (
+      '<?xml version="1.0" encoding="UTF-8"?>\n'
+      '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/'
+      'TrainingCenterDatabase/v2"><Activities><Activity Sport="Biking">'
+      f'<Id>{START:%Y-%m-%dT%H:%M:%SZ}</Id>'
+      f'<Lap StartTime="{START:%Y-%m-%dT%H:%M:%SZ}"><Track>'
+      + ''.join(points)
+      + '</Track></Lap></Activity></Activities></TrainingCenterDatabase>\n'
+  ).encode()
+
+
+def _gpx_file(noise):
+  points = []
+  for i in range(POINTS):
+    time, lat, lon, alt, heart_rate = _track(i, noise)
+    points.append(
+        f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{alt:.2f}</ele>'
+        f'<time>{time}</time><extensions><gpxtpx:TrackPointExtension>'
+        f'<gpxtpx:hr>{heart_rate}</gpxtpx:hr>'
+        '</gpxtpx:TrackPointExtension></extensions></trkpt>')
+  return (
+      '<?xml version="1.0" encoding="UTF-8"?>\n'
+      '<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1" '
+      'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">'
+      f'<metadata><time>{START:%Y-%m-%dT%H:%M:%SZ}</time></metadata>'
+      '<trk><type>cycling</type><trkseg>'
+      + ''.join(points)
+      + '</trkseg></trk></gpx>\n'
+  ).encode()
+
+
+def _session_files():
+  return [
+      ('Polar H10.tcx', _tcx_file(0.0)),
+      ('Apple Watch.gpx', _gpx_file(0.00002)),
+      ('Garmin Edge.tcx', _tcx_file(0.00001)),
+  ]
+
+
+def _normalized(report):
+  html, metrics = report
+  return PLOTLY_ID.sub(b'', html), metrics
+
+
+class BuildReportTest(unittest.TestCase):
+
+  def test_concurrent_builds_match_sequential_build(self):
+    files = _session_files()
+    expected = _normalized(report_api.build_report(files))
+
+    with concurrent.futures.ThreadPoolExecutor(THREADS) as executor:
+      reports = list(executor.map(
+          lambda _: report_api.build_report(files), range(BUILDS)))
+
+    for report in reports:
+      html, metrics = _normalized(report)
+      self.assertEqual(metrics, expected[1])
+      self.assertEqual(html, expected[0])
+
+  def test_build_prints_nothing(self):
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+      html, metrics = report_api.build_report(_session_files())
+    self.assertEqual(stdout.getvalue(), '')
+    self.assertTrue(html)
+    self.assertIn(b'"elevation"', metrics)
+
+  def test_single_gpx_file(self):
+    # GPX heart rates are parsed as integers, the map must still serialize
+    html, metrics = report_api.build_report(
+        [('Apple Watch.gpx', _gpx_file(0.0))])
+    self.assertIn(b'"heart_rate": 120,', html)
+    self.assertIn(b'"heart_rate"', metrics)
+
+  def test_metrics_only_has_no_report(self):
+    html, metrics = report_api.build_report(_session_files(),
+                                            metrics_only=True)
+    self.assertIsNone(html)
+    self.assertIn(b'"heart_rate"', metrics)
+
+
+if __name__ == '__main__':
+  unittest.main()
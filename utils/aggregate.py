@@ -0,0 +1,342 @@
+"""Aggregate device accuracy metrics across many sessions."""
+
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import os
+
+import pandas as pd
+
+from utils import align_devices, calc_distance, memory_budget, metrics, normalize_time, outliers, probe, process_files, render_cache, smooth_track
+
+SESSIONS_FILENAME = 'campaign_sessions.csv'
+LEADERBOARD_FILENAME = 'campaign_leaderboard.csv'
+SUMMARY_FILENAME = 'campaign_summary.html'
+PARSE_CACHE_DIRNAME = '.parse_cache'
+
+
+def discover_sessions(root_folder):
+  """Finds the sessions in every folder below root_folder.
+
+  The files of a folder are grouped into sessions by the start time read
+  from their headers, so a folder may hold a single session or a flat
+  archive of many.
+
+  Args:
+    root_folder: the campaign folder
+
+  Returns:
+    A sorted list of (session, data file paths) tuples.  The session is the
+    folder, suffixed with the session start time when the folder holds more
+    than one session.
+  """
+  sessions = []
+  for folder, _, _ in os.walk(root_folder):
+    file_paths = sorted(process_files.find_data_files(folder))
+    if not file_paths:
+      continue
+    groups = probe.group_sessions([probe.probe_file(f) for f in file_paths])
+    for group in groups:
+      session = folder
+      if len(groups) > 1:
+        start_time = group[0]['start_time']
+        label = start_time.isoformat() if start_time else group[0]['device']
+        session = f'{folder}@{label}'
+      sessions.append((session, sorted(p['path'] for p in group)))
+  return sorted(sessions)
+
+
+def session_signature(file_paths, options):
+  """Fingerprints a session's files by name, size and mtime, and its options.
+
+  The code version is included too, so changed metrics are computed again.
+  """
+  digest = hashlib.sha1(f'code={render_cache.code_version()}\n'.encode())
+  for name in sorted(options):
+    if name not in ('cache_dir', 'catalog_path', 'store_path',
+                    'memory_limit'):
+      digest.update(f'{name}={options[name]}\n'.encode())
+  for file_path in sorted(file_paths):
+    stat = os.stat(file_path)
+    digest.update(
+        f'{os.path.basename(file_path)}:{stat.st_size}:{stat.st_mtime_ns}\n'
+        .encode())
+  return digest.hexdigest()
+
+
+def session_metrics(session, file_paths, options):
+  """Computes the metric rows of a single session.
+
+  Args:
+    session: the session folder, used as its identifier
+    file_paths: the data files of the session
+    options: dict of the analysis options, see aggregate_sessions
+
+  Returns:
+    A list of dicts, one per device per metric table.
+  """
+  # Match the devices in time windows when the session exceeds its share of
+  # the memory budget
+  window = None
+  if (options['memory_limit'] and memory_budget.project_peak(
+      file_paths, metrics_only=True) > options['memory_limit']):
+    window = memory_budget.CHUNK_WINDOW
+
+  # Workers run in parallel, keep their progress messages quiet
+  with contextlib.redirect_stdout(io.StringIO()):
+    combined_df, sport, start_time = process_files.load_session(
+        file_paths, options['cache_dir'], options['catalog_path'],
+        options['store_path'], store_read_only=True,
+        duplicates=options['duplicates'])
+    combined_df, offsets = process_files.analyze_session(
+        combined_df, options['ground_truth_device'], options['ref_device'],
+        options['max_offset'], options['outlier_window'],
+        options['outlier_threshold'], options['smooth_gps'],
+        options['gps_noise'], options['stationary_mode'],
+        options['distance_model'], options['distance_3d'])
+    tables = metrics.compute_metrics(
+        combined_df, options['ground_truth_device'], options['ref_device'],
+        options['unit_of_measure'], offsets, options['power_gt'],
+        options['cadence_gt'], window, options['hr_zone_bounds'])
+
+  session_info = {
+      'session': session,
+      'signature': session_signature(file_paths, options),
+      'sport': sport,
+      'start_time': start_time.isoformat() if start_time else None,
+  }
+  rows = []
+  for table, records in metrics.metrics_records(tables).items():
+    for record in records:
+      rows.append({**session_info, 'table': table, **record})
+  return rows
+
+
+def _percentile(q):
+  def percentile(values):
+    return values.quantile(q / 100.0)
+  percentile.__name__ = f'p{q}'
+  return percentile
+
+
+def build_leaderboard(session_rows):
+  """Combines the per-session metric rows into a per-device leaderboard.
+
+  MAE values, and the HR zone agreement, are weighted by the number of
+  samples matched against the GT/ref device in each session.
+
+  Args:
+    session_rows: DataFrame of the rows returned by session_metrics
+
+  Returns:
+    A DataFrame with one row per sport and device.
+  """
+  boards = []
+  for table, prefix in (('heart_rate', 'HR'), ('distance', 'Distance'),
+                        ('power', 'Power'), ('cadence', 'Cadence')):
+    rows = session_rows[session_rows['table'] == table]
+    rows = rows.dropna(subset=['MAE'])
+    if rows.empty:
+      continue
+    rows = rows.assign(
+        Samples=rows['Samples'].fillna(1),
+        WeightedError=rows['MAE'] * rows['Samples'].fillna(1),
+    )
+    grouped = rows.groupby(['sport', 'Device'])
+    board = pd.DataFrame({
+        f'{prefix} Sessions': grouped['session'].nunique(),
+        f'{prefix} Samples': grouped['Samples'].sum(),
+        f'{prefix} Weighted MAE': (
+            grouped['WeightedError'].sum() / grouped['Samples'].sum()),
+    })
+    for name, values in (('MAE', 'MAE'), ('Variance', 'Variance')):
+      stats = grouped[values].agg(
+          ['mean', 'std', _percentile(10), _percentile(50), _percentile(90)])
+      stats.columns = [f'{prefix} {name} {stat}' for stat in stats.columns]
+      board = board.join(stats)
+    boards.append(board)
+
+  rows = session_rows[session_rows['table'] == 'hr_zones']
+  if 'Agreement' in rows.columns:
+    rows = rows.dropna(subset=['Agreement'])
+  if not rows.empty and 'Agreement' in rows.columns:
+    rows = rows.assign(WeightedAgreement=rows['Agreement'] * rows['Samples'])
+    grouped = rows.groupby(['sport', 'Device'])
+    boards.append(pd.DataFrame({
+        'HR Zone Agreement': (grouped['WeightedAgreement'].sum()
+                              / grouped['Samples'].sum()),
+        'HR Zone Agreement p10': grouped['Agreement'].quantile(0.1),
+    }))
+
+  if not boards:
+    return pd.DataFrame()
+  leaderboard = pd.concat(boards, axis=1).round(2).reset_index()
+  for column in leaderboard.columns:
+    if column.endswith(('Sessions', 'Samples')):
+      leaderboard[column] = leaderboard[column].astype('Int64')
+  sort_columns = [c for c in ('HR Weighted MAE', 'Distance Weighted MAE')
+                  if c in leaderboard.columns]
+  return leaderboard.sort_values(['sport'] + sort_columns)
+
+
+def write_summary_html(leaderboard, summary_filename):
+  """Writes the leaderboard as an HTML page with a table per sport."""
+  sections = ''
+  for sport, board in leaderboard.groupby('sport'):
+    sections += f'<h2>{sport}</h2>\n'
+    sections += board.drop(columns=['sport']).to_html(
+        index=False, border=0, classes='leaderboard', na_rep='---')
+  html_content = f'''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="UTF-8">
+<title>Campaign Leaderboard</title>
+<style>
+body {{ font-family: sans-serif; }}
+.leaderboard {{ border-collapse: collapse; }}
+.leaderboard th {{ background-color: paleturquoise; padding: 4px 8px; }}
+.leaderboard td {{ background-color: lavender; padding: 4px 8px;
+                   text-align: right; }}
+</style>
+</head>
+<body>
+<h1>Campaign Leaderboard</h1>
+{sections}
+</body>
+</html>
+'''
+  with open(summary_filename, 'w') as f:
+    f.write(html_content)
+
+
+def aggregate_sessions(root_folder, output_dir, ground_truth_device,
+                       ref_device, unit_of_measure,
+                       max_offset=align_devices.DEFAULT_MAX_LAG_SECONDS,
+                       outlier_window=outliers.DEFAULT_WINDOW_SECONDS,
+                       outlier_threshold=outliers.DEFAULT_THRESHOLD,
+                       jobs=None, catalog_path=None, store_path=None,
+                       power_gt=None, cadence_gt=None, memory_limit=None,
+                       smooth_gps=False,
+                       gps_noise=smooth_track.DEFAULT_GPS_NOISE_METERS,
+                       stationary_mode='keep', hr_zone_bounds=None,
+                       distance_model=calc_distance.DEFAULT_DISTANCE_MODEL,
+                       distance_3d=False,
+                       duplicates=normalize_time.DEFAULT_DUPLICATE_POLICY):
+  """Computes the metrics of every session and writes the leaderboard.
+
+  Sessions whose files and options are unchanged since the last run are read
+  back from the sessions CSV in output_dir, so only new or modified sessions
+  are parsed and analyzed.
+
+  Args:
+    root_folder: the campaign folder, see discover_sessions
+    output_dir: Folder to save the results
+    ground_truth_device:  the string used to determine GT device
+    ref_device:  the string used to determine the ref device
+    unit_of_measure:  imperial or metric
+    max_offset: largest clock offset in seconds to correct between devices,
+                0 disables the alignment
+    outlier_window: width in seconds of the rolling outlier window
+    outlier_threshold: number of scaled MADs from the rolling median to be
+                       flagged as an outlier
+    jobs: number of worker processes (default: one per CPU)
+    catalog_path: optional catalog database the parsed files are recorded in
+    store_path: optional session store folder to read the files from,
+                workers never append to it
+    power_gt: the string used to determine the power GT device
+              (default: ground_truth_device)
+    cadence_gt: the string used to determine the cadence GT device
+                (default: ground_truth_device)
+    memory_limit: optional memory budget in bytes shared by the workers,
+                  sessions projected over a worker's share are matched in
+                  time windows
+    smooth_gps: smooth the GPS tracks before distance and speed are used
+    gps_noise: standard deviation of a GPS fix in meters, used to smooth
+    stationary_mode: keep, drop or collapse the stationary runs of each
+                     device before the metrics
+    hr_zone_bounds: the lower bound in BPM of each heart rate zone
+                    (default: hr_zones.zone_bounds())
+    distance_model: the model distances are measured with, see
+                    calc_distance.DISTANCE_MODELS
+    distance_3d: include the climb between points from alt_meters in the
+                 distance
+    duplicates: how repeated timestamps are resolved, see
+                normalize_time.DUPLICATE_POLICIES
+
+  Returns:
+    The leaderboard DataFrame.
+  """
+  sessions_filename = os.path.join(output_dir, SESSIONS_FILENAME)
+  options = {
+      'ground_truth_device': ground_truth_device,
+      'ref_device': ref_device,
+      'unit_of_measure': unit_of_measure,
+      'max_offset': max_offset,
+      'outlier_window': outlier_window,
+      'outlier_threshold': outlier_threshold,
+      'cache_dir': os.path.join(output_dir, PARSE_CACHE_DIRNAME),
+      'catalog_path': catalog_path,
+      'store_path': store_path,
+      'power_gt': power_gt,
+      'cadence_gt': cadence_gt,
+      'memory_limit': memory_limit and memory_limit // (jobs or os.cpu_count()),
+      'smooth_gps': smooth_gps,
+      'gps_noise': gps_noise,
+      'stationary_mode': stationary_mode,
+      'hr_zone_bounds': hr_zone_bounds,
+      'distance_model': distance_model,
+      'distance_3d': distance_3d,
+      'duplicates': duplicates,
+  }
+
+  sessions = discover_sessions(root_folder)
+  signatures = {
+      session: session_signature(file_paths, options)
+      for session, file_paths in sessions
+  }
+
+  # Reuse the rows of sessions whose files have not changed
+  known_rows = pd.DataFrame()
+  if os.path.exists(sessions_filename):
+    known_rows = pd.read_csv(sessions_filename)
+    known_rows = known_rows[
+        known_rows['session'].map(signatures) == known_rows['signature']
+    ]
+  known_sessions = set(known_rows.get('session', []))
+  pending = [
+      (session, file_paths)
+      for session, file_paths in sessions
+      if session not in known_sessions
+  ]
+  print(f'Sessions: {len(sessions)}, new or changed: {len(pending)}')
+
+  new_rows = []
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+    futures = {
+        executor.submit(session_metrics, session, file_paths, options):
+            session
+        for session, file_paths in pending
+    }
+    for future in concurrent.futures.as_completed(futures):
+      session = futures[future]
+      try:
+        new_rows.extend(future.result())
+        print('Session: ', session)
+      except Exception as e:  # pylint: disable=broad-except
+        print(f'Failed to process session {session}: {e}')
+
+  session_rows = pd.concat([known_rows, pd.DataFrame(new_rows)],
+                           ignore_index=True)
+  if session_rows.empty:
+    print('No sessions found in', root_folder)
+    return pd.DataFrame()
+  session_rows = session_rows.sort_values(['session', 'table'], kind='stable')
+  session_rows.to_csv(sessions_filename, index=False)
+
+  leaderboard = build_leaderboard(session_rows)
+  leaderboard.to_csv(os.path.join(output_dir, LEADERBOARD_FILENAME),
+                     index=False)
+  write_summary_html(leaderboard, os.path.join(output_dir, SUMMARY_FILENAME))
+  print('Leaderboard: ', os.path.join(output_dir, SUMMARY_FILENAME))
+  return leaderboard
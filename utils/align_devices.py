@@ -0,0 +1,141 @@
+"""Estimate and correct clock offsets between devices."""
+import numpy as np
+import pandas as pd
+from scipy import signal
+
+from utils import utils
+
+DEFAULT_MAX_LAG_SECONDS = 30
+ALIGNMENT_CHANNELS = ('heart_rate', 'speed_kmh')
+MIN_OVERLAP_SECONDS = 60
+
+
+def _resample(data, column):
+  """Resamples a device channel onto a 1 second grid."""
+  series = data.dropna(subset=[column]).set_index('time')[column]
+  series = series.astype(float)
+  series = series[~series.index.duplicated()]
+  return series.resample('1s').mean()
+
+
+def estimate_offset(ref_series, series, max_lag_seconds):
+  """Estimates the clock offset of a series relative to a reference series.
+
+  Both series are cropped to the samples that can overlap within
+  max_lag_seconds, placed on a shared 1 second grid and cross-correlated
+  with an FFT, so the cost follows the overlap rather than the time between
+  the devices.  Gaps are masked so that the score at each lag is the Pearson
+  correlation over the samples that actually overlap at that lag.
+
+  Args:
+    ref_series: 1 second resampled series of the reference device
+    series: 1 second resampled series of the device to align
+    max_lag_seconds: the largest offset (in either direction) to consider
+
+  Returns:
+    The offset in seconds to subtract from the device times, or None when
+    the series do not overlap enough to estimate one.
+  """
+  if ref_series.empty or series.empty:
+    return None
+  max_lag = pd.Timedelta(seconds=max_lag_seconds)
+  start = max(ref_series.index[0], series.index[0])
+  end = min(ref_series.index[-1], series.index[-1])
+  if (end - start + max_lag).total_seconds() < MIN_OVERLAP_SECONDS:
+    return None
+  ref_series = ref_series[start - max_lag:end + max_lag]
+  series = series[start - max_lag:end + max_lag]
+  if ref_series.empty or series.empty:
+    return None
+
+  grid = pd.date_range(
+      min(ref_series.index[0], series.index[0]),
+      max(ref_series.index[-1], series.index[-1]),
+      freq='1s',
+  )
+  ref_values = ref_series.reindex(grid).to_numpy()
+  values = series.reindex(grid).to_numpy()
+
+  ref_mask = ~np.isnan(ref_values)
+  mask = ~np.isnan(values)
+  ref_values = np.where(ref_mask, ref_values - np.nanmean(ref_values), 0.0)
+  values = np.where(mask, values - np.nanmean(values), 0.0)
+  ref_mask = ref_mask.astype(float)
+  mask = mask.astype(float)
+
+  def xcorr(a, b):
+    return signal.correlate(a, b, mode='full', method='fft')
+
+  # Pearson correlation over the samples that overlap at each lag
+  count = np.round(xcorr(mask, ref_mask))
+  sum_x = xcorr(values, ref_mask)
+  sum_y = xcorr(mask, ref_values)
+  sum_xx = xcorr(values**2, ref_mask)
+  sum_yy = xcorr(mask, ref_values**2)
+  sum_xy = xcorr(values, ref_values)
+  lags = signal.correlation_lags(len(values), len(ref_values), mode='full')
+
+  in_range = (np.abs(lags) <= max_lag_seconds) & (count >= MIN_OVERLAP_SECONDS)
+  if not in_range.any():
+    return None
+  count = count[in_range]
+  covariance = sum_xy[in_range] - sum_x[in_range] * sum_y[in_range] / count
+  variance = (
+      (sum_xx[in_range] - sum_x[in_range]**2 / count)
+      * (sum_yy[in_range] - sum_y[in_range]**2 / count)
+  )
+  if not (variance > 0).any():
+    return None
+  scores = np.where(variance > 0,
+                    covariance / np.sqrt(np.clip(variance, 1e-12, None)),
+                    -np.inf)
+  return int(lags[in_range][np.argmax(scores)])
+
+
+def align_devices(combined_df, reference_device,
+                  max_lag_seconds=DEFAULT_MAX_LAG_SECONDS):
+  """Shifts each device's timestamps to match the reference device's clock.
+
+  Heart rate is used when both devices recorded it, otherwise speed.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    reference_device: the string used to determine the reference device
+    max_lag_seconds: the largest clock offset to search for
+
+  Returns:
+    A tuple of the aligned DataFrame and a dict of device to the offset in
+    seconds that was removed from its timestamps.
+  """
+  is_ref = combined_df['device'].str.contains(reference_device, case=False)
+  ref_data = combined_df[is_ref]
+  offsets = {}
+  if ref_data.empty:
+    utils.progress(f'Reference device {reference_device} not found, '
+                   'skipping clock alignment')
+    return combined_df, offsets
+
+  aligned_df = combined_df.copy()
+  for device, data in combined_df[~is_ref].groupby('device'):
+    offset = None
+    for channel in ALIGNMENT_CHANNELS:
+      if channel not in data.columns or data[channel].isnull().all():
+        continue
+      if ref_data[channel].isnull().all():
+        continue
+      offset = estimate_offset(_resample(ref_data, channel),
+                               _resample(data, channel), max_lag_seconds)
+      if offset is not None:
+        break
+    if offset is None:
+      utils.progress(f'Unable to estimate clock offset for device: {device}')
+      continue
+
+    offsets[device] = offset
+    if offset:
+      utils.progress(f'Clock offset: {device} {offset:+d}s')
+      rows = aligned_df['device'] == device
+      aligned_df.loc[rows, 'time'] = (
+          aligned_df.loc[rows, 'time'] - pd.Timedelta(seconds=offset))
+
+  return aligned_df, offsets
@@ -0,0 +1,92 @@
+"""Encode numeric report data as base64 little-endian typed arrays."""
+
+import base64
+
+import numpy as np
+import pandas as pd
+
+# Float32 holds every integer up to 2**24 exactly, eg. heart rates
+FLOAT32_EXACT_LIMIT = 2 ** 24
+
+
+def encode_array(values, dtype):
+  """Encodes values as a plotly style {'dtype', 'bdata'} typed array.
+
+  Args:
+    values: array-like of numbers, missing values as NaN
+    dtype: numpy dtype string of the typed array, eg. 'f8'
+
+  Returns:
+    A dict of the dtype and the base64 little-endian bytes.
+  """
+  data = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder('<'))
+  return {'dtype': dtype, 'bdata': base64.b64encode(data.tobytes()).decode()}
+
+
+def compact_dtype(values):
+  """Returns f4 when every value is an integer float32 holds exactly."""
+  finite = values[np.isfinite(values)]
+  if (finite.size and np.all(finite == np.round(finite))
+      and np.all(np.abs(finite) < FLOAT32_EXACT_LIMIT)):
+    return 'f4'
+  return 'f8'
+
+
+def wall_clock_ms(times):
+  """Converts times to ms since epoch of their wall clock, as if UTC.
+
+  Plotly date axes show numeric times as UTC, so this keeps the local times
+  the report shows elsewhere.
+  """
+  times = pd.DatetimeIndex(times)
+  if times.tz is not None:
+    times = times.tz_localize(None)
+  return times.to_numpy(dtype='datetime64[ms]').astype(np.int64).astype(float)
+
+
+def _is_datetime(values):
+  if values.dtype.kind == 'M':
+    return True
+  if values.dtype.kind in 'OU' and values.size:
+    first = values[0]
+    if isinstance(first, (pd.Timestamp, np.datetime64)):
+      return True
+    if isinstance(first, str):
+      try:
+        pd.Timestamp(str(first))
+      except (TypeError, ValueError):
+        return False
+      return True
+  return False
+
+
+def encode_figure(fig):
+  """Stores the time and value arrays of a figure's traces as typed arrays.
+
+  Times become Float64 wall clock ms on a date axis, integer valued series
+  Float32 and other numbers Float64, so plotly writes them as base64 typed
+  arrays instead of decimal and ISO date text.
+
+  Args:
+    fig: the plotly figure, updated in place
+
+  Returns:
+    The updated figure.
+  """
+  date_axes = set()
+  for trace in fig.data:
+    if trace.type != 'scatter':
+      continue
+    if trace.x is not None:
+      x = np.asarray(trace.x)
+      if _is_datetime(x):
+        trace.x = wall_clock_ms(x)
+        date_axes.add(trace.xaxis or 'x')
+    if trace.y is not None:
+      y = np.asarray(trace.y)
+      if y.dtype.kind in 'iuf':
+        y = y.astype(float)
+        trace.y = y.astype(np.float32) if compact_dtype(y) == 'f4' else y
+  for axis in date_axes:
+    fig.layout[f'xaxis{axis[1:]}'].type = 'date'
+  return fig
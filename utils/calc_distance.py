@@ -1,7 +1,32 @@
 """Calculate a data frame of distance values for each gps coordinate."""
+import time
+
 import numpy as np
 import pandas as pd
 
+from utils import calc_speed, elevation
+
+EARTH_RADIUS_METERS = 6371000.0
+
+# WGS-84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+VINCENTY_TOLERANCE = 1e-12
+VINCENTY_MAX_ITERATIONS = 200
+
+DEFAULT_DISTANCE_MODEL = 'haversine'
+REFERENCE_DISTANCE_MODEL = 'vincenty'
+
+
+def _equirectangular(lat1, lon1, lat2, lon2):
+  """Flat Earth approximation around the midpoint, fast for short steps."""
+  lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+  x = (lon2 - lon1) * np.cos((lat1 + lat2) / 2)
+  y = lat2 - lat1
+  return np.hypot(x, y) * EARTH_RADIUS_METERS
+
 
 def _haversine(lat1, lon1, lat2, lon2):
   # convert decimal degrees to radians
@@ -16,15 +41,98 @@ def _haversine(lat1, lon1, lat2, lon2):
   return c * r * 1000
 
 
-def calc_distance_haversine(df: pd.DataFrame) -> pd.Series:
-  """Calculate the cumulative distance between consecutive GPS coordinates.
+def _vincenty(lat1, lon1, lat2, lon2):
+  """Vincenty's inverse formula on the WGS-84 ellipsoid.
 
-  It uses the Haversine formula.  The haversine formula is a more accurate
-  way to calculate distances between GPS coordinates, as it takes into
-  account the curvature of the Earth.
+  Every pair iterates at once until all of them converge, pairs that already
+  converged are left unchanged.
+  """
+  lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float))
+                            for v in (lat1, lon1, lat2, lon2))
+  f = WGS84_F
+  u1 = np.arctan((1 - f) * np.tan(lat1))
+  u2 = np.arctan((1 - f) * np.tan(lat2))
+  sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+  sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+  big_l = lon2 - lon1
+
+  lam = big_l
+  pending = np.ones(np.shape(lam), dtype=bool)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    for _ in range(VINCENTY_MAX_ITERATIONS):
+      sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+      sin_sigma = np.hypot(cos_u2 * sin_lam,
+                           cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+      cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+      sigma = np.arctan2(sin_sigma, cos_sigma)
+      # Coincident points have no azimuth
+      sin_alpha = np.where(sin_sigma == 0, 0.0,
+                           cos_u1 * cos_u2 * sin_lam / sin_sigma)
+      cos2_alpha = 1 - sin_alpha ** 2
+      # Points on the equator have no midpoint latitude
+      cos_2sigma_m = np.where(
+          cos2_alpha == 0, 0.0,
+          cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+      c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+      next_lam = big_l + (1 - c) * f * sin_alpha * (
+          sigma + c * sin_sigma * (
+              cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+      pending = np.abs(next_lam - lam) > VINCENTY_TOLERANCE
+      lam = next_lam
+      if not np.any(pending):
+        break
+
+    u_sq = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = b * sin_sigma * (
+        cos_2sigma_m + b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2)
+            * (-3 + 4 * cos_2sigma_m ** 2)))
+  return WGS84_B * a * (sigma - delta_sigma)
+
+
+# Distance in meters between arrays of points, from the fastest to the most
+# accurate
+DISTANCE_MODELS = {
+    'equirectangular': _equirectangular,
+    'haversine': _haversine,
+    'vincenty': _vincenty,
+}
+
+
+def distance_steps(latitude, longitude, model=DEFAULT_DISTANCE_MODEL,
+                   altitude=None):
+  """Returns the distance in meters between consecutive points of a track.
+
+  Args:
+    latitude: array of the latitudes of the track
+    longitude: array of the longitudes of the track
+    model: one of DISTANCE_MODELS
+    altitude: optional array of altitudes in meters, steps where both points
+              have an altitude include the climb
+
+  Returns:
+    An array with one step less than the track.
+  """
+  latitude = np.asarray(latitude, dtype=float)
+  longitude = np.asarray(longitude, dtype=float)
+  steps = DISTANCE_MODELS[model](latitude[:-1], longitude[:-1],
+                                 latitude[1:], longitude[1:])
+  if altitude is not None:
+    climb = np.diff(np.asarray(altitude, dtype=float))
+    steps = np.where(np.isnan(climb), steps, np.hypot(steps, climb))
+  return steps
+
+
+def calc_distance(df, model=DEFAULT_DISTANCE_MODEL, altitude=False):
+  """Calculate the cumulative distance between consecutive GPS coordinates.
 
   Args:
       df (pd.DataFrame): A pandas DataFrame containing GPS data.
+      model: one of DISTANCE_MODELS
+      altitude: include the climb between points from alt_meters
 
   Returns:
       pd.Series: A pandas Series of cumulative distances between consecutive
@@ -34,18 +142,127 @@ def calc_distance_haversine(df: pd.DataFrame) -> pd.Series:
   df['latitude'] = df['position'].apply(lambda pos: pos['lat'])
   df['longitude'] = df['position'].apply(lambda pos: pos['long'])
 
-  # calculate distance for each pair of consecutive GPS coordinates
-  distances = [
-      _haversine(
-          df['latitude'][i],
-          df['longitude'][i],
-          df['latitude'][i + 1],
-          df['longitude'][i + 1],
-      )
-      for i in range(len(df) - 1)
-  ]
+  alt = None
+  if altitude and 'alt_meters' in df.columns:
+    alt = pd.to_numeric(df['alt_meters'], errors='coerce')
+  steps = distance_steps(df['latitude'], df['longitude'], model, alt)
 
   # add distance values to Series and make cumulative
-  result = pd.Series([0] + distances)
+  result = pd.Series(np.concatenate([[0.0], steps]))
   result_cumulative = result.cumsum()
   return result_cumulative
+
+
+def calc_distance_haversine(df: pd.DataFrame) -> pd.Series:
+  """Calculate the cumulative distance between consecutive GPS coordinates.
+
+  It uses the Haversine formula.  The haversine formula is a more accurate
+  way to calculate distances between GPS coordinates, as it takes into
+  account the curvature of the Earth.
+
+  Args:
+      df (pd.DataFrame): A pandas DataFrame containing GPS data.
+
+  Returns:
+      pd.Series: A pandas Series of cumulative distances between consecutive
+      GPS coordinates.
+  """
+  return calc_distance(df, 'haversine')
+
+
+def recalc_distance(combined_df, model=DEFAULT_DISTANCE_MODEL,
+                    altitude=False):
+  """Recalculates the distance and speed of every device with a GPS track.
+
+  Files are loaded with haversine distances, see process_files.load_file.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    model: one of DISTANCE_MODELS
+    altitude: include the climb between points from alt_meters
+
+  Returns:
+    A copy of the DataFrame with calc_distance_meters, speed_kmh and
+    grade_percent recalculated.
+  """
+  df = combined_df.copy()
+  if 'calc_distance_meters' not in df.columns:
+    return df
+  has_track = df['calc_distance_meters'].notnull().to_numpy()
+  alt = None
+  if altitude and 'alt_meters' in df.columns:
+    alt = pd.to_numeric(df['alt_meters'], errors='coerce').to_numpy()
+  latitude = df['latitude'].to_numpy(dtype=float)
+  longitude = df['longitude'].to_numpy(dtype=float)
+
+  distance = df['calc_distance_meters'].to_numpy(dtype=float, copy=True)
+  speeds = df['speed_kmh'].to_numpy(dtype=float, copy=True)
+  grade = None
+  if 'grade_percent' in df.columns:
+    seconds = (df['time'] - df['time'].min()).dt.total_seconds().to_numpy()
+    smoothed = df['elevation_meters'].to_numpy(dtype=float)
+    grade = df['grade_percent'].to_numpy(dtype=float, copy=True)
+  for positions in df.groupby('device').indices.values():
+    positions = positions[has_track[positions]]
+    if not len(positions):
+      continue
+    steps = distance_steps(latitude[positions], longitude[positions], model,
+                           None if alt is None else alt[positions])
+    distance[positions] = np.concatenate([[0.0], np.cumsum(steps)])
+    track = pd.DataFrame({'time': df['time'].to_numpy()[positions],
+                          'calc_distance_meters': distance[positions]})
+    speeds[positions] = calc_speed.calc_speed(track).to_numpy(dtype=float)
+    if grade is not None:
+      grade[positions] = elevation.track_grade(
+          seconds[positions], smoothed[positions], distance[positions])
+  df['calc_distance_meters'] = distance
+  df['speed_kmh'] = speeds
+  if grade is not None:
+    df['grade_percent'] = grade
+  return df
+
+
+def benchmark_models(combined_df, repeat=5):
+  """Times every distance model and measures its error vs the ellipsoid.
+
+  Args:
+    combined_df: A combined DataFrame with the GPS tracks of every device.
+    repeat: the best of this many runs is timed
+
+  Returns:
+    A DataFrame with a row per model: its throughput in steps per second,
+    and the error of its steps and of its total distance vs the
+    REFERENCE_DISTANCE_MODEL.
+  """
+  starts, ends = [], []
+  df = combined_df.dropna(subset=['latitude', 'longitude'])
+  for _, data in df.groupby('device'):
+    points = data[['latitude', 'longitude']].to_numpy(dtype=float)
+    starts.append(points[:-1])
+    ends.append(points[1:])
+  if not starts:
+    return pd.DataFrame()
+  start = np.concatenate(starts)
+  end = np.concatenate(ends)
+  pairs = (start[:, 0], start[:, 1], end[:, 0], end[:, 1])
+
+  reference = DISTANCE_MODELS[REFERENCE_DISTANCE_MODEL](*pairs)
+  rows = []
+  for model, kernel in DISTANCE_MODELS.items():
+    best = float('inf')
+    for _ in range(repeat):
+      begin = time.perf_counter()
+      steps = kernel(*pairs)
+      best = min(best, time.perf_counter() - begin)
+    errors = np.abs(steps - reference)
+    rows.append({
+        'Model': model,
+        'Steps': len(steps),
+        'Steps/s': round(len(steps) / best) if best else float('inf'),
+        'Mean Error (m)': float(np.nanmean(errors)),
+        'Max Error (m)': float(np.nanmax(errors)),
+        'Total Error (%)': float(
+            (np.nansum(steps) - np.nansum(reference))
+            / np.nansum(reference) * 100.0),
+    })
+  return pd.DataFrame(rows)
@@ -18,8 +18,9 @@ def calc_speed(df):
   time_diff = (
       df_with_distance['time'] - df_with_distance['time'].shift()
   ).fillna(pd.Timedelta(seconds=0))
-  # convert time difference to hours
-  time_diff_hours = time_diff.apply(lambda x: x.total_seconds() / 3600)
+  # convert time difference to hours, repeated times have no speed
+  time_diff_hours = time_diff.dt.total_seconds() / 3600
+  time_diff_hours = time_diff_hours.where(time_diff_hours != 0)
   # calculate speed in km/h
   speed_kmh = (
       (
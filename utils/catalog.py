@@ -0,0 +1,250 @@
+"""SQLite catalog of every ingested activity file."""
+
+import datetime as dt
+import json
+import os
+import sqlite3
+
+import pandas as pd
+
+from utils import geohash, probe
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS activities (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    device TEXT,
+    sport TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    point_count INTEGER,
+    min_lat REAL,
+    max_lat REAL,
+    min_long REAL,
+    max_long REAL,
+    avg_heart_rate REAL,
+    max_heart_rate REAL,
+    distance_meters REAL,
+    avg_speed_kmh REAL,
+    indexed_at TEXT
+);
+CREATE INDEX IF NOT EXISTS activities_start_time ON activities (start_time);
+CREATE INDEX IF NOT EXISTS activities_sport ON activities (sport);
+CREATE INDEX IF NOT EXISTS activities_device ON activities (device);
+CREATE TABLE IF NOT EXISTS cells (
+    cell TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (cell, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cells_path ON cells (path);
+'''
+
+COLUMNS = (
+    'path', 'hash', 'device', 'sport', 'start_time', 'end_time',
+    'point_count', 'min_lat', 'max_lat', 'min_long', 'max_long',
+    'avg_heart_rate', 'max_heart_rate', 'distance_meters', 'avg_speed_kmh',
+    'indexed_at',
+)
+
+
+def open_catalog(catalog_path):
+  """Opens the catalog database, creating its tables if needed."""
+  # Parallel workers may write at once, wait for their locks
+  conn = sqlite3.connect(catalog_path, timeout=30)
+  conn.row_factory = sqlite3.Row
+  conn.executescript(SCHEMA)
+  return conn
+
+
+def _utc_iso(time):
+  """Formats a timestamp as a naive UTC ISO string, sortable as text."""
+  if time is None or pd.isna(time):
+    return None
+  time = pd.Timestamp(time)
+  if time.tzinfo is not None:
+    time = time.tz_convert('UTC').tz_localize(None)
+  return time.isoformat(timespec='seconds')
+
+
+def _number(value):
+  return None if value is None or pd.isna(value) else float(value)
+
+
+def summarize_activity(file_path, file_hash, device, sport, df):
+  """Builds the catalog row of a parsed activity file.
+
+  Args:
+    file_path: The file path of the TCX or GPX file
+    file_hash: the hash of the file content
+    device: the device label used in the reports
+    sport: the sport of the activity
+    df: the parsed DataFrame, with calc_distance_meters/speed_kmh when the
+        file has GPS data
+
+  Returns:
+    A dict of column name to value, and the geohash cells of the track.
+  """
+  row = {
+      'path': file_path,
+      'hash': file_hash,
+      'device': device,
+      'sport': sport or None,
+      'start_time': _utc_iso(df['time'].min()) if len(df) else None,
+      'end_time': _utc_iso(df['time'].max()) if len(df) else None,
+      'point_count': len(df),
+      'avg_heart_rate': _number(df['heart_rate'].mean()),
+      'max_heart_rate': _number(df['heart_rate'].max()),
+      'indexed_at': dt.datetime.utcnow().isoformat(timespec='seconds'),
+  }
+  if 'latitude' in df.columns:
+    row.update({
+        'min_lat': _number(df['latitude'].min()),
+        'max_lat': _number(df['latitude'].max()),
+        'min_long': _number(df['longitude'].min()),
+        'max_long': _number(df['longitude'].max()),
+        'cells': geohash.track_cells(df['latitude'], df['longitude']),
+    })
+  if 'calc_distance_meters' in df.columns:
+    row['distance_meters'] = _number(df['calc_distance_meters'].max())
+    row['avg_speed_kmh'] = _number(df['speed_kmh'].mean())
+  return row
+
+
+def record_activity(conn, row):
+  """Inserts or replaces the catalog row of a file and its track cells."""
+  values = [row.get(column) for column in COLUMNS]
+  conn.execute(
+      f'INSERT OR REPLACE INTO activities ({", ".join(COLUMNS)}) '
+      f'VALUES ({", ".join("?" for _ in COLUMNS)})', values)
+  conn.execute('DELETE FROM cells WHERE path = ?', (row['path'],))
+  conn.executemany('INSERT INTO cells (cell, path) VALUES (?, ?)',
+                   [(cell, row['path']) for cell in row.get('cells', [])])
+  conn.commit()
+
+
+def is_indexed(conn, file_path, file_hash):
+  """Returns True if the file is catalogued with the same content.
+
+  Files with a track catalogued before the cells were recorded are indexed
+  again.
+  """
+  found = conn.execute(
+      'SELECT 1 FROM activities WHERE path = ? AND hash = ? AND '
+      '(min_lat IS NULL OR EXISTS (SELECT 1 FROM cells WHERE cells.path = '
+      'activities.path))', (file_path, file_hash)).fetchone()
+  return found is not None
+
+
+def _read_activities(catalog_path, conditions, params):
+  """Runs a select on the activities, parsing their start times."""
+  where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+
+  conn = open_catalog(catalog_path)
+  try:
+    rows = conn.execute(
+        f'SELECT * FROM activities {where} ORDER BY start_time, path',
+        params).fetchall()
+  finally:
+    conn.close()
+
+  activities = []
+  for row in rows:
+    activity = dict(row)
+    if activity['start_time']:
+      activity['start_time'] = dt.datetime.fromisoformat(
+          activity['start_time'])
+    activities.append(activity)
+  return activities
+
+
+def query_activities(catalog_path, sport=None, device=None, since=None,
+                     until=None, cells=None):
+  """Selects catalogued activities.
+
+  Args:
+    catalog_path: the catalog database
+    sport: exact sport name, eg. Biking
+    device: case insensitive text contained in the device label, eg. Polar
+    since: include activities starting on or after this ISO date/time (UTC)
+    until: include activities starting before this ISO date/time (UTC)
+    cells: include activities whose track passes through any of these
+           geohash cells, looked up in the cells index
+
+  Returns:
+    A list of dicts of the matching rows ordered by start time, with the
+    start_time parsed as a naive UTC datetime.
+  """
+  conditions = []
+  params = []
+  if sport:
+    conditions.append('sport = ?')
+    params.append(sport)
+  if device:
+    conditions.append('LOWER(device) LIKE ?')
+    params.append(f'%{device.lower()}%')
+  if since:
+    conditions.append('start_time >= ?')
+    params.append(since)
+  if until:
+    conditions.append('start_time < ?')
+    params.append(until)
+  if cells is not None:
+    conditions.append('path IN (SELECT path FROM cells WHERE cell IN '
+                      '(SELECT value FROM json_each(?)))')
+    params.append(json.dumps(list(cells)))
+  return _read_activities(catalog_path, conditions, params)
+
+
+def query_sessions(catalog_path, activities,
+                   gap_minutes=probe.SESSION_GAP_MINUTES):
+  """Groups queried activities into sessions with every device's recording.
+
+  A query on a device only matches that device's file, so the catalogued
+  files recorded alongside each match are added back to make up the
+  session.  As in discover_sessions, only files of the same folder are
+  grouped together.
+
+  Args:
+    catalog_path: the catalog database
+    activities: the matching rows from query_activities
+    gap_minutes: the most minutes after a session's first file that another
+                 file can start and still belong to it
+
+  Returns:
+    A list of sessions, each a list of catalog rows, ordered by start time.
+  """
+  times = [a['start_time'] for a in activities if a['start_time']]
+  candidates = [a for a in activities if not a['start_time']]
+  if times:
+    gap = dt.timedelta(minutes=gap_minutes)
+    candidates += _read_activities(
+        catalog_path, ['start_time >= ?', 'start_time <= ?'],
+        [(min(times) - gap).isoformat(), (max(times) + gap).isoformat()])
+
+  folders = {}
+  for activity in candidates:
+    folders.setdefault(os.path.dirname(activity['path']), []).append(activity)
+  matched = {a['path'] for a in activities}
+  sessions = []
+  for folder_activities in folders.values():
+    sessions.extend(
+        session
+        for session in probe.group_sessions(folder_activities, gap_minutes)
+        if any(a['path'] in matched for a in session))
+  return sorted(sessions, key=lambda session: (
+      session[0]['start_time'] or dt.datetime.max, session[0]['path']))
+
+
+def print_sessions(sessions):
+  """Prints queried sessions and the summary of each of their files."""
+  for session in sessions:
+    start_time = session[0]['start_time']
+    sport = next((a['sport'] for a in session if a['sport']), 'Unknown')
+    print(f'{start_time or "Unknown Time"}  {sport}')
+    for activity in session:
+      distance = activity['distance_meters']
+      distance = f'{distance / 1000:.2f} km' if distance is not None else '---'
+      heart_rate = activity['avg_heart_rate']
+      heart_rate = f'{heart_rate:.0f} bpm' if heart_rate is not None else '---'
+      print(f'    {activity["device"]}: {activity["point_count"]} points, '
+            f'{distance}, {heart_rate}: {activity["path"]}')
@@ -1,20 +1,10 @@
 """Combine multiple HTML files into a single HTML file with tabs."""
 import os
+import shutil
 
 
-def combine_html(output_filename, html_files, tab_labels):
-  """Combine multiple HTML files into a single HTML file with tabs.
-
-  Args:
-    output_filename (str): The output file path. If not specified, a temporary
-      file will be used.
-    html_files (list): A list of HTML file paths to combine.
-    tab_labels (list): A list of labels for the tabs.
-
-  Returns:
-    str: The path of the combined HTML file.
-  """
-
+def _template_parts(tab_labels, extra_html):
+  """Returns the template HTML before and after the tab content."""
   template_filename = 'html/combined_template.html'
   template_path = os.path.join(os.path.dirname(__file__), template_filename)
   with open(template_path, 'r') as template_file:
@@ -33,22 +23,61 @@ def combine_html(output_filename, html_files, tab_labels):
           '<button class="tablinks" onclick="openTab(event,'
           f" 'tab{i}')\">{label}</button>\n"
       )
-  combined_html = combined_html.replace('{tab_header}', tab_header)
-
-  # Create the tab content
-  tab_content = ''
-  for i, html_file in enumerate(html_files):
-    with open(html_file, 'r') as infile:
-      content = infile.read()
-      if i == 0:
-        tab_content += f'<div id="tab{i}" class="tabcontent active">\n'
-      else:
-        tab_content += f'<div id="tab{i}" class="tabcontent">\n'
-      tab_content += content
-      tab_content += '</div>\n'
-  combined_html = combined_html.replace('{tab_content}', tab_content)
+  head, tail = combined_html.split('{tab_content}')
+  head = head.replace('{tab_header}', tab_header)
+  tail = tail.replace('{extra_html}', extra_html)
+  return head, tail
+
+
+def _tab_start(i):
+  if i == 0:
+    return f'<div id="tab{i}" class="tabcontent active">\n'
+  return f'<div id="tab{i}" class="tabcontent">\n'
 
+
+def combine_html(output_filename, html_files, tab_labels, extra_html=''):
+  """Combine multiple HTML files into a single HTML file with tabs.
+
+  Args:
+    output_filename (str): The output file path. If not specified, a temporary
+      file will be used.
+    html_files (list): A list of HTML file paths to combine.
+    tab_labels (list): A list of labels for the tabs.
+    extra_html (str): Optional HTML, eg. scripts, added after the tabs.
+
+  Returns:
+    str: The path of the combined HTML file.
+  """
+  head, tail = _template_parts(tab_labels, extra_html)
+
+  # Copy the tab content one file at a time, so a large report is never held
+  # in memory as a whole
   with open(output_filename, 'w') as outfile:
-    outfile.write(combined_html)
+    outfile.write(head)
+    for i, html_file in enumerate(html_files):
+      outfile.write(_tab_start(i))
+      with open(html_file, 'r') as infile:
+        shutil.copyfileobj(infile, outfile)
+      outfile.write('</div>\n')
+    outfile.write(tail)
 
   return output_filename
+
+
+def combine_html_string(html_sections, tab_labels, extra_html=''):
+  """Combine multiple HTML strings into a single HTML string with tabs.
+
+  Args:
+    html_sections (list): A list of the HTML string of each tab.
+    tab_labels (list): A list of labels for the tabs.
+    extra_html (str): Optional HTML, eg. scripts, added after the tabs.
+
+  Returns:
+    str: The combined HTML.
+  """
+  head, tail = _template_parts(tab_labels, extra_html)
+  parts = [head]
+  for i, html in enumerate(html_sections):
+    parts.extend([_tab_start(i), html, '</div>\n'])
+  parts.append(tail)
+  return ''.join(parts)
@@ -0,0 +1,277 @@
+"""Derive elevation, grade and vertical speed and measure them per device."""
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from utils import memory_budget, utils
+
+# Width in seconds of the centered window the altitude is averaged over, and
+# the grade and vertical speed are measured across
+DEFAULT_WINDOW_SECONDS = 10.0
+# Windows covering less distance have no grade, eg. while stopped
+MIN_GRADE_METERS = 5.0
+
+# The channels derived from alt_meters, see add_elevation
+ELEVATION_COLUMNS = ('elevation_meters', 'grade_percent', 'vertical_speed_mh')
+
+
+def _windows(seconds, window):
+  """Returns the first and last sample of the window centered on each."""
+  first = np.searchsorted(seconds, seconds - window / 2, side='left')
+  last = np.searchsorted(seconds, seconds + window / 2, side='right') - 1
+  return first, last
+
+
+def track_grade(seconds, elevation, distance,
+                window=DEFAULT_WINDOW_SECONDS):
+  """Returns the grade in percent of each sample of a track.
+
+  Args:
+    seconds: array of the sample times in seconds, in time order
+    elevation: array of smoothed elevations in meters, see track_channels
+    distance: array of cumulative distances in meters
+    window: width of the window in seconds
+
+  Returns:
+    An array of the climb over the distance across the window of each
+    sample, NaN where the window covers less than MIN_GRADE_METERS.
+  """
+  seconds = np.asarray(seconds, dtype=float)
+  elevation = np.asarray(elevation, dtype=float)
+  distance = np.asarray(distance, dtype=float)
+  first, last = _windows(seconds, window)
+  run = distance[last] - distance[first]
+  with np.errstate(invalid='ignore', divide='ignore'):
+    return np.where(run >= MIN_GRADE_METERS,
+                    (elevation[last] - elevation[first]) / run * 100.0,
+                    np.nan)
+
+
+def track_channels(seconds, altitude, distance=None,
+                   window=DEFAULT_WINDOW_SECONDS):
+  """Derives the elevation channels of a track.
+
+  The altitude is averaged over a centered time window with cumulative
+  sums, so irregular sampling and missing altitudes need no loop.  Grade
+  and vertical speed are the change of the averaged altitude across the
+  same window.
+
+  Args:
+    seconds: array of the sample times in seconds, in time order
+    altitude: array of altitudes in meters, NaN where missing
+    distance: optional array of cumulative distances in meters
+    window: width of the window in seconds
+
+  Returns:
+    A tuple of the smoothed elevation in meters, the grade in percent, NaN
+    without a distance, and the vertical speed in meters per hour.
+  """
+  seconds = np.asarray(seconds, dtype=float)
+  altitude = np.asarray(altitude, dtype=float)
+  valid = ~np.isnan(altitude)
+  first, last = _windows(seconds, window)
+  sums = np.concatenate([[0.0], np.cumsum(np.where(valid, altitude, 0.0))])
+  counts = np.concatenate([[0], np.cumsum(valid)])
+  with np.errstate(invalid='ignore', divide='ignore'):
+    elevation = np.where(
+        valid, (sums[last + 1] - sums[first])
+        / (counts[last + 1] - counts[first]), np.nan)
+    elapsed = seconds[last] - seconds[first]
+    vertical_speed = np.where(
+        elapsed > 0, (elevation[last] - elevation[first]) / elapsed * 3600.0,
+        np.nan)
+  grade = np.full(len(seconds), np.nan)
+  if distance is not None:
+    grade = track_grade(seconds, elevation, distance, window)
+  return elevation, grade, vertical_speed
+
+
+def add_elevation(df, window=DEFAULT_WINDOW_SECONDS):
+  """Adds the elevation channels of a single file from its alt_meters.
+
+  Args:
+    df: the DataFrame of a file, see process_files.derive_track
+    window: width of the window in seconds, see track_channels
+
+  Returns:
+    The DataFrame with the ELEVATION_COLUMNS when it has an altitude.
+  """
+  if 'alt_meters' not in df.columns:
+    return df
+  altitude = pd.to_numeric(df['alt_meters'], errors='coerce').to_numpy(
+      dtype=float, na_value=np.nan)
+  if np.isnan(altitude).all():
+    return df
+  seconds = (df['time'] - df['time'].min()).dt.total_seconds().to_numpy()
+  distance = None
+  if 'calc_distance_meters' in df.columns:
+    distance = df['calc_distance_meters'].to_numpy(dtype=float)
+  # Files are derived as recorded, before their samples are sorted
+  order = np.argsort(seconds, kind='stable')
+  channels = track_channels(seconds[order], altitude[order],
+                            None if distance is None else distance[order],
+                            window)
+  for column, values in zip(ELEVATION_COLUMNS, channels):
+    recorded = np.empty(len(df))
+    recorded[order] = values
+    df[column] = recorded
+  return df
+
+
+def has_elevation(combined_df):
+  """Returns True if any device recorded an altitude."""
+  return ('elevation_meters' in combined_df.columns
+          and bool(combined_df['elevation_meters'].notnull().any()))
+
+
+def get_elevation_metrics(combined_df, ref_device, small_ratio, window=None):
+  """Gets the climb of each device and its elevation error vs ref device.
+
+  The ascent and descent of every device are summed from the rises and falls
+  of its smoothed elevation in a single groupby.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    ref_device: the string used to determine the ref device
+    small_ratio: meters to the unit shown, eg. utils.M_TO_FT_RATIO
+    window: optional pd.Timedelta, match the devices one time window at a
+            time, see memory_budget.matched_parts
+
+  Returns:
+    A DataFrame with a row per device with an elevation.
+  """
+  columns = ['Device', 'Ascent', 'Descent', 'Min', 'Max', 'MaxGrade',
+             'MaxClimbRate', 'MAE', 'Bias', 'Samples']
+  df = combined_df[['time', 'device', *ELEVATION_COLUMNS]].dropna(
+      subset=['elevation_meters'])
+  if df.empty:
+    return pd.DataFrame(columns=columns)
+  steps = df.groupby('device')['elevation_meters'].diff()
+  df = df.assign(ascent=steps.clip(lower=0), descent=-steps.clip(upper=0))
+  summary = df.groupby('device').agg(
+      Ascent=('ascent', 'sum'), Descent=('descent', 'sum'),
+      Min=('elevation_meters', 'min'), Max=('elevation_meters', 'max'),
+      MaxGrade=('grade_percent', 'max'),
+      MaxClimbRate=('vertical_speed_mh', 'max'),
+      Samples=('elevation_meters', 'size'))
+
+  ref_data = df[df['device'].str.contains(ref_device, case=False)]
+  rows = []
+  for device, row in summary.iterrows():
+    mae = bias = '---'
+    if not device.lower().startswith(ref_device.lower()):
+      errors = [
+          merged['elevation_meters'].to_numpy(dtype=float)
+          - merged['elevation_meters_ref'].to_numpy(dtype=float)
+          for merged in memory_budget.matched_parts(
+              df[df['device'] == device], ref_data, 'elevation_meters',
+              window)
+      ]
+      errors = np.concatenate(errors) if errors else np.empty(0)
+      if len(errors):
+        mae = round(np.mean(np.abs(errors)) * small_ratio, 2)
+        bias = round(np.mean(errors) * small_ratio, 2)
+    rows.append({
+        'Device': device,
+        'Ascent': round(row['Ascent'] * small_ratio, 1),
+        'Descent': round(row['Descent'] * small_ratio, 1),
+        'Min': round(row['Min'] * small_ratio, 1),
+        'Max': round(row['Max'] * small_ratio, 1),
+        'MaxGrade': round(row['MaxGrade'], 1),
+        'MaxClimbRate': round(row['MaxClimbRate'] * small_ratio),
+        'MAE': mae,
+        'Bias': bias,
+        'Samples': int(row['Samples']),
+    })
+  return pd.DataFrame(rows, columns=columns)
+
+
+def plot_elevation(df, ref_device, sport, start_time, unit_of_measure,
+                   window=None):
+  """Plots the smoothed elevation of each device.
+
+  Args:
+    df:  the dataframe containing the data
+    ref_device: the reference test device label
+    sport: specifices the sport eg. Biking for which the data was generated
+    start_time: start time of the activity
+    unit_of_measure:  IMPERIAL or METRIC
+    window: optional pd.Timedelta, match the devices one time window at a
+            time, see memory_budget.matched_parts
+
+  Returns:
+    fig:  A plot of the elevation for the activity
+
+  """
+  small_ratio = 1.0
+  small_unit = 'm'
+  if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
+    small_ratio = utils.M_TO_FT_RATIO
+    small_unit = 'ft'
+
+  metrics_table = get_elevation_metrics(df, ref_device, small_ratio, window)
+  duration = df['time'].max() - df['time'].min()
+  minutes, seconds = divmod(duration.seconds, 60)
+
+  fig = go.Figure()
+  for device, data in df.dropna(subset=['elevation_meters']).groupby(
+      'device'):
+    fig.add_trace(
+        go.Scatter(
+            x=data['time'],
+            y=data['elevation_meters'] * small_ratio,
+            mode='lines',
+            name=device,
+            legendgroup=device,
+            showlegend=True
+        )
+    )
+
+  fig.update_layout(
+      title=dict(
+          text=(f'Elevation ({sport}) - {start_time}'),
+          font=dict(size=20, color='black'),
+          yanchor='top',
+          y=0.95,
+          xanchor='center',
+          x=0.5,
+      ),
+      xaxis_title=f'Duration: {minutes}m {seconds}s',
+      yaxis_title=f'Elevation ({small_unit})',
+      plot_bgcolor='white',
+      xaxis=dict(linecolor='black'),
+      yaxis=dict(linecolor='black'),
+      legend=dict(
+          orientation='h', yanchor='bottom', y=-0.2, xanchor='center', x=0.5
+      ),
+      margin=dict(l=20, r=20, t=20, b=20),
+      height=600,
+      width=1200
+  )
+
+  headers = ['Device', f'MAE\t({small_unit})', f'Bias\t({small_unit})',
+             f'Ascent\t({small_unit})', f'Descent\t({small_unit})',
+             'Max\tGrade\t(%)']
+  columns = ['Device', 'MAE', 'Bias', 'Ascent', 'Descent', 'MaxGrade']
+  fig.add_trace(
+      go.Table(
+          columnwidth=[2.5] + [1] * (len(columns) - 1),
+          header=dict(
+              values=headers,
+              fill_color='paleturquoise',
+              align=['left'] + ['right'] * (len(columns) - 1),
+              font=dict(size=14),
+              height=40
+          ),
+          cells=dict(
+              values=[metrics_table[column] for column in columns],
+              fill_color='lavender',
+              align=['left'] + ['right'] * (len(columns) - 1),
+              font=dict(size=12),
+              height=30
+          ),
+          domain=dict(x=[0.6, 1.0], y=[0.01, 0.3]),
+      )
+  )
+
+  return fig
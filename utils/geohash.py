@@ -0,0 +1,101 @@
+"""Vectorized geohash cells of GPS tracks."""
+import numpy as np
+
+BASE32 = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+
+# 7 characters are cells of about 150 x 150 m at the equator, narrower
+# towards the poles
+DEFAULT_PRECISION = 7
+
+
+def _bits(precision):
+  """Returns the number of longitude and latitude bits of a geohash."""
+  total = 5 * precision
+  return (total + 1) // 2, total // 2
+
+
+def cell_indices(latitude, longitude, precision=DEFAULT_PRECISION):
+  """Returns the row and column of the geohash cell of each point.
+
+  Args:
+    latitude: array of latitudes in decimal degrees
+    longitude: array of longitudes in decimal degrees
+    precision: number of geohash characters
+
+  Returns:
+    A tuple of the int64 latitude and longitude cell index arrays.
+  """
+  lon_bits, lat_bits = _bits(precision)
+  latitude = np.asarray(latitude, dtype=float)
+  longitude = np.asarray(longitude, dtype=float)
+  rows = np.floor((latitude + 90.0) / 180.0 * (1 << lat_bits))
+  columns = np.floor((longitude + 180.0) / 360.0 * (1 << lon_bits))
+  rows = np.clip(rows, 0, (1 << lat_bits) - 1).astype(np.int64)
+  columns = np.clip(columns, 0, (1 << lon_bits) - 1).astype(np.int64)
+  return rows, columns
+
+
+def encode_indices(rows, columns, precision=DEFAULT_PRECISION):
+  """Encodes cell indices as geohash strings, see cell_indices."""
+  lon_bits, lat_bits = _bits(precision)
+  rows = np.asarray(rows, dtype=np.int64)
+  columns = np.asarray(columns, dtype=np.int64)
+  # Interleave the bits, longitude first, most significant bit first
+  code = np.zeros(np.shape(rows), dtype=np.int64)
+  for bit in range(5 * precision):
+    if bit % 2 == 0:
+      value = (columns >> (lon_bits - 1 - bit // 2)) & 1
+    else:
+      value = (rows >> (lat_bits - 1 - bit // 2)) & 1
+    code = (code << 1) | value
+  hashes = np.full(np.shape(rows), '', dtype=f'<U{precision}')
+  for i in range(precision):
+    digits = (code >> (5 * (precision - 1 - i))) & 31
+    hashes = np.char.add(hashes, BASE32[digits])
+  return hashes
+
+
+def encode(latitude, longitude, precision=DEFAULT_PRECISION):
+  """Returns the geohash of each point.
+
+  Args:
+    latitude: array of latitudes in decimal degrees
+    longitude: array of longitudes in decimal degrees
+    precision: number of geohash characters
+
+  Returns:
+    A numpy array of geohash strings.
+  """
+  rows, columns = cell_indices(latitude, longitude, precision)
+  return encode_indices(rows, columns, precision)
+
+
+def track_cells(latitude, longitude, precision=DEFAULT_PRECISION,
+                neighbours=False):
+  """Returns the distinct geohash cells a track passes through.
+
+  Args:
+    latitude: array of latitudes in decimal degrees, missing fixes are
+              skipped
+    longitude: array of longitudes in decimal degrees
+    precision: number of geohash characters
+    neighbours: also include the 8 cells around each cell, so tracks of the
+                same route recorded on either side of a cell border match
+
+  Returns:
+    A sorted list of geohash strings.
+  """
+  latitude = np.asarray(latitude, dtype=float)
+  longitude = np.asarray(longitude, dtype=float)
+  valid = ~(np.isnan(latitude) | np.isnan(longitude))
+  rows, columns = cell_indices(latitude[valid], longitude[valid], precision)
+  cells = np.unique(np.column_stack([rows, columns]), axis=0)
+  if neighbours and len(cells):
+    lon_bits, lat_bits = _bits(precision)
+    offsets = np.array([(r, c) for r in (-1, 0, 1) for c in (-1, 0, 1)])
+    cells = (cells[:, None, :] + offsets[None, :, :]).reshape(-1, 2)
+    # Rows stop at the poles, columns wrap around the antimeridian
+    cells = cells[(cells[:, 0] >= 0) & (cells[:, 0] < (1 << lat_bits))]
+    cells[:, 1] %= 1 << lon_bits
+    cells = np.unique(cells, axis=0)
+  return sorted(encode_indices(cells[:, 0], cells[:, 1], precision).tolist())
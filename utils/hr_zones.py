@@ -0,0 +1,234 @@
+"""Heart rate zones, time in zone per device and zone agreement vs GT."""
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from utils import memory_budget, stationary
+
+DEFAULT_MAX_HR = 190
+# Lower bound of zones 1 to 5 as a percentage of the max heart rate
+ZONE_PERCENTS = (50, 60, 70, 80, 90)
+
+
+def parse_bounds(text):
+  """Parses comma separated, increasing zone lower bounds in BPM."""
+  bounds = tuple(float(value) for value in text.split(','))
+  if not bounds or any(b <= a for a, b in zip(bounds, bounds[1:])):
+    raise ValueError(f'zone bounds must be increasing: {text}')
+  return bounds
+
+
+def zone_bounds(max_hr=None, bounds=None):
+  """Returns the lower bound in BPM of each zone.
+
+  Args:
+    max_hr: the max heart rate the zones are a percentage of
+            (default: DEFAULT_MAX_HR)
+    bounds: explicit lower bounds, used instead of max_hr when set
+
+  Returns:
+    A tuple of increasing lower bounds, zone 1 first.
+  """
+  if bounds:
+    return tuple(bounds)
+  max_hr = max_hr or DEFAULT_MAX_HR
+  return tuple(round(max_hr * percent / 100.0) for percent in ZONE_PERCENTS)
+
+
+def zone_names(bounds):
+  """Returns the name of each zone, starting with the one below zone 1."""
+  return ['<Z1'] + [f'Z{zone}' for zone in range(1, len(bounds) + 1)]
+
+
+def to_zones(heart_rate, bounds):
+  """Returns the zone index of each heart rate, 0 below zone 1."""
+  return np.searchsorted(np.asarray(bounds, dtype=float),
+                         np.asarray(heart_rate, dtype=float), side='right')
+
+
+def time_in_zones(combined_df, bounds,
+                  pause_gap=stationary.DEFAULT_PAUSE_GAP_SECONDS):
+  """Sums the time every device spent in each zone.
+
+  Each interval to the next heart rate sample counts in the zone of the
+  sample starting it, unless it is longer than pause_gap.  The intervals of
+  every device are counted with a single weighted bincount.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    bounds: the lower bound of each zone, see zone_bounds
+    pause_gap: longest interval in seconds counted as recorded time
+
+  Returns:
+    A DataFrame of seconds with a row per device and a column per zone.
+  """
+  names = zone_names(bounds)
+  df = combined_df[['device', 'time', 'heart_rate']].dropna()
+  df = df.sort_values(['device', 'time'], kind='stable')
+  if df.empty:
+    return pd.DataFrame(columns=names, dtype=float)
+
+  codes, devices = pd.factorize(df['device'], sort=True)
+  seconds = (df['time'] - df['time'].iloc[0]).dt.total_seconds().to_numpy()
+  intervals = np.diff(seconds, append=seconds[-1])
+  last = np.append(codes[1:] != codes[:-1], True)
+  intervals[last | (intervals > pause_gap)] = 0.0
+
+  zones = to_zones(df['heart_rate'], bounds)
+  totals = np.bincount(codes * len(names) + zones, weights=intervals,
+                       minlength=len(devices) * len(names))
+  return pd.DataFrame(totals.reshape(len(devices), len(names)),
+                      index=devices, columns=names)
+
+
+def zone_agreement(data, ground_truth, bounds, window=None):
+  """Counts the samples in the same zone as the GT device at equal times.
+
+  Args:
+    data: DataFrame of the device with 'time' and 'heart_rate'
+    ground_truth: DataFrame of the GT device with 'time' and 'heart_rate'
+    bounds: the lower bound of each zone, see zone_bounds
+    window: optional pd.Timedelta, see memory_budget.matched_parts
+
+  Returns:
+    A tuple of the number of agreeing and of matched samples.
+  """
+  agreeing = 0
+  count = 0
+  for merged in memory_budget.matched_parts(data, ground_truth, 'heart_rate',
+                                            window):
+    agreeing += int(np.sum(to_zones(merged['heart_rate'], bounds)
+                           == to_zones(merged['heart_rate_ref'], bounds)))
+    count += len(merged)
+  return agreeing, count
+
+
+def get_zone_metrics(combined_df, ground_truth_device, bounds, window=None):
+  """Gets the share of time in each zone and the zone agreement vs GT.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    ground_truth_device: the string used to determine GT device
+    bounds: the lower bound of each zone, see zone_bounds
+    window: optional pd.Timedelta, match the devices one time window at a
+            time, see memory_budget.matched_parts
+
+  Returns:
+    A DataFrame with a row for the GT device and each device recording heart
+    rate, the percentage of its time in each zone and the percentage of the
+    samples matched with the GT device in the same zone.
+  """
+  seconds = time_in_zones(combined_df, bounds)
+  shares = seconds.div(seconds.sum(axis=1).replace(0.0, np.nan), axis=0)
+  shares = (shares * 100.0).round(1)
+
+  is_gt = combined_df['device'].str.contains(ground_truth_device, case=False)
+  ground_truth = combined_df[is_gt]
+  gt_devices = [d for d in shares.index
+                if d.lower().startswith(ground_truth_device.lower())]
+
+  rows = []
+  for device in gt_devices[:1]:
+    rows.append({
+        'Device': device,
+        **shares.loc[device].to_dict(),
+        'Agreement': '---',
+        'Samples': int(ground_truth['heart_rate'].notnull().sum()),
+    })
+  for device in shares.index:
+    if device in gt_devices:
+      continue
+    agreeing, samples = zone_agreement(
+        combined_df[combined_df['device'] == device], ground_truth, bounds,
+        window)
+    rows.append({
+        'Device': device,
+        **shares.loc[device].to_dict(),
+        'Agreement': round(agreeing / samples * 100.0, 1) if samples else '---',
+        'Samples': samples,
+    })
+  return pd.DataFrame(rows)
+
+
+def plot_hr_zones(df, ground_truth_device, bounds, sport, start_time,
+                  window=None):
+  """plots the time each device spent in each heart rate zone.
+
+  Args:
+    df:  the dataframe containing the data
+    ground_truth_device: The label for the device considered to be the source
+                         of truth for heart rate data
+    bounds: the lower bound of each zone, see zone_bounds
+    sport: specifices the sport eg. Biking for which the data was generated
+    start_time: start time of the activity
+    window: optional pd.Timedelta, match the devices one time window at a
+            time, see memory_budget.matched_parts
+
+  Returns:
+    fig:  A bar chart of the minutes in each zone for the activity
+
+  """
+  names = zone_names(bounds)
+  labels = [f'{names[0]} (<{bounds[0]:g})'] + [
+      f'{name} ({lower:g}+)' for name, lower in zip(names[1:], bounds)]
+  minutes = time_in_zones(df, bounds) / 60.0
+  metrics_table = get_zone_metrics(df, ground_truth_device, bounds, window)
+
+  fig = go.Figure()
+  for device, row in minutes.iterrows():
+    fig.add_trace(
+        go.Bar(
+            x=labels,
+            y=row.round(2).to_numpy(),
+            name=device,
+            legendgroup=device,
+        )
+    )
+
+  fig.update_layout(
+      title=dict(
+          text=(f'Heart Rate Zones ({sport}) - {start_time}'),
+          font=dict(size=20, color='black'),
+          yanchor='top',
+          y=0.95,
+          xanchor='center',
+          x=0.5,
+      ),
+      barmode='group',
+      xaxis=dict(linecolor='black', domain=[0.0, 0.55]),
+      yaxis=dict(linecolor='black'),
+      yaxis_title='Time in Zone (min)',
+      plot_bgcolor='white',
+      legend=dict(
+          orientation='h', yanchor='bottom', y=-0.2, xanchor='center', x=0.5
+      ),
+      margin=dict(l=50, r=50, t=50, b=20),
+      height=600
+  )
+
+  # Add the metrics table to the right of the bars
+  columns = ['Device'] + names + ['Agreement']
+  fig.add_trace(
+      go.Table(
+          columnwidth=[2.0] + [1.0] * len(names) + [1.4],
+          header=dict(
+              values=['Device'] + [f'{name}\t(%)' for name in names]
+              + ['Same\tZone\tvs\tGT\t(%)'],
+              fill_color='paleturquoise',
+              align=['left'] + ['right'] * (len(columns) - 1),
+              font=dict(size=14),
+              height=40
+          ),
+          cells=dict(
+              values=[metrics_table[column] for column in columns],
+              fill_color='lavender',
+              align=['left'] + ['right'] * (len(columns) - 1),
+              font=dict(size=12),
+              height=30
+          ),
+          domain=dict(x=[0.6, 1.0], y=[0.3, 0.9]),
+      )
+  )
+
+  return fig
@@ -0,0 +1,209 @@
+"""Per-activity and per-lap breakdowns of a session."""
+
+import pandas as pd
+import plotly.graph_objects as go
+
+from utils import stationary, utils
+
+# Column averaged over each lap and the name of its metric
+LAP_AVERAGES = {
+    'heart_rate': 'AvgHR',
+    'power_watts': 'AvgPower',
+    'cadence': 'AvgCadence',
+}
+
+
+def count_activities(combined_df):
+  """Returns the number of activities recorded by any device."""
+  if 'activity' not in combined_df.columns:
+    return 1
+  return max(int(combined_df['activity'].nunique()), 1)
+
+
+def has_laps(combined_df):
+  """Returns True if a device recorded several laps or activities."""
+  if 'lap' not in combined_df.columns:
+    return False
+  laps = combined_df.groupby(['device', 'activity'])['lap'].nunique()
+  return count_activities(combined_df) > 1 or bool((laps > 1).any())
+
+
+def activity_spans(combined_df):
+  """Returns the time span of each activity of the session.
+
+  The spans are those of the device recording the most activities, the one
+  with the most samples among those, since another device may record a
+  multisport session as a single activity.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+
+  Returns:
+    A DataFrame with the start and end time and the sport, '' if unknown, of
+    each activity, indexed from 0 in the order they were recorded.
+  """
+  counts = combined_df.groupby('device')['activity'].agg(['nunique', 'size'])
+  device = counts.sort_values(['nunique', 'size'], ascending=False,
+                              kind='stable').index[0]
+  data = combined_df[combined_df['device'] == device]
+  spans = data.groupby('activity', sort=True)['time'].agg(['min', 'max'])
+  spans = spans.rename(columns={'min': 'start', 'max': 'end'})
+  spans['sport'] = ''
+  if 'activity_sport' in data.columns:
+    sports = data['activity_sport'].astype(str)
+    sports = sports[sports != '']
+    if not sports.empty:
+      spans['sport'] = sports.groupby(data['activity']).agg(
+          lambda values: values.mode().iloc[0]).reindex(
+              spans.index, fill_value='')
+  return spans.reset_index(drop=True)
+
+
+def split_activities(combined_df, sport):
+  """Splits a session into one session per activity.
+
+  A device recording every activity keeps its own activities.  The samples
+  of a device recording fewer, eg. a multisport session as one activity,
+  are assigned to the activity whose time span contains them, see
+  activity_spans, and its samples between the activities, eg. transitions,
+  are left out.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    sport: the sport of the session, used for activities without one
+
+  Yields:
+    A tuple of the activity index and its DataFrame, sport and start time as
+    a naive UTC datetime, like process_files.load_session.
+  """
+  spans = activity_spans(combined_df)
+  times = combined_df['time']
+  own = (combined_df.groupby('device')['activity'].transform('nunique')
+         == len(spans))
+  for activity, span in enumerate(spans.itertuples(index=False)):
+    in_span = (times >= span.start) & (times <= span.end)
+    data = combined_df[(own & (combined_df['activity'] == activity))
+                       | (~own & in_span)]
+    if data.empty:
+      continue
+    data = data.assign(activity=activity)
+    activity_sport = span.sport or sport
+    start_time = data['time'].min().tz_convert('UTC').tz_localize(None)
+    yield (activity, data.reset_index(drop=True), activity_sport,
+           start_time.to_pydatetime())
+
+
+def get_lap_metrics(combined_df, unit_of_measure):
+  """Gets the duration, distance and averages of every lap of every device.
+
+  Every lap is aggregated by a single groupby over device, activity and lap.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    unit_of_measure: IMPERIAL or METRIC
+
+  Returns:
+    A DataFrame with a row per device, activity and lap, numbered from 1.
+  """
+  ratio = 1.0
+  if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
+    ratio = utils.KM_TO_MILE_RATIO
+
+  keys = ['device', 'activity', 'lap']
+  columns = {'time': combined_df['time']}
+  for column in ['calc_distance_meters', *LAP_AVERAGES]:
+    if column in combined_df.columns:
+      columns[column] = pd.to_numeric(combined_df[column], errors='coerce')
+  df = pd.DataFrame({**{key: combined_df[key] for key in keys}, **columns})
+
+  aggregations = {'Start': ('time', 'min'), 'End': ('time', 'max')}
+  if 'calc_distance_meters' in df.columns:
+    aggregations['First'] = ('calc_distance_meters', 'min')
+    aggregations['Last'] = ('calc_distance_meters', 'max')
+  for column, name in LAP_AVERAGES.items():
+    if column in df.columns:
+      aggregations[name] = (column, 'mean')
+  if 'heart_rate' in df.columns:
+    aggregations['MaxHR'] = ('heart_rate', 'max')
+  laps = df.groupby(keys, sort=True, observed=True).agg(**aggregations)
+  laps = laps.reset_index()
+
+  seconds = (laps['End'] - laps['Start']).dt.total_seconds()
+  table = pd.DataFrame({
+      'Device': laps['device'].astype(str),
+      'Activity': laps['activity'].astype(int) + 1,
+      'Lap': laps['lap'].astype(int) + 1,
+      'Start': laps['Start'].dt.strftime('%H:%M:%S'),
+      'Duration': seconds.map(stationary.format_duration),
+  })
+  if 'First' in laps.columns:
+    distance = (laps['Last'] - laps['First']) / 1000 * ratio
+    table['Distance'] = distance.round(3)
+    table['AvgSpeed'] = (distance / (seconds / 3600)).where(
+        seconds > 0).round(2)
+  for name in [*LAP_AVERAGES.values(), 'MaxHR']:
+    if name in laps.columns:
+      table[name] = laps[name].round(1)
+  return table
+
+
+def plot_laps(df, sport, start_time, unit_of_measure):
+  """Builds a table of every lap of every device.
+
+  Args:
+    df:  the dataframe containing the data
+    sport: specifices the sport eg. Biking for which the data was generated
+    start_time: start time of the activity
+    unit_of_measure:  IMPERIAL or METRIC
+
+  Returns:
+    fig:  A table of the laps for the activity
+
+  """
+  distance_unit, speed_unit = 'km', 'km/h'
+  if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
+    distance_unit, speed_unit = 'mi', 'mph'
+  labels = {
+      'Distance': f'Distance\t({distance_unit})',
+      'AvgSpeed': f'Avg\tSpeed\t({speed_unit})',
+      'AvgHR': 'Avg\tHR',
+      'MaxHR': 'Max\tHR',
+      'AvgPower': 'Avg\tPower\t(W)',
+      'AvgCadence': 'Avg\tCadence',
+  }
+
+  metrics_table = get_lap_metrics(df, unit_of_measure)
+  columns = list(metrics_table.columns)
+  fig = go.Figure()
+  fig.add_trace(
+      go.Table(
+          columnwidth=[2.0] + [1.0] * (len(columns) - 1),
+          header=dict(
+              values=[labels.get(column, column) for column in columns],
+              fill_color='paleturquoise',
+              align=['left'] + ['right'] * (len(columns) - 1),
+              font=dict(size=14),
+              height=40
+          ),
+          cells=dict(
+              values=[metrics_table[column] for column in columns],
+              fill_color='lavender',
+              align=['left'] + ['right'] * (len(columns) - 1),
+              font=dict(size=12),
+              height=30
+          ),
+      )
+  )
+  fig.update_layout(
+      title=dict(
+          text=(f'Laps ({sport}) - {start_time}'),
+          font=dict(size=20, color='black'),
+          yanchor='top',
+          y=0.95,
+          xanchor='center',
+          x=0.5,
+      ),
+      margin=dict(l=50, r=50, t=80, b=20),
+      height=max(400, 120 + 30 * len(metrics_table)),
+  )
+  return fig
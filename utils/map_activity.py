@@ -2,12 +2,116 @@
 
 import json
 
+import numpy as np
 import pandas as pd
 
-from utils import utils
+from utils import binary_traces, utils
 
 
-def map_activity(df, sport, api_key, unit_of_measure):
+def _location_columns(data, ratio, small_ratio):
+  """Computes the marker fields of one device's fixes as arrays.
+
+  Args:
+    data: the rows of a single device
+    ratio: the km to km/mile ratio
+    small_ratio: the m to m/ft ratio
+
+  Returns:
+    A dict of 'time' (local times), 'wall_ms', 'heart_rate', 'alt_meters',
+    'lat', 'long', 'distance', 'speed' and 'track_error' arrays, NaN when
+    missing.
+  """
+  lat = data['position'].map(lambda pos: pos['lat'])
+  long = data['position'].map(lambda pos: pos['long'])
+  data = data[lat.notna() & long.notna()]
+  lat, long = lat[data.index], long[data.index]
+
+  def column(name):
+    if name not in data.columns:
+      return np.full(len(data), np.nan)
+    return pd.to_numeric(data[name], errors='coerce').to_numpy(dtype=float)
+
+  # Distances are rounded in the display unit, then shown scaled again
+  distance = np.array([round(d / 1000 * ratio, 2)
+                       for d in column('calc_distance_meters')])
+  track_error = np.array([round(e * small_ratio, 2)
+                          for e in column('track_error_meters')])
+  return {
+      'time': data['time'],
+      'wall_ms': binary_traces.wall_clock_ms(data['time']),
+      'heart_rate': data['heart_rate'].to_numpy(),
+      'alt_meters': data['alt_meters'].to_numpy()
+                    if 'alt_meters' in data.columns
+                    else np.full(len(data), None),
+      'lat': lat.to_numpy(),
+      'long': long.to_numpy(),
+      'distance': distance * ratio,
+      'speed': column('speed_kmh') * ratio,
+      'track_error': track_error,
+  }
+
+
+def _json_value(value):
+  """Converts a column value into a plain JSON value, None when missing."""
+  if isinstance(value, np.generic):
+    value = value.item()
+  if isinstance(value, float) and np.isnan(value):
+    return None
+  return value
+
+
+def _location_dicts(columns, distance_label, speed_label):
+  """Returns the marker dicts of a device's location columns."""
+  times = columns['time'].dt.strftime('%Y-%m-%d %H:%M:%S %p').tolist()
+  locations = []
+  for i, time in enumerate(times):
+    track_error = columns['track_error'][i]
+    locations.append({
+        'device': columns['device'],
+        'time': time,
+        'heart_rate': _json_value(columns['heart_rate'][i]),
+        'alt_meters': _json_value(columns['alt_meters'][i]),
+        'position': {'lat': columns['lat'][i], 'lng': columns['long'][i]},
+        'distance': format(columns['distance'][i], '.4f'),
+        'distance_label': distance_label,
+        'speed': format(columns['speed'][i], '.2f'),
+        'speed_label': speed_label,
+        'track_error': None if np.isnan(track_error) else float(track_error),
+    })
+  return locations
+
+
+def _encode_locations(device_columns):
+  """Packs every device's location columns as base64 typed arrays."""
+  def concat(name):
+    if not device_columns:
+      return np.empty(0)
+    return np.concatenate([
+        pd.to_numeric(pd.Series(c[name]), errors='coerce').to_numpy(
+            dtype=float)
+        for c in device_columns
+    ])
+
+  devices = [c['device'] for c in device_columns]
+  encoded = {
+      'devices': devices,
+      'device': binary_traces.encode_array(
+          np.repeat(np.arange(len(devices)),
+                    [len(c['lat']) for c in device_columns]), 'u2'),
+      'time': binary_traces.encode_array(concat('wall_ms'), 'f8'),
+  }
+  for name in ('heart_rate', 'alt_meters', 'lat', 'long', 'distance',
+               'speed', 'track_error'):
+    values = concat(name)
+    dtype = binary_traces.compact_dtype(values)
+    if name in ('lat', 'long'):
+      dtype = 'f8'
+    encoded[name] = binary_traces.encode_array(values, dtype)
+  return encoded
+
+
+def map_activity(df, sport, api_key, unit_of_measure, track_metrics=None,
+                 binary=False):
   """Maps an activity based on the GPS data in the given DataFrame.
 
   Args:
@@ -15,6 +119,10 @@ def map_activity(df, sport, api_key, unit_of_measure):
     sport: The sport of the activity, used in the title
     api_key: Google API key used for mapping.
     unit_of_measure: IMPERIAL or METRIC
+    track_metrics: optional cross-track error summary table shown above the
+                   map, the per-fix errors are read from track_error_meters
+    binary: embed the locations as base64 typed arrays decoded by the page
+            instead of a JSON list of objects
 
   Returns:
     The HTML content of the map.
@@ -28,7 +136,7 @@ def map_activity(df, sport, api_key, unit_of_measure):
   ]
 
   if 'position' not in df.columns:
-    print('No gps data found for any device')
+    utils.progress('No gps data found for any device')
     return ''
 
   # Set the zoom level of the map
@@ -36,11 +144,15 @@ def map_activity(df, sport, api_key, unit_of_measure):
 
   distance_label = 'Distance (km)'
   speed_label = 'Speed (km/h)'
+  error_label = 'Track Error (m)'
   ratio = 1.0
+  small_ratio = 1.0
   if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
     ratio = utils.KM_TO_MILE_RATIO
+    small_ratio = utils.M_TO_FT_RATIO
     distance_label = 'Distance (mi)'
     speed_label = 'Speed (mph)'
+    error_label = 'Track Error (ft)'
 
 
   # Create the map URL
@@ -54,7 +166,7 @@ def map_activity(df, sport, api_key, unit_of_measure):
   center_long = round(
       float(df['position'].apply(lambda x: x['long']).mean()), 5)
 
-  print(f'lat: {center_lat}, {center_long}' + f' zoom: {zoom_level}')
+  utils.progress(f'lat: {center_lat}, {center_long}' + f' zoom: {zoom_level}')
 
   # Create the HTML content of the map
   html_content = '''
@@ -74,6 +186,10 @@ def map_activity(df, sport, api_key, unit_of_measure):
                       margin: 0;
                       padding: 0;
                   }}
+                  .track-metrics td, .track-metrics th {{
+                      padding: 2px 12px;
+                      text-align: right;
+                  }}
               </style>
               <script src="{map_url}"></script>
               <script>
@@ -94,8 +210,72 @@ def map_activity(df, sport, api_key, unit_of_measure):
                         }};
                     }}
 
+                    // Rebuilds the marker objects from base64 typed arrays
+                    function decodeLocations(encoded) {{
+                        var types = {{u2: Uint16Array, f4: Float32Array, f8: Float64Array}};
+                        var columns = {{}};
+                        Object.keys(encoded).forEach(function(name) {{
+                            var column = encoded[name];
+                            if (!column.bdata) {{
+                                return;
+                            }}
+                            var text = atob(column.bdata);
+                            var bytes = new Uint8Array(text.length);
+                            for (var i = 0; i < text.length; i++) {{
+                                bytes[i] = text.charCodeAt(i);
+                            }}
+                            columns[name] = new types[column.dtype](bytes.buffer);
+                        }});
+                        function pad(value) {{
+                            return (value < 10 ? '0' : '') + value;
+                        }}
+                        function value(name, i) {{
+                            return isNaN(columns[name][i]) ? null : columns[name][i];
+                        }}
+                        function fixed(number, digits) {{
+                            return isNaN(number) ? 'nan' : number.toFixed(digits);
+                        }}
+                        var result = [];
+                        for (var i = 0; i < columns.time.length; i++) {{
+                            // Times are wall clock ms, encoded as if they were UTC
+                            var time = new Date(columns.time[i]);
+                            var hours = time.getUTCHours();
+                            result.push({{
+                                device: encoded.devices[columns.device[i]],
+                                time: time.getUTCFullYear() + '-' + pad(time.getUTCMonth() + 1) + '-' +
+                                      pad(time.getUTCDate()) + ' ' + pad(hours) + ':' +
+                                      pad(time.getUTCMinutes()) + ':' + pad(time.getUTCSeconds()) +
+                                      (hours < 12 ? ' AM' : ' PM'),
+                                heart_rate: columns.heart_rate[i],
+                                alt_meters: value('alt_meters', i),
+                                position: {{lat: columns.lat[i], lng: columns.long[i]}},
+                                distance: fixed(columns.distance[i], 4),
+                                distance_label: '{distance_label}',
+                                speed: fixed(columns.speed[i], 2),
+                                speed_label: '{speed_label}',
+                                track_error: value('track_error', i)
+                            }});
+                        }}
+                        return result;
+                    }}
+
                     var deviceColors = {device_colors_json};
                     var locations = {locations_json};
+                    var maxTrackError = {max_track_error};
+                    var markers = [];
+
+                    // Green at zero error through to red at maxTrackError
+                    function errorColor(error) {{
+                        var hue = 120 * (1 - Math.min(error / maxTrackError, 1));
+                        return 'hsl(' + hue + ', 100%, 50%)';
+                    }}
+
+                    function markerColor(location, showError) {{
+                        if (showError && location.track_error !== null) {{
+                            return errorColor(location.track_error);
+                        }}
+                        return deviceColors[location.device];
+                    }}
 
                     for (var i = 0; i < locations.length; i++) {{
                         var marker = new google.maps.Marker({{
@@ -103,14 +283,29 @@ def map_activity(df, sport, api_key, unit_of_measure):
                             map: map,
                             icon: createMarkerIcon(deviceColors[locations[i].device])
                         }});
+                        markers.push(marker);
 
                         // Attach click event to marker
                         attachClickEvent(marker, locations[i]);
                     }}
 
+                    var errorToggle = document.getElementById('track-error-toggle');
+                    if (errorToggle) {{
+                        errorToggle.addEventListener('change', function() {{
+                            for (var i = 0; i < markers.length; i++) {{
+                                markers[i].setIcon(createMarkerIcon(
+                                    markerColor(locations[i], errorToggle.checked)));
+                            }}
+                        }});
+                    }}
+
                     function attachClickEvent(marker, location) {{
+                        var content = 'Device: ' + location.device + '<br>Time: ' + location.time + '<br>Heart Rate: ' + location.heart_rate  + '<br>' + location.distance_label + ' ' + location.distance + '<br>' + location.speed_label + ' ' + location.speed;
+                        if (location.track_error !== null) {{
+                            content += '<br>{error_label}: ' + location.track_error;
+                        }}
                         var infowindow = new google.maps.InfoWindow({{
-                            content: 'Device: ' + location.device + '<br>Time: ' + location.time + '<br>Heart Rate: ' + location.heart_rate  + '<br>' + location.distance_label + ' ' + location.distance + '<br>' + location.speed_label + ' ' + location.speed
+                            content: content
                         }});
 
                         marker.addListener('click', function() {{
@@ -121,6 +316,7 @@ def map_activity(df, sport, api_key, unit_of_measure):
             </script>
           </head>
           <body onload="initMap()">
+              {track_metrics_html}
               <div id="map"></div>
           </body>
       </html>
@@ -128,45 +324,48 @@ def map_activity(df, sport, api_key, unit_of_measure):
 
   colors = ['red', 'blue', 'green', 'purple', 'brown']
 
-  # Generate the list of GPS locations and assign colors to device
+  # Generate the GPS locations of each device and assign colors to device
   device_colors = {}
-  locations = []
+  device_columns = []
   color_index = 0
   for device, data in df.groupby('device'):
-    print(f'Mapping: {device}')
+    utils.progress(f'Mapping: {device}')
     if 'position' not in data.columns or data['position'].isnull().all():
-      print('No gps data for device: ', device)
+      utils.progress(f'No gps data for device:  {device}')
       continue
 
     if device not in device_colors:
       device_colors[device] = colors[color_index % len(colors)]
       color_index += 1
 
-    for _, row in data.iterrows():
-      if pd.isna(row['position']['lat']) or pd.isna(row['position']['long']):
-        continue
-
-      location = {}
-      location['device'] = device
-      location['time'] = row['time'].strftime('%Y-%m-%d %H:%M:%S %p')
-      location['heart_rate'] = row['heart_rate']
-      position = {
-          'lat': row['position']['lat'],
-          'lng': row['position']['long']
-      }
-      location['alt_meters'] = row['alt_meters']
-      distance = None
-      if row['calc_distance_meters'] is not None:
-        distance = round(float(row['calc_distance_meters']) / 1000 * ratio, 2)
-      location['position'] = position
-      location['distance'] = format(distance * ratio, '.4f')
-      location['distance_label'] = distance_label
-      location['speed'] = format(row['speed_kmh'] * ratio, '.2f')
-      location['speed_label'] = speed_label
-      locations.append(location)
+    columns = _location_columns(data, ratio, small_ratio)
+    columns['device'] = device
+    device_columns.append(columns)
+
+  if binary:
+    locations_json = (
+        f'decodeLocations({json.dumps(_encode_locations(device_columns))})')
+  else:
+    locations = []
+    for columns in device_columns:
+      locations.extend(_location_dicts(columns, distance_label, speed_label))
+    locations_json = json.dumps(locations)
 
   device_colors_json = json.dumps(device_colors)
-  locations_json = json.dumps(locations)
+  # Scale the error colors to the worst device's 95th percentile
+  max_track_error = 1.0
+  track_metrics_html = ''
+  if track_metrics is not None and not track_metrics.empty:
+    max_track_error = max(float(track_metrics['P95'].max()), 1.0)
+    track_metrics_html = (
+        '<label><input type="checkbox" id="track-error-toggle">'
+        f' Color by {error_label.lower()}</label>'
+        + track_metrics.rename(columns={
+            'Mean': f'Mean {error_label}',
+            'P95': f'P95 {error_label}',
+            'Max': f'Max {error_label}',
+        }).to_html(index=False, classes='track-metrics', border=0)
+    )
 
   # Insert the device colors and locations into the HTML content
   html_content = html_content.format(
@@ -176,7 +375,12 @@ def map_activity(df, sport, api_key, unit_of_measure):
       center_long=center_long,
       map_url=map_url,
       device_colors_json=device_colors_json,
-      locations_json=locations_json
+      locations_json=locations_json,
+      max_track_error=max_track_error,
+      error_label=error_label,
+      distance_label=distance_label,
+      speed_label=speed_label,
+      track_metrics_html=track_metrics_html
   )
 
   return html_content
@@ -0,0 +1,238 @@
+"""Project a session's memory use and record the peak of each stage."""
+
+import contextlib
+import os
+import sys
+import threading
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from utils import utils
+
+try:
+  import resource
+except ImportError:  # Windows
+  resource = None
+
+MEMORY_UNITS = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+# Peak memory per byte of TCX/GPX data read, over the memory in use before
+# the session is loaded, measured on 1 Hz sessions.  The report figures and
+# map hold several serialized copies of every sample, and each render worker
+# a copy of the session and of its section.
+REPORT_BYTES_PER_FILE_BYTE = 8.5
+METRICS_BYTES_PER_FILE_BYTE = 5.0
+WORKER_BYTES_PER_FILE_BYTE = 6.0
+
+# Width of the time windows merged at once when over the memory limit
+CHUNK_WINDOW = pd.Timedelta(minutes=30)
+
+DEFAULT_SAMPLE_SECONDS = 0.02
+
+
+def memory_size(text):
+  """Parses a memory size such as 512M, 2G or a number of bytes."""
+  text = text.strip().upper().removesuffix('B')
+  scale = MEMORY_UNITS.get(text[-1:], 1)
+  if text[-1:] in MEMORY_UNITS:
+    text = text[:-1]
+  size = int(float(text) * scale)
+  if size <= 0:
+    raise ValueError(f'memory size must be positive: {text}')
+  return size
+
+
+def format_size(size):
+  """Formats bytes as MB, eg. for progress messages."""
+  return f'{size / MEMORY_UNITS["M"]:.1f} MB'
+
+
+def current_rss():
+  """Returns the resident set size of this process in bytes, None if unknown."""
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (OSError, ValueError, IndexError):
+    return None
+
+
+def children_peak_rss():
+  """Returns the largest peak RSS of any finished child process, eg. workers."""
+  if resource is None:
+    return 0
+  peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  # Linux reports kilobytes, macOS bytes
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def project_peak(file_paths, metrics_only=False, workers=0):
+  """Projects the peak memory of processing a session from its file sizes.
+
+  Args:
+    file_paths: the data files of the session
+    metrics_only: True if no figures, map or HTML are built
+    workers: number of worker processes rendering the report sections at
+             once, 0 when they are rendered in this process
+
+  Returns:
+    The projected peak in bytes, including the memory already in use.
+  """
+  ratio = (METRICS_BYTES_PER_FILE_BYTE if metrics_only
+           else REPORT_BYTES_PER_FILE_BYTE)
+  file_bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+  in_use = current_rss() or 0
+  # Workers start from about the memory this process used before loading
+  worker = in_use + file_bytes * WORKER_BYTES_PER_FILE_BYTE
+  return in_use + int(file_bytes * ratio + workers * worker)
+
+
+class StageMemory:
+  """Records the peak memory of each pipeline stage.
+
+  The resident set size is sampled from a background thread where the OS
+  reports it.  A stage running worker processes reports the larger of this
+  process and the largest worker that finished during it, not their sum.
+  Elsewhere, or for a stage starting when the OS fails to report it, only
+  Python allocations are traced, with tracemalloc.
+
+  Attributes:
+    limit: optional memory budget in bytes the peaks are checked against
+    peaks: dict of stage name to its peak in bytes, in stage order
+  """
+
+  def __init__(self, limit=None, interval=DEFAULT_SAMPLE_SECONDS):
+    self.limit = limit
+    self.interval = interval
+    self.peaks = {}
+    self.sample_rss = current_rss() is not None
+    # Stages traced with tracemalloc although the RSS is sampled, when the
+    # OS stopped reporting it
+    self.traced = set()
+
+  @contextlib.contextmanager
+  def _trace(self, name):
+    """Records the peak of the Python allocations while the block runs."""
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+      tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+      yield
+    finally:
+      self.peaks[name] = tracemalloc.get_traced_memory()[1]
+      if not tracing:
+        tracemalloc.stop()
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    """Records the peak memory while the block runs as the stage name."""
+    rss = current_rss() if self.sample_rss else None
+    if rss is None:
+      if self.sample_rss:
+        self.traced.add(name)
+      with self._trace(name):
+        yield
+      return
+
+    peak = [rss]
+    children_before = children_peak_rss()
+    stop = threading.Event()
+
+    def update():
+      # Samples the OS fails to report are skipped
+      rss = current_rss()
+      if rss is not None:
+        peak[0] = max(peak[0], rss)
+
+    def sample():
+      while not stop.wait(self.interval):
+        update()
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+      yield
+    finally:
+      stop.set()
+      sampler.join()
+      update()
+      children = children_peak_rss()
+      if children > children_before:
+        peak[0] = max(peak[0], children)
+      self.peaks[name] = peak[0]
+
+  def report(self):
+    """Reports the peak of each stage, and the stages over the limit."""
+    kind = 'RSS' if self.sample_rss else 'Python allocations'
+    utils.progress(f'Peak memory ({kind}): ' + ', '.join(
+        f'{name} {format_size(peak)}'
+        + (' (Python allocations)' if name in self.traced else '')
+        for name, peak in self.peaks.items()))
+    if self.limit:
+      over = [name for name, peak in self.peaks.items() if peak > self.limit]
+      if over:
+        utils.progress(f'Over the {format_size(self.limit)} memory limit: '
+                       + ', '.join(over))
+
+
+def matched_parts(data, reference, column, window=None):
+  """Merges a device with a reference at equal times, a window at a time.
+
+  Only the time and compared columns are merged.  Each time matches a
+  single reference sample, the first when several devices match the
+  reference, so the merge is one to one and linear in the samples.  With a
+  window, one time window of each device is merged at a time, so the merged
+  rows never hold more than a window of samples.
+
+  Args:
+    data: DataFrame of the device with 'time' and column
+    reference: DataFrame of the GT/ref device with 'time' and column
+    column: the compared column
+    window: optional pd.Timedelta of the time windows
+
+  Yields:
+    DataFrames with 'time', column and the reference's f'{column}_ref'.
+  """
+  data = data[['time', column]].dropna()
+  reference = reference[['time', column]].dropna()
+  reference = reference.drop_duplicates('time')
+  if window is None or data.empty or reference.empty:
+    parts = [(data, reference)]
+  else:
+    t0 = min(data['time'].min(), reference['time'].min())
+    reference_parts = dict(
+        tuple(reference.groupby((reference['time'] - t0) // window)))
+    parts = [
+        (data_part, reference_parts[key])
+        for key, data_part in data.groupby((data['time'] - t0) // window)
+        if key in reference_parts
+    ]
+
+  for data_part, reference_part in parts:
+    yield data_part.merge(reference_part, on='time', how='inner',
+                          suffixes=('', '_ref'), validate='one_to_one')
+
+
+def matched_abs_error(data, reference, column, window=None):
+  """Sums the absolute errors of a device vs a reference at equal times.
+
+  Args:
+    data: DataFrame of the device with 'time' and column
+    reference: DataFrame of the GT/ref device with 'time' and column
+    column: the compared column
+    window: optional pd.Timedelta, see matched_parts
+
+  Returns:
+    A tuple of the sum of the absolute errors and the number of matched
+    samples.
+  """
+  total = 0.0
+  count = 0
+  for merged in matched_parts(data, reference, column, window):
+    errors = np.abs(merged[f'{column}_ref'].to_numpy(dtype=float)
+                    - merged[column].to_numpy(dtype=float))
+    total += np.sum(errors)
+    count += len(merged)
+  return total, count
@@ -0,0 +1,146 @@
+"""Compute the metric tables of a session and export them as JSON or CSV."""
+
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+from utils import elevation, hr_zones, laps, plot_channel, plot_distance, plot_heart_rate, plot_speed, track_accuracy, utils
+
+METRICS_FORMATS = ('json', 'csv')
+
+
+def compute_metrics(combined_df, ground_truth_device, ref_device,
+                    unit_of_measure, offsets=None, power_gt=None,
+                    cadence_gt=None, window=None, hr_zone_bounds=None):
+  """Computes every metric table shown in the report.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    ground_truth_device: the string used to determine GT device
+    ref_device: the string used to determine the ref device
+    unit_of_measure: IMPERIAL or METRIC
+    offsets: clock offsets in seconds removed from each device, if aligned
+    power_gt: the string used to determine the power GT device, see
+              plot_channel.resolve_ground_truth (default: ground_truth_device)
+    cadence_gt: the string used to determine the cadence GT device
+                (default: ground_truth_device)
+    window: optional pd.Timedelta, match the devices one time window at a
+            time to bound the memory of the merges
+    hr_zone_bounds: the lower bound in BPM of each heart rate zone
+                    (default: hr_zones.zone_bounds())
+
+  Returns:
+    A dict of table name to metrics DataFrame.
+  """
+  ratio = 1.0
+  small_ratio = 1.0
+  if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
+    ratio = utils.KM_TO_MILE_RATIO
+    small_ratio = utils.M_TO_FT_RATIO
+
+  tables = {
+      'heart_rate': plot_heart_rate.get_heart_rate_metrics(
+          combined_df, ground_truth_device, offsets, window),
+  }
+  if plot_channel.has_channel(combined_df, 'heart_rate'):
+    tables['hr_zones'] = hr_zones.get_zone_metrics(
+        combined_df, ground_truth_device,
+        hr_zone_bounds or hr_zones.zone_bounds(), window)
+  channel_gts = {'power': power_gt, 'cadence': cadence_gt}
+  for table, column in plot_channel.CHANNEL_SECTIONS.items():
+    if plot_channel.has_channel(combined_df, column):
+      channel_gt = plot_channel.resolve_ground_truth(
+          combined_df, column, channel_gts[table] or ground_truth_device)
+      tables[table] = plot_channel.get_channel_metrics(
+          combined_df, channel_gt, column, offsets, window)
+  if 'calc_distance_meters' in combined_df.columns:
+    tables['distance'] = plot_distance.get_distance_metrics(
+        combined_df, ref_device, ratio, small_ratio, offsets, window)
+    tables['speed'] = plot_speed.get_speed_metrics(combined_df, ratio)
+  if elevation.has_elevation(combined_df):
+    tables['elevation'] = elevation.get_elevation_metrics(
+        combined_df, ref_device, small_ratio, window)
+  if laps.has_laps(combined_df):
+    tables['laps'] = laps.get_lap_metrics(combined_df, unit_of_measure)
+  if 'track_error_meters' in combined_df.columns:
+    tables['track'] = track_accuracy.get_track_metrics(
+        combined_df, ref_device, small_ratio)
+  return tables
+
+
+def _to_value(value):
+  """Converts a display table cell into a plain JSON/CSV value."""
+  if isinstance(value, str):
+    value = value.replace('\t', ' ')
+    if value in ('---', '-'):
+      return None
+    if value.endswith('%'):
+      try:
+        return float(value[:-1])
+      except ValueError:
+        return value
+    return value
+  if isinstance(value, np.generic):
+    value = value.item()
+  if isinstance(value, float) and np.isnan(value):
+    return None
+  return value
+
+
+def metrics_records(tables):
+  """Converts the metric tables into lists of plain dicts."""
+  return {
+      name: [
+          {column: _to_value(value) for column, value in row.items()}
+          for row in table.to_dict(orient='records')
+      ]
+      for name, table in tables.items()
+  }
+
+
+def format_metrics(tables, metrics_format='json', session=None):
+  """Serializes the metric tables as JSON or CSV.
+
+  Args:
+    tables: dict of table name to metrics DataFrame
+    metrics_format: json or csv
+    session: optional dict describing the session, eg. sport and start time
+
+  Returns:
+    The serialized metrics string.
+  """
+  session = session or {}
+  records = metrics_records(tables)
+  if metrics_format == 'csv':
+    rows = []
+    for name, table_records in records.items():
+      for record in table_records:
+        rows.append({**session, 'table': name, **record})
+    content = pd.DataFrame(rows).to_csv(index=False)
+  else:
+    content = json.dumps({**session, **records}, indent=2) + '\n'
+  return content
+
+
+def write_metrics(tables, metrics_format='json', output_file=None,
+                  session=None):
+  """Writes the metric tables as JSON or CSV.
+
+  Args:
+    tables: dict of table name to metrics DataFrame
+    metrics_format: json or csv
+    output_file: file to write to, stdout when not set
+    session: optional dict describing the session, eg. sport and start time
+
+  Returns:
+    The serialized metrics string.
+  """
+  content = format_metrics(tables, metrics_format, session)
+  if output_file:
+    with open(output_file, 'w') as f:
+      f.write(content)
+  else:
+    sys.stdout.write(content)
+  return content
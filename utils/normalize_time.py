@@ -0,0 +1,69 @@
+"""Sort a device's samples by time and resolve repeated timestamps."""
+import numpy as np
+import pandas as pd
+
+# Keep the first or the last sample of a repeated timestamp, or average the
+# numeric columns of its samples
+DUPLICATE_POLICIES = ('first', 'last', 'mean')
+DEFAULT_DUPLICATE_POLICY = 'first'
+
+# Numeric columns that label the samples rather than measure them
+LABEL_COLUMNS = ('activity', 'lap')
+
+
+def _mean_duplicates(df):
+  """Averages the numeric columns of the samples sharing a timestamp.
+
+  Other columns keep the first sample's value, and positions are rebuilt
+  from the averaged coordinates.
+  """
+  df = df.copy()
+  if 'position' in df.columns and 'latitude' not in df.columns:
+    df['latitude'] = pd.to_numeric(
+        df['position'].map(lambda pos: pos.get('lat')), errors='coerce')
+    df['longitude'] = pd.to_numeric(
+        df['position'].map(lambda pos: pos.get('long')), errors='coerce')
+  numeric = [
+      column for column in df.columns
+      if column != 'time' and column not in LABEL_COLUMNS
+      and pd.api.types.is_numeric_dtype(df[column])
+      and not pd.api.types.is_bool_dtype(df[column])
+  ]
+  result = df.drop_duplicates('time', keep='first').set_index('time')
+  result[numeric] = df.groupby('time')[numeric].mean()
+  result = result.reset_index()[df.columns]
+
+  if 'position' in result.columns:
+    has_position = result['latitude'].notnull() & result['longitude'].notnull()
+    positions = result['position'].tolist()
+    for row in np.flatnonzero(has_position.to_numpy()):
+      positions[row] = {'lat': result['latitude'].iloc[row],
+                        'long': result['longitude'].iloc[row]}
+    result['position'] = positions
+  return result
+
+
+def resolve_duplicates(df, policy=DEFAULT_DUPLICATE_POLICY):
+  """Sorts a single device's samples by time, one sample per timestamp.
+
+  Args:
+    df: the DataFrame of a single device with a 'time' column
+    policy: one of DUPLICATE_POLICIES
+
+  Returns:
+    A tuple of the DataFrame, sorted with unique times and a fresh index, and
+    True when rows were reordered or merged.
+  """
+  if policy not in DUPLICATE_POLICIES:
+    raise ValueError(f'Unknown duplicate policy: {policy}')
+  changed = not df['time'].is_monotonic_increasing
+  if changed:
+    df = df.sort_values('time', kind='stable')
+  if df['time'].is_unique:
+    return df.reset_index(drop=True), changed
+
+  if policy == 'mean':
+    df = _mean_duplicates(df)
+  else:
+    df = df.drop_duplicates('time', keep=policy)
+  return df.reset_index(drop=True), True
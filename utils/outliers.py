@@ -0,0 +1,71 @@
+"""Flag outliers with a rolling median / MAD over a time window."""
+import numpy as np
+import pandas as pd
+
+DEFAULT_WINDOW_SECONDS = 30
+DEFAULT_THRESHOLD = 3.5
+
+# Scales the MAD to be consistent with the standard deviation of normal data
+MAD_TO_STD = 1.4826
+
+# Column flagged, source column and smallest deviation scale for each check.
+# The minimum scale stops flat stretches (eg. stopped, steady HR) with a MAD
+# of zero from flagging every small change.
+OUTLIER_CHECKS = {
+    'speed_kmh_outlier': ('speed_kmh', 1.0),
+    'heart_rate_outlier': ('heart_rate', 3.0),
+    'gps_jump_outlier': ('step_meters', 2.0),
+}
+
+
+def rolling_outliers(times, values, window_seconds, threshold, min_scale):
+  """Flags values that deviate from their rolling median.
+
+  Args:
+    times: the sorted timestamps of the samples
+    values: the sample values, missing values are never flagged
+    window_seconds: width of the centered rolling window in seconds
+    threshold: number of scaled MADs from the median to be an outlier
+    min_scale: smallest deviation scale in the units of the values
+
+  Returns:
+    A boolean numpy array marking the outliers.
+  """
+  series = pd.Series(np.asarray(values, dtype=float),
+                     index=pd.DatetimeIndex(times))
+  window = f'{window_seconds}s'
+  median = series.rolling(window, center=True, min_periods=1).median()
+  deviation = (series - median).abs()
+  mad = deviation.rolling(window, center=True, min_periods=1).median()
+  scale = (mad * MAD_TO_STD).clip(lower=min_scale)
+  return (deviation / scale > threshold).to_numpy()
+
+
+def detect_outliers(combined_df, window_seconds=DEFAULT_WINDOW_SECONDS,
+                    threshold=DEFAULT_THRESHOLD):
+  """Flags speed, heart rate and GPS jump outliers for every device.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    window_seconds: width of the centered rolling window in seconds
+    threshold: number of scaled MADs from the median to be an outlier
+
+  Returns:
+    A copy of the DataFrame sorted by device and time with a boolean column
+    for each of the OUTLIER_CHECKS.
+  """
+  df = combined_df.sort_values(['device', 'time'], kind='stable')
+  df = df.reset_index(drop=True)
+  if 'calc_distance_meters' in df.columns:
+    df['step_meters'] = df.groupby('device')['calc_distance_meters'].diff()
+
+  for outlier_column, (column, min_scale) in OUTLIER_CHECKS.items():
+    flags = np.zeros(len(df), dtype=bool)
+    if column in df.columns:
+      for positions in df.groupby('device').indices.values():
+        data = df.iloc[positions]
+        flags[positions] = rolling_outliers(
+            data['time'], data[column], window_seconds, threshold, min_scale)
+    df[outlier_column] = flags
+
+  return df.drop(columns=['step_meters'], errors='ignore')
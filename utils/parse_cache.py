@@ -0,0 +1,53 @@
+"""Cache parsed TCX/GPX files on disk keyed by their content hash."""
+
+import hashlib
+import os
+import pickle
+
+from utils import parser
+
+# Bump when the parsers change the DataFrame they produce
+CACHE_VERSION = 4
+
+
+def file_hash(file_path):
+  """Returns the sha1 hex digest of a file's content."""
+  digest = hashlib.sha1()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def parse_file_cached(file_path, cache_dir=None):
+  """Parses a TCX or GPX file, reusing a cached parse of the same content.
+
+  Args:
+    file_path: The file path of the TCX or GPX file
+    cache_dir: folder holding the cached parses, parsing is not cached when
+               not set
+
+  Returns:
+    the same (DataFrame, sport, start time) tuple as parser.parse_file
+  """
+  if not cache_dir:
+    return parser.parse_file(file_path)
+
+  extension = os.path.splitext(file_path.lower())[1]
+  cache_path = os.path.join(
+      cache_dir, f'{file_hash(file_path)}{extension}.v{CACHE_VERSION}.pkl')
+  if os.path.exists(cache_path):
+    try:
+      with open(cache_path, 'rb') as f:
+        return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+      pass
+
+  result = parser.parse_file(file_path)
+  os.makedirs(cache_dir, exist_ok=True)
+  # Write then rename so concurrent workers never read a partial file
+  temp_path = f'{cache_path}.{os.getpid()}.tmp'
+  with open(temp_path, 'wb') as f:
+    pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(temp_path, cache_path)
+  return result
@@ -6,19 +6,22 @@ from utils import parser_gpx
 from utils import parser_tcx
 
 
-def parse_file(file_path):
+def parse_file(file_path, file_type=None):
   """Parse a TCX or GPX file and return a Pandas DataFrame.
 
   Args:
-    file_path: The file path of the TCS or GPX file
+    file_path: The file path of the TCS or GPX file, or a binary file object
+               reading it
+    file_type: .tcx or .gpx, taken from the file path when not set
 
   Returns:
     a Pandas DataFrame
   """
 
-  file_type = os.path.splitext(file_path.lower())[1]
+  if file_type is None:
+    file_type = os.path.splitext(file_path.lower())[1]
   return (
       parser_tcx.parse_tcx_file(file_path)
-      if file_type == '.tcx'
+      if file_type.lower() == '.tcx'
       else parser_gpx.parse_gpx_file(file_path)
   )
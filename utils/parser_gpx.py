@@ -6,12 +6,88 @@ import pandas as pd
 METRIC_NOT_AVAILABLE = None
 TIME_NOT_AVAILABLE = None
 
+GPX_NS = '{http://www.topografix.com/GPX/1/1}'
+TRK_TAG = f'{GPX_NS}trk'
+TRKSEG_TAG = f'{GPX_NS}trkseg'
+TRKPT_TAG = f'{GPX_NS}trkpt'
+TYPE_TAG = f'{GPX_NS}type'
+TIME_TAG = f'{GPX_NS}time'
+ELE_TAG = f'{GPX_NS}ele'
+EXTENSIONS_TAG = f'{GPX_NS}extensions'
+
+
+def to_int(text):
+  """Converts element text to an int, METRIC_NOT_AVAILABLE if invalid."""
+  try:
+    return int(text)
+  except (TypeError, ValueError):
+    return METRIC_NOT_AVAILABLE
+
+
+def to_float(text):
+  """Converts element text to a float, METRIC_NOT_AVAILABLE if invalid."""
+  try:
+    return float(text)
+  except (TypeError, ValueError):
+    return METRIC_NOT_AVAILABLE
+
+
+TPX_V1_NS = '{http://www.garmin.com/xmlschemas/TrackPointExtension/v1}'
+TPX_V2_NS = '{http://www.garmin.com/xmlschemas/TrackPointExtension/v2}'
+
+# Extension tag to the column and converter of its value
+EXTENSION_CHANNELS = {
+    f'{TPX_V1_NS}hr': ('heart_rate', to_int),
+    f'{TPX_V1_NS}cad': ('cadence', to_float),
+    f'{TPX_V1_NS}atemp': ('temperature_c', to_float),
+    f'{TPX_V2_NS}hr': ('heart_rate', to_int),
+    f'{TPX_V2_NS}cad': ('cadence', to_float),
+    f'{TPX_V2_NS}atemp': ('temperature_c', to_float),
+    f'{GPX_NS}power': ('power_watts', to_float),
+    'power': ('power_watts', to_float),
+}
+
+# The columns of a track point, before any of its elements are read
+EMPTY_POINT = {
+    'time': TIME_NOT_AVAILABLE,
+    'heart_rate': METRIC_NOT_AVAILABLE,
+    'position': None,
+    'alt_meters': METRIC_NOT_AVAILABLE,
+    'distance_meters': METRIC_NOT_AVAILABLE,
+    'speed': METRIC_NOT_AVAILABLE,
+    'power_watts': METRIC_NOT_AVAILABLE,
+    'cadence': METRIC_NOT_AVAILABLE,
+    'temperature_c': METRIC_NOT_AVAILABLE,
+    'activity': 0,
+    'lap': 0,
+    'activity_sport': '',
+}
+
+# GPX track types and the matching TCX sport names
+GPX_SPORTS = {
+    'cycling': 'Biking',
+    'biking': 'Biking',
+    'running': 'Running',
+}
+
+
+def to_sport(track_type):
+  """Converts a GPX track type into a TCX style sport name."""
+  if not track_type or not track_type.strip():
+    return ''
+  track_type = track_type.strip()
+  return GPX_SPORTS.get(track_type.lower(), track_type.capitalize())
+
 
 def parse_gpx_file(file_path):
   """Parse GPX file and return a Pandas DataFrame.
 
+  Each track is recorded as an activity and each of its segments as a lap,
+  with the sport of the track's type.
+
   Args:
-    file_path: The file path of the GPX file
+    file_path: The file path of the GPX file, or a binary file object
+               reading it
 
   Returns:
     a Pandas DataFrame
@@ -26,7 +102,12 @@ def parse_gpx_file(file_path):
       'gpxtpx': 'http://www.garmin.com/xmlschemas/TrackPointExtension/v1',
   }
 
-  start_time_element = root.find('.//gpx:metadate', ns)
+  # Prefer the metadata time, then the first track point time
+  start_time_element = root.find('gpx:metadata/gpx:time', ns)
+  if start_time_element is None:
+    start_time_element = root.find('.//gpx:metadate', ns)
+  if start_time_element is None:
+    start_time_element = root.find('.//gpx:trkpt/gpx:time', ns)
   start_time_str = (
       start_time_element.text if start_time_element is not None
       else TIME_NOT_AVAILABLE
@@ -36,33 +117,42 @@ def parse_gpx_file(file_path):
   except ValueError:
     start_time = dt.datetime.strptime(start_time_str, '%Y-%m-%dT%H:%M:%S.%fZ')
 
+  track_type_element = root.find('gpx:trk/gpx:type', ns)
+  sport = to_sport(
+      track_type_element.text if track_type_element is not None else None)
+
   # Extract the data into a list of dictionaries
   data = []
 
-  for trkpt in root.findall('.//{http://www.topografix.com/GPX/1/1}trkpt'):
-    time_element = trkpt.find(
-        '{http://www.topografix.com/GPX/1/1}time')
-    time_str = (
-        time_element.text if time_element is not None else TIME_NOT_AVAILABLE
-    )
-    time = pd.Timestamp(time_str)
-
-    hr_element = trkpt.find(
-        './/{http://www.garmin.com/xmlschemas/TrackPointExtension/v1}hr')
-    hr = (
-        int(hr_element.text) if hr_element is not None else METRIC_NOT_AVAILABLE
-    )
-
-    position = {'lat': float(trkpt.get('lat')), 'long': float(trkpt.get('lon'))}
-    data.append({
-        'time': time,
-        'heart_rate': hr,
-        'position': position,
-        'alt_meters': METRIC_NOT_AVAILABLE,
-        'distance_meters': METRIC_NOT_AVAILABLE,
-        'speed': METRIC_NOT_AVAILABLE,
-    })
+  for activity_index, trk in enumerate(list(root.iter(TRK_TAG)) or [root]):
+    track_type = trk.find(TYPE_TAG)
+    activity_sport = to_sport(
+        track_type.text if track_type is not None else None)
+    segments = list(trk.iter(TRKSEG_TAG)) or [trk]
+    for lap_index, segment in enumerate(segments):
+      lap_point = dict(EMPTY_POINT, activity=activity_index, lap=lap_index,
+                       activity_sport=activity_sport)
+      for trkpt in segment.iter(TRKPT_TAG):
+        point = dict(lap_point)
+        # Visit each element of the point once, dispatching on its tag
+        for element in trkpt:
+          if element.tag == TIME_TAG:
+            point['time'] = element.text
+          elif element.tag == ELE_TAG:
+            point['alt_meters'] = to_float(element.text)
+          elif element.tag == EXTENSIONS_TAG:
+            for extension in element.iter():
+              channel = EXTENSION_CHANNELS.get(extension.tag)
+              if channel is not None:
+                point[channel[0]] = channel[1](extension.text)
+
+        point['time'] = pd.Timestamp(point['time'])
+        point['position'] = {
+            'lat': float(trkpt.get('lat')), 'long': float(trkpt.get('lon'))}
+        data.append(point)
 
   # Convert the list of dictionaries into a pandas DataFrame
   df = pd.DataFrame(data)
-  return df, '', start_time
+  if 'activity_sport' in df.columns:
+    df['activity_sport'] = df['activity_sport'].astype('category')
+  return df, sport, start_time
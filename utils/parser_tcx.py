@@ -6,12 +6,73 @@ import pandas as pd
 METRIC_NOT_AVAILABLE = None
 TIME_NOT_AVAILABLE = None
 
+TCX_NS = '{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}'
+TPX_NS = '{http://www.garmin.com/xmlschemas/ActivityExtension/v2}'
+
+ACTIVITY_TAG = f'{TCX_NS}Activity'
+LAP_TAG = f'{TCX_NS}Lap'
+TRACKPOINT_TAG = f'{TCX_NS}Trackpoint'
+TIME_TAG = f'{TCX_NS}Time'
+POSITION_TAG = f'{TCX_NS}Position'
+LATITUDE_TAG = f'{TCX_NS}LatitudeDegrees'
+LONGITUDE_TAG = f'{TCX_NS}LongitudeDegrees'
+EXTENSIONS_TAG = f'{TCX_NS}Extensions'
+
+
+def to_float(text):
+  """Converts element text to a float, METRIC_NOT_AVAILABLE if invalid."""
+  try:
+    return float(text)
+  except (TypeError, ValueError):
+    return METRIC_NOT_AVAILABLE
+
+
+def to_km_per_hr(text):
+  """Converts a speed in m/s to km/h."""
+  speed = to_float(text)
+  return None if speed is None else round(speed * 3.6, 2)
+
+
+# Trackpoint child tag to the column and converter of its value
+POINT_CHANNELS = {
+    f'{TCX_NS}HeartRateBpm': ('heart_rate', to_float),
+    f'{TCX_NS}AltitudeMeters': ('alt_meters', to_float),
+    f'{TCX_NS}DistanceMeters': ('distance_meters', to_float),
+    f'{TCX_NS}Cadence': ('cadence', to_float),
+}
+
+# Activity extension tag to the column and converter of its value
+EXTENSION_CHANNELS = {
+    f'{TPX_NS}Speed': ('speed_km_per_hr', to_km_per_hr),
+    f'{TPX_NS}Watts': ('power_watts', to_float),
+    f'{TPX_NS}RunCadence': ('cadence', to_float),
+}
+
+# The columns of a trackpoint, before any of its elements are read
+EMPTY_POINT = {
+    'time': TIME_NOT_AVAILABLE,
+    'heart_rate': METRIC_NOT_AVAILABLE,
+    'position': None,
+    'alt_meters': METRIC_NOT_AVAILABLE,
+    'distance_meters': METRIC_NOT_AVAILABLE,
+    'speed_km_per_hr': METRIC_NOT_AVAILABLE,
+    'power_watts': METRIC_NOT_AVAILABLE,
+    'cadence': METRIC_NOT_AVAILABLE,
+    'activity': 0,
+    'lap': 0,
+    'activity_sport': '',
+}
+
 
 def parse_tcx_file(file_path):
   """Parse TCX file and return a Pandas DataFrame.
 
+  Every trackpoint records the index of its activity and of its lap within
+  the activity, and the sport of its activity.
+
   Args:
-    file_path: The file path of the TCSfile
+    file_path: The file path of the TCSfile, or a binary file object
+               reading it
 
   Returns:
     a Pandas DataFrame
@@ -45,42 +106,46 @@ def parse_tcx_file(file_path):
     sport = ''
 
   data = []
-  # Iterate through each trackpoint
-  for trackpoint in root.findall('.//tcx:Trackpoint', ns):
-    time_element = trackpoint.find('tcx:Time', ns)
-    time_str = (
-        time_element.text if time_element is not None else TIME_NOT_AVAILABLE
-    )
-    time = pd.Timestamp(time_str)
-    heart_rate = get_metric(trackpoint, ns, 'tcx:HeartRateBpm/tcx:Value')
-
-    position_element = trackpoint.find('tcx:Position', ns)
-    latitude = get_metric(position_element, ns, 'tcx:LatitudeDegrees')
-    longitude = get_metric(position_element, ns, 'tcx:LongitudeDegrees')
-    altitude = get_metric(trackpoint, ns, 'tcx:AltitudeMeters')
-    distance = get_metric(trackpoint, ns, 'tcx:DistanceMeters')
-    extension_element = trackpoint.find('tcx:Extensions', ns)
-
-    speed_km_per_hr = None
-    if extension_element is not None:
-      tpx_element = extension_element.find('tpx:TPX', ns)
-      speed = get_metric(tpx_element, ns, 'tpx:Speed')
-      if speed is not None:
-        # Convert from m/s to km/hr
-        speed_km_per_hr = round(float(speed) * 3.6, 2)
-
-    position = {'lat': latitude, 'long': longitude}
-    data.append({
-        'time': time,
-        'heart_rate': heart_rate,
-        'position': position,
-        'alt_meters': altitude,
-        'distance_meters': distance,
-        'speed_km_per_hr': speed_km_per_hr,
-    })
+  # Iterate through each trackpoint of each lap, visiting each of its
+  # elements once
+  for activity_index, activity_element in enumerate(
+      list(root.iter(ACTIVITY_TAG)) or [root]):
+    laps = list(activity_element.iter(LAP_TAG)) or [activity_element]
+    for lap_index, lap in enumerate(laps):
+      lap_point = dict(EMPTY_POINT, activity=activity_index, lap=lap_index,
+                       activity_sport=activity_element.get('Sport', ''))
+      for trackpoint in lap.iter(TRACKPOINT_TAG):
+        point = dict(lap_point)
+        latitude = longitude = METRIC_NOT_AVAILABLE
+        for element in trackpoint:
+          tag = element.tag
+          if tag == TIME_TAG:
+            point['time'] = element.text
+          elif tag == POSITION_TAG:
+            for coordinate in element:
+              if coordinate.tag == LATITUDE_TAG:
+                latitude = to_float(coordinate.text)
+              elif coordinate.tag == LONGITUDE_TAG:
+                longitude = to_float(coordinate.text)
+          elif tag == EXTENSIONS_TAG:
+            for extension in element.iter():
+              channel = EXTENSION_CHANNELS.get(extension.tag)
+              if channel is not None:
+                point[channel[0]] = channel[1](extension.text)
+          elif tag in POINT_CHANNELS:
+            column, convert = POINT_CHANNELS[tag]
+            # HeartRateBpm holds its value in a child element
+            text = element[0].text if len(element) else element.text
+            point[column] = convert(text)
+
+        point['time'] = pd.Timestamp(point['time'])
+        point['position'] = {'lat': latitude, 'long': longitude}
+        data.append(point)
 
   # Create the DataFrame
   df = pd.DataFrame(data)
+  if 'activity_sport' in df.columns:
+    df['activity_sport'] = df['activity_sport'].astype('category')
   return df, sport, start_time
 
 
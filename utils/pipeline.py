@@ -0,0 +1,254 @@
+"""Report many sessions through overlapping I/O and CPU stages."""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import os
+import re
+import time
+
+from utils import aggregate, normalize_time, process_files, report_api, utils
+
+STAGES = ('read', 'parse', 'analyze', 'render', 'write')
+# Sessions running in each stage at once
+DEFAULT_STAGE_JOBS = {'read': 2, 'parse': 2, 'analyze': 2, 'render': 2,
+                      'write': 2}
+# Sessions waiting between two stages, a full queue holds back the stage
+# before it
+DEFAULT_QUEUE_SIZE = 2
+
+_DONE = object()
+
+
+def parse_stage_jobs(text):
+  """Parses per stage concurrency, eg. parse=4,render=3.
+
+  Returns:
+    A dict with the concurrency of every stage, DEFAULT_STAGE_JOBS for the
+    stages not given.
+  """
+  jobs = dict(DEFAULT_STAGE_JOBS)
+  for item in filter(None, (text or '').split(',')):
+    stage, _, value = item.partition('=')
+    if stage not in STAGES or not value.isdigit() or int(value) < 1:
+      raise ValueError(f'Invalid stage jobs: {item}')
+    jobs[stage] = int(value)
+  return jobs
+
+
+def report_filename(output_dir, root_folder, session, sport, start_time):
+  """Returns the report file of a session, unique within the campaign."""
+  name = os.path.relpath(session.split('@')[0], root_folder)
+  label = session.partition('@')[2]
+  slug = re.sub(r'[^A-Za-z0-9]+', '_', f'{name} {label}').strip('_')
+  date = utils.to_local_time(start_time).date() if start_time else 'Unknown'
+  filename = f'{sport}_{date}'
+  if slug:
+    filename += f'-{slug}'
+  return os.path.join(output_dir, filename.replace(' ', '_') + '.html')
+
+
+def _read_files(file_paths):
+  files = []
+  for file_path in file_paths:
+    with open(file_path, 'rb') as f:
+      files.append((os.path.basename(file_path), f.read()))
+  return files
+
+
+def _write_file(filename, html):
+  temp_filename = f'{filename}.tmp'
+  with open(temp_filename, 'w') as f:
+    f.write(html)
+  os.replace(temp_filename, filename)
+
+
+def _quiet(function, *args):
+  """Runs a stage in a worker process without its progress messages."""
+  with contextlib.redirect_stdout(io.StringIO()):
+    return function(*args)
+
+
+def _analyze(session, options):
+  combined_df, sport, start_time = session
+  combined_df, offsets = process_files.analyze_session(
+      combined_df, options['ground_truth_device'], options['ref_device'],
+      **options['analysis_options'])
+  return combined_df, sport, start_time, offsets
+
+
+def _render(analyzed, options):
+  combined_df, sport, start_time, offsets = analyzed
+  return sport, start_time, report_api.render_report(
+      combined_df, sport, start_time, offsets,
+      options['ground_truth_device'], options['ref_device'],
+      options['unit_of_measure'], options['google_maps_api_key'],
+      options['power_gt'], options['cadence_gt'], options['hr_zone_bounds'],
+      options['pyramid'], options['binary'])
+
+
+class _StageTimes:
+  """Sums the time the sessions spend in each stage."""
+
+  def __init__(self):
+    self.seconds = dict.fromkeys(STAGES, 0.0)
+
+  @contextlib.contextmanager
+  def measure(self, stage):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.seconds[stage] += time.perf_counter() - start
+
+
+async def _run_stage(stage, work, inbox, outbox, jobs, times):
+  """Runs jobs workers taking sessions from inbox and passing on results.
+
+  A session that fails is reported and dropped, the others carry on.
+  """
+
+  async def worker():
+    while True:
+      item = await inbox.get()
+      if item is _DONE:
+        # Let the other workers of the stage see the end too
+        await inbox.put(_DONE)
+        return
+      session, value = item
+      try:
+        with times.measure(stage):
+          result = await work(session, value)
+      except Exception as e:  # pylint: disable=broad-except
+        print(f'Failed to {stage} session {session}: {e}')
+        continue
+      if outbox is not None:
+        await outbox.put((session, result))
+
+  await asyncio.gather(*(worker() for _ in range(jobs)))
+  if outbox is not None:
+    await outbox.put(_DONE)
+
+
+async def _run_pipeline(sessions, output_dir, root_folder, options,
+                        stage_jobs, queue_size, executor):
+  loop = asyncio.get_running_loop()
+  times = _StageTimes()
+  queues = {stage: asyncio.Queue(queue_size) for stage in STAGES}
+  written = []
+
+  async def read(_, file_paths):
+    return await asyncio.to_thread(_read_files, file_paths)
+
+  async def parse(_, files):
+    return await loop.run_in_executor(
+        executor, _quiet, report_api.load_files, files, options['duplicates'])
+
+  async def analyze(_, session):
+    return await loop.run_in_executor(executor, _quiet, _analyze, session,
+                                      options)
+
+  async def render(_, analyzed):
+    return await loop.run_in_executor(executor, _quiet, _render, analyzed,
+                                      options)
+
+  async def write(session, rendered):
+    sport, start_time, html = rendered
+    filename = report_filename(output_dir, root_folder, session, sport,
+                               start_time)
+    await asyncio.to_thread(_write_file, filename, html)
+    print('Report: ', filename)
+    written.append(filename)
+
+  async def discover():
+    for session, file_paths in sessions:
+      await queues['read'].put((session, file_paths))
+    await queues['read'].put(_DONE)
+
+  work = {'read': read, 'parse': parse, 'analyze': analyze,
+          'render': render, 'write': write}
+  start = time.perf_counter()
+  await asyncio.gather(discover(), *(
+      _run_stage(stage, work[stage], queues[stage],
+                 queues[STAGES[i + 1]] if i + 1 < len(STAGES) else None,
+                 stage_jobs[stage], times)
+      for i, stage in enumerate(STAGES)))
+  elapsed = time.perf_counter() - start
+  print(f'Reports: {len(written)} of {len(sessions)} sessions in '
+        f'{elapsed:.1f}s, time in each stage: ' + ', '.join(
+            f'{stage} {seconds:.1f}s'
+            for stage, seconds in times.seconds.items()))
+  return sorted(written)
+
+
+def report_sessions(root_folder, output_dir, google_maps_api_key,
+                    ground_truth_device, ref_device, unit_of_measure,
+                    analysis_options=None, power_gt=None, cadence_gt=None,
+                    hr_zone_bounds=None,
+                    duplicates=normalize_time.DEFAULT_DUPLICATE_POLICY,
+                    pyramid=False, binary=False, stage_jobs=None,
+                    queue_size=DEFAULT_QUEUE_SIZE):
+  """Writes a report of every session below root_folder.
+
+  Each session goes through the read, parse, analyze, render and write
+  stages in turn, and the stages work on different sessions at once: files
+  are read and reports written in threads while sessions are parsed,
+  analyzed and rendered in worker processes.  Bounded queues between the
+  stages hold back a stage that runs ahead of the next one, so throughput
+  is set by the slowest stage rather than the sum of them, and only a few
+  sessions are held in memory.
+
+  Args:
+    root_folder: the campaign folder, see aggregate.discover_sessions
+    output_dir: Folder to save the reports
+    google_maps_api_key: Required for the map output to render
+    ground_truth_device:  the string used to determine GT device
+    ref_device:  the string used to determine the ref device
+    unit_of_measure:  imperial or metric
+    analysis_options: optional keyword arguments for
+                      process_files.analyze_session
+    power_gt: the string used to determine the power GT device
+              (default: ground_truth_device)
+    cadence_gt: the string used to determine the cadence GT device
+                (default: ground_truth_device)
+    hr_zone_bounds: the lower bound in BPM of each heart rate zone
+                    (default: hr_zones.zone_bounds())
+    duplicates: how repeated timestamps are resolved, see
+                normalize_time.DUPLICATE_POLICIES
+    pyramid: embed trace pyramids, see trace_pyramid
+    binary: embed the traces and map locations as base64 typed arrays
+    stage_jobs: optional dict of the sessions each stage works on at once,
+                see DEFAULT_STAGE_JOBS
+    queue_size: the most sessions waiting between two stages
+
+  Returns:
+    The sorted list of the report files written.
+  """
+  stage_jobs = {**DEFAULT_STAGE_JOBS, **(stage_jobs or {})}
+  options = {
+      'ground_truth_device': ground_truth_device,
+      'ref_device': ref_device,
+      'unit_of_measure': unit_of_measure,
+      'google_maps_api_key': google_maps_api_key,
+      'analysis_options': analysis_options or {},
+      'power_gt': power_gt,
+      'cadence_gt': cadence_gt,
+      'hr_zone_bounds': hr_zone_bounds,
+      'duplicates': duplicates,
+      'pyramid': pyramid,
+      'binary': binary,
+  }
+  sessions = aggregate.discover_sessions(root_folder)
+  print(f'Sessions: {len(sessions)}')
+  os.makedirs(output_dir, exist_ok=True)
+
+  # Enough processes for every parse, analyze and render job at once
+  workers = sum(stage_jobs[stage] for stage in ('parse', 'analyze', 'render'))
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+    # Start the workers before the reader threads, forking while other
+    # threads run is unsafe
+    executor.submit(int).result()
+    return asyncio.run(_run_pipeline(
+        sessions, output_dir, root_folder, options, stage_jobs, queue_size,
+        executor))
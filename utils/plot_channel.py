@@ -0,0 +1,247 @@
+"""Plots a sensor channel, eg. heart rate, power or cadence, vs a GT device."""
+
+import pandas as pd
+import plotly.graph_objects as go
+from utils import memory_budget, outliers
+
+# Column of each sensor channel and its (title, unit)
+CHANNELS = {
+    'heart_rate': ('Heart Rate', 'BPM'),
+    'power_watts': ('Power', 'W'),
+    'cadence': ('Cadence', 'RPM'),
+}
+
+# Report section of each optional channel and its column
+CHANNEL_SECTIONS = {
+    'power': 'power_watts',
+    'cadence': 'cadence',
+}
+
+
+def has_channel(df, column):
+  """Returns True if any device recorded the channel."""
+  return column in df.columns and df[column].notnull().any()
+
+
+def resolve_ground_truth(df, column, preferred_device):
+  """Picks the GT device of a channel.
+
+  Args:
+    df: A combined DataFrame containing the data of all devices.
+    column: the channel column
+    preferred_device: the string used to determine the GT device, used when
+                      that device recorded the channel
+
+  Returns:
+    preferred_device, or else the device with the most samples of the
+    channel.
+  """
+  counts = pd.to_numeric(df[column], errors='coerce').notnull().groupby(
+      df['device']).sum()
+  preferred = counts[counts.index.str.contains(preferred_device, case=False,
+                                               regex=False)]
+  if preferred.sum() or not counts.sum():
+    return preferred_device
+  return counts.idxmax()
+
+
+def _count_outliers(data, column):
+  if f'{column}_outlier' not in data.columns:
+    return '---'
+  return int(data[f'{column}_outlier'].sum())
+
+
+def get_channel_metrics(combined_df, ground_truth_device, column,
+                        offsets=None, window=None):
+  """Gets the summary metrics of a channel vs the gt device.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    ground_truth_device: the string used to determine GT device
+    column: the channel column, see CHANNELS
+    offsets: clock offsets in seconds removed from each device, if aligned
+    window: optional pd.Timedelta, match the devices one time window at a
+            time, see memory_budget.matched_abs_error
+
+  Returns:
+    A DataFrame with a row for the GT device and each device recording the
+    channel at the same times.
+  """
+  offsets = offsets or {}
+  average = f'avg{CHANNELS[column][1]}'
+
+  # Find the ground truth line
+  ground_truth = combined_df[
+      combined_df['device'].str.contains(ground_truth_device, case=False)
+  ]
+  # Calculate metrics for each line
+  rows = []
+  # Calculate the average and variance for GT Device
+  gt_average = round(ground_truth[column].mean(), 2)
+
+  rows.append({
+      'Device': f'GT ({ground_truth_device})',
+      'MAE': '---',
+      average: gt_average,
+      'Variance': '---',
+      'Offset': '---',
+      'Outliers': _count_outliers(ground_truth, column),
+      'Samples': int(ground_truth[column].notnull().sum()),
+  })
+
+  # Calculate the metrics for the other devices
+  gt_device = None
+  for device, data in combined_df.groupby('device'):
+    if not device.lower().startswith(ground_truth_device.lower()):
+      device_data = data.dropna(subset=[column])
+      total_error, samples = memory_budget.matched_abs_error(
+          data, ground_truth, column, window)
+      if samples:
+        mae = total_error / samples
+        device_average = round(device_data[column].mean(), 2)
+        var = (
+            round(device_average - gt_average, 2)
+            if device != ground_truth_device
+            else '-'
+        )
+        row = {
+            'Device': device,
+            'MAE': round(mae, 2),
+            average: device_average,
+            'Variance': var,
+            'Offset': offsets.get(device, '---'),
+            'Outliers': _count_outliers(data, column),
+            'Samples': samples,
+        }
+        rows.append(row)
+    else:
+      gt_device = device
+
+  if gt_device is not None:
+    rows[0]['Device'] = gt_device
+
+  metrics_table = pd.DataFrame(rows)
+  return metrics_table
+
+
+def plot_channel(df, column, ground_truth_device, sport, start_time,
+                 offsets=None, window=None):
+  """plots a channel's data for a given dataframe.
+
+  Args:
+    df:  the dataframe containing the data
+    column: the channel column, see CHANNELS
+    ground_truth_device: The label for the device considered to be the source
+                         of truth for the channel
+    sport: specifices the sport eg. Biking for which the data was generated
+    start_time: start time of the activity
+    offsets: clock offsets in seconds removed from each device, if aligned
+    window: optional pd.Timedelta, match the devices one time window at a
+            time, see memory_budget.matched_parts
+
+  Returns:
+    fig:  A plot of the channel for the activity
+
+  """
+  title, unit = CHANNELS[column]
+  outlier_column = f'{column}_outlier'
+
+  # Outliers are flagged once in the analysis stage
+  if column == 'heart_rate' and outlier_column not in df.columns:
+    df = outliers.detect_outliers(df)
+
+  metrics_table = get_channel_metrics(df, ground_truth_device, column,
+                                      offsets, window)
+
+  # Calculate the duration
+  min_time = df['time'].min()
+  max_time = df['time'].max()
+  duration = max_time - min_time
+  minutes, seconds = divmod(duration.seconds, 60)
+
+  # Create a single plot with two traces
+  fig = go.Figure()
+
+  # Add a trace for the channel data
+  for device, data in df.groupby('device'):
+    if data[column].isnull().all():
+      continue
+    fig.add_trace(
+        go.Scatter(
+            x=data['time'],
+            y=data[column],
+            mode='lines',
+            name=device,
+            legendgroup=device,
+        )
+    )
+    # plot the outliers separately with a different symbol
+    if outlier_column not in data.columns:
+      continue
+    channel_outliers = data[data[outlier_column]]
+    if not channel_outliers.empty:
+      fig.add_trace(
+          go.Scatter(
+              x=channel_outliers['time'],
+              y=channel_outliers[column],
+              mode='markers',
+              marker=dict(symbol='x', size=10),
+              name=f'{device} Outliers',
+              legendgroup=device,
+          )
+      )
+
+  # Set the title and devices
+  fig.update_layout(
+      title=dict(
+          text=(f'{title} ({sport}) - {start_time}'),
+          font=dict(size=20, color='black'),
+          yanchor='top',
+          y=0.95,
+          xanchor='center',
+          x=0.5,
+      ),
+      xaxis_title=f'Duration: {minutes}m {seconds}s',
+      yaxis_title=f'{title} ({unit})',
+      plot_bgcolor='white',
+      xaxis=dict(linecolor='black'),
+      yaxis=dict(linecolor='black'),
+      legend=dict(
+          orientation='h', yanchor='bottom', y=-0.2, xanchor='center', x=0.5
+      ),
+      margin=dict(l=50, r=50, t=50, b=20),
+      height=600
+  )
+
+  # Add the metrics table above the x-axis, in the bottom right corner of the
+  # plot
+  fig.add_trace(
+      go.Table(
+          columnwidth=[2.0, 1.2, 1.2, 1.2, 1.2, 1.2],
+          header=dict(
+              values=['Device', 'MAE vs GT', f'Avg {unit}', f'{unit} vs GT',
+                      'Offset (s)', 'Outliers'],
+              fill_color='paleturquoise',
+              align=['left', 'right', 'right', 'right', 'right', 'right'],
+              font=dict(size=14),
+              height=40
+          ),
+          cells=dict(
+              values=[
+                  metrics_table['Device'],
+                  metrics_table['MAE'],
+                  metrics_table[f'avg{unit}'],
+                  metrics_table['Variance'],
+                  metrics_table['Offset'],
+                  metrics_table['Outliers'],
+              ],
+              fill_color='lavender',
+              align=['left', 'right', 'right', 'right', 'right', 'right'],
+              font=dict(size=12),
+              height=30
+          ),
+          domain=dict(x=[0.6, 1.0], y=[0.01, 0.3]),
+      )
+  )
+
+  return fig
@@ -1,14 +1,36 @@
 """Plots distance over the time of the activity."""
 import pandas as pd
 import plotly.graph_objects as go
-from sklearn.metrics import mean_absolute_error
+from utils import memory_budget
+from utils import outliers
 from utils import utils
 
 ZOOM_LEVEL = 16
 
 
-def get_distance_metrics(combined_df, ref_device, ratio, small_ratio):
-  """Gets the summary metrics for distance data vs ref device."""
+def _count_gps_jumps(data):
+  if 'gps_jump_outlier' not in data.columns:
+    return '---'
+  return int(data['gps_jump_outlier'].sum())
+
+
+def _raw_distance(data, ratio):
+  """Returns the distance of the recorded fixes when tracks were smoothed."""
+  if 'raw_distance_meters' not in data.columns:
+    return {}
+  return {'Raw Distance': round(
+      data['raw_distance_meters'].max() / 1000 * ratio, 4)}
+
+
+def get_distance_metrics(combined_df, ref_device, ratio, small_ratio,
+                         offsets=None, window=None):
+  """Gets the summary metrics for distance data vs ref device.
+
+  The devices are matched one time window at a time when window is set, see
+  memory_budget.matched_abs_error.
+  """
+
+  offsets = offsets or {}
 
   # Find the ground truth line
   ref_data = combined_df[
@@ -23,26 +45,22 @@ def get_distance_metrics(combined_df, ref_device, ratio, small_ratio):
       'Device': f'Ref:\t({ref_device})',
       'MAE': '---',
       'Distance': round(ref_total_distance / 1000 * ratio, 4),
+      **_raw_distance(ref_data, ratio),
       'Variance': '---',
+      'Offset': '---',
+      'Jumps': _count_gps_jumps(ref_data),
+      'Samples': int(ref_data['calc_distance_meters'].notnull().sum()),
   })
 
   # Calculate the metrics for the other devices
   for device, data in combined_df.groupby('device'):
     if not device.lower().startswith(ref_device.lower()):
       device_data = data.dropna(subset=['calc_distance_meters'])
-      merged_df = pd.merge(
-          device_data, ref_data, on='time', how='outer', suffixes=('', '_ref')
-      )
-      # Drop any rows with missing values
-      merged_df = merged_df.dropna(
-          subset=['calc_distance_meters', 'calc_distance_meters_ref']
-      )
+      total_error, samples = memory_budget.matched_abs_error(
+          device_data, ref_data, 'calc_distance_meters', window)
       # measure MEA in smaller unit (ft or meters)
-      if not merged_df.empty:
-        mae = mean_absolute_error(
-            merged_df['calc_distance_meters'] * small_ratio,
-            merged_df['calc_distance_meters_ref'] * small_ratio,
-        )
+      if samples:
+        mae = total_error / samples * small_ratio
         total_distance = (
             device_data['calc_distance_meters'].max()
         )
@@ -61,7 +79,11 @@ def get_distance_metrics(combined_df, ref_device, ratio, small_ratio):
             'Device': device.replace(' ', '\t'),
             'MAE': round(mae, 2),
             'Distance': round(total_distance / 1000 * ratio, 4),
-            'Variance': var
+            **_raw_distance(device_data, ratio),
+            'Variance': var,
+            'Offset': offsets.get(device, '---'),
+            'Jumps': _count_gps_jumps(device_data),
+            'Samples': samples,
         }
         rows.append(row)
 
@@ -74,7 +96,8 @@ def has_valid_position(row):
   return position['lat'] is not None and position['long'] is not None
 
 
-def plot_distance(df, ref_device, sport, start_time, unit_of_measure):
+def plot_distance(df, ref_device, sport, start_time, unit_of_measure,
+                  offsets=None, window=None):
   """plots distance data for a given dataframe.
 
   Args:
@@ -83,6 +106,9 @@ def plot_distance(df, ref_device, sport, start_time, unit_of_measure):
     sport: specifices the sport eg. Biking for which the data was generated
     start_time: start time of the activity
     unit_of_measure:  IMPERIAL or METRIC
+    offsets: clock offsets in seconds removed from each device, if aligned
+    window: optional pd.Timedelta, match the devices one time window at a
+            time, see memory_budget.matched_parts
 
   Returns:
     fig:  A plot of the distances for the activity
@@ -101,7 +127,12 @@ def plot_distance(df, ref_device, sport, start_time, unit_of_measure):
     distance_label_short = 'mi'
     mae_label = 'MAE\t(ft)'
 
-  metrics_table = get_distance_metrics(df, ref_device, ratio, small_ratio)
+  # GPS jumps are flagged once in the analysis stage
+  if 'gps_jump_outlier' not in df.columns:
+    df = outliers.detect_outliers(df)
+
+  metrics_table = get_distance_metrics(df, ref_device, ratio, small_ratio,
+                                       offsets, window)
   # Calculate the duration
   min_time = df['time'].min()
   max_time = df['time'].max()
@@ -171,27 +202,30 @@ def plot_distance(df, ref_device, sport, start_time, unit_of_measure):
       width=1200
   )
 
+  headers = ['Device', mae_label, distance_label_short, '+/-\t(%)',
+             'Offset\t(s)', 'Jumps']
+  columns = ['Device', 'MAE', 'Distance', 'Variance', 'Offset', 'Jumps']
+  if 'Raw Distance' in metrics_table.columns:
+    # Smoothed tracks also show the distance of the recorded fixes
+    headers.insert(3, f'raw\t{distance_label_short}')
+    columns.insert(3, 'Raw Distance')
+
   # Add the metrics table above the x-axis, in the bottom right corner of the
   # plot
   fig.add_trace(
       go.Table(
-          columnwidth=[2.5, 1, 1, 1],
+          columnwidth=[2.5] + [1] * (len(columns) - 1),
           header=dict(
-              values=['Device', mae_label, distance_label_short, '+/-\t(%)'],
+              values=headers,
               fill_color='paleturquoise',
-              align=['left', 'right', 'right', 'right'],
+              align=['left'] + ['right'] * (len(columns) - 1),
               font=dict(size=14),
               height=40
           ),
           cells=dict(
-              values=[
-                  metrics_table['Device'],
-                  metrics_table['MAE'],
-                  metrics_table['Distance'],
-                  metrics_table['Variance'],
-              ],
+              values=[metrics_table[column] for column in columns],
               fill_color='lavender',
-              align=['left', 'right', 'right', 'right'],
+              align=['left'] + ['right'] * (len(columns) - 1),
               font=dict(size=12),
               height=30
 
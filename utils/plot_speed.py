@@ -1,13 +1,54 @@
 """Plots speed over the time of the activity."""
 
-import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+from utils import outliers
+from utils import stationary
 from utils import utils
 
 ZOOM_LEVEL = 16
 
 
+def get_speed_metrics(combined_df, ratio):
+  """Gets the average speed and outlier count for each device.
+
+  The average speed is over the elapsed time, the moving speed over the
+  moving time, see stationary.moving_seconds.
+  """
+
+  rows = []
+  df_with_speed = combined_df.dropna(subset=['speed_kmh'])
+  for device, data in df_with_speed.groupby('device'):
+    # calculate total distance and total time
+    total_distance = data['calc_distance_meters'].iloc[-1] / 1000.0 * ratio
+    elapsed_seconds = (
+        data['time'].iloc[-1] - data['time'].iloc[0]
+    ).total_seconds()
+    total_time = elapsed_seconds / 3600
+    moving_seconds = stationary.moving_seconds(data)
+
+    # calculate average speed
+    avg_speed = total_distance / total_time
+    moving_speed = (total_distance / (moving_seconds / 3600)
+                    if moving_seconds else float('nan'))
+
+    outlier_count = '---'
+    if 'speed_kmh_outlier' in data.columns:
+      outlier_count = int(data['speed_kmh_outlier'].sum())
+
+    rows.append({
+        'Device': device.replace(' ', '\t'),
+        'AvgSpeed': round(avg_speed, 2),
+        'MovingSpeed': round(moving_speed, 2),
+        'Moving': stationary.format_duration(moving_seconds),
+        'Elapsed': stationary.format_duration(elapsed_seconds),
+        'Outliers': outlier_count,
+    })
+
+  metrics_table = pd.DataFrame(rows)
+  return metrics_table
+
+
 def plot_speed(df, sport, start_time, unit_of_measure):
   """plots speed data for a given dataframe.
 
@@ -22,12 +63,14 @@ def plot_speed(df, sport, start_time, unit_of_measure):
 
   """
   speed_label = 'Avg\tSpeed\t(km/h)'
+  moving_label = 'Moving\t(km/h)'
   yaxis_title = 'Speed (km/h)'
   ratio = 1.0
   if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
     ratio = utils.KM_TO_MILE_RATIO
     yaxis_title = 'Speed (mph)'
     speed_label = 'Avg\tSpeed\t(mph)'
+    moving_label = 'Moving\t(mph)'
 
   # Calculate the duration
   min_time = df['time'].min()
@@ -38,6 +81,10 @@ def plot_speed(df, sport, start_time, unit_of_measure):
   # Create a single plot with two traces
   fig = go.Figure()
 
+  # Outliers are flagged once in the analysis stage
+  if 'speed_kmh_outlier' not in df.columns:
+    df = outliers.detect_outliers(df)
+
   # Filter the DataFrame to keep only rows with non-null speed data
   df_with_speed = df.dropna(
       subset=['speed_kmh']
@@ -50,31 +97,9 @@ def plot_speed(df, sport, start_time, unit_of_measure):
   # Group the filtered DataFrame by 'device'
   grouped_data = df_with_speed.groupby('device')
 
-  metrics = []
   # Add a trace for the speed data
   for device, data in grouped_data:
-    # calculate z-scores
-    z_scores = np.abs(
-        (data['speed_kmh'] - data['speed_kmh'].mean()) / data['speed_kmh'].std()
-    )
-
-    # identify outliers with z-score > 3
-    outliers = data[z_scores > 3]
-
-    # calculate total distance and total time
-    total_distance = data['calc_distance_meters'].iloc[-1] / 1000.0 * ratio
-    total_time = (
-        data['time'].iloc[-1] - data['time'].iloc[0]
-    ).total_seconds() / 3600
-
-    # calculate average speed
-    avg_speed = total_distance / total_time
-
-    metrics.append({
-        'Device': device.replace(' ', '\t'),
-        'AvgSpeed': round(avg_speed, 2),
-        'Outliers': len(outliers),
-    })
+    speed_outliers = data[data['speed_kmh_outlier']]
 
     fig.add_trace(
         go.Scatter(
@@ -89,8 +114,8 @@ def plot_speed(df, sport, start_time, unit_of_measure):
     # plot the outliers separately with a different symbol
     fig.add_trace(
         go.Scatter(
-            x=outliers['time'],
-            y=outliers['speed_kmh'] * ratio,
+            x=speed_outliers['time'],
+            y=speed_outliers['speed_kmh'] * ratio,
             mode='markers',
             marker=dict(symbol='x', size=10),
             name=f'{device} Outliers',
@@ -99,14 +124,15 @@ def plot_speed(df, sport, start_time, unit_of_measure):
         )
     )
 
-  metrics_table = pd.DataFrame(metrics)
+  metrics_table = get_speed_metrics(df_with_speed, ratio)
   fig.add_trace(
       go.Table(
-          columnwidth=[2.5, 1.7, 1],
+          columnwidth=[2.5, 1.7, 1.7, 1.3, 1.3, 1],
           header=dict(
-              values=['Device', speed_label, 'Outliers'],
+              values=['Device', speed_label, moving_label, 'Moving\tTime',
+                      'Elapsed', 'Outliers'],
               fill_color='paleturquoise',
-              align=['left', 'right', 'right'],
+              align=['left', 'right', 'right', 'right', 'right', 'right'],
               font=dict(size=14),
               height=40
           ),
@@ -114,10 +140,13 @@ def plot_speed(df, sport, start_time, unit_of_measure):
               values=[
                   metrics_table['Device'],
                   metrics_table['AvgSpeed'],
+                  metrics_table['MovingSpeed'],
+                  metrics_table['Moving'],
+                  metrics_table['Elapsed'],
                   metrics_table['Outliers'],
               ],
               fill_color='lavender',
-              align=['left', 'right', 'right'],
+              align=['left', 'right', 'right', 'right', 'right', 'right'],
               font=dict(size=12),
               height=30
 
@@ -0,0 +1,186 @@
+"""Read the sport, start time and device of a data file without parsing it."""
+
+import datetime as dt
+import os
+import re
+import xml.etree.ElementTree as ET
+
+from utils import parser_gpx
+
+PROBE_BYTES = 64 * 1024
+CHUNK_BYTES = 8 * 1024
+# A TCX Activity names its Creator after its laps, near the end of the file
+TAIL_BYTES = 8 * 1024
+
+_TCX_CREATOR = re.compile(
+    rb'<(?:\w+:)?Creator\b[^>]*>(.*?)</(?:\w+:)?Creator>', re.S)
+_TCX_NAME = re.compile(rb'<(?:\w+:)?Name>\s*([^<]*?)\s*</')
+_TCX_ACTIVITY_END = re.compile(rb'</(?:\w+:)?Activity>')
+
+# Files starting within this many minutes of a session's first file are
+# recordings of the same session by another device
+SESSION_GAP_MINUTES = 15
+
+
+def _local_name(tag):
+  return tag.rsplit('}', 1)[-1]
+
+
+def parse_time(time_str):
+  """Parses an ISO 8601 time as a naive UTC datetime, None if invalid."""
+  if not time_str:
+    return None
+  time_str = time_str.strip()
+  for time_format in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ'):
+    try:
+      return dt.datetime.strptime(time_str, time_format)
+    except ValueError:
+      pass
+  try:
+    time = dt.datetime.fromisoformat(time_str.replace('Z', '+00:00'))
+  except ValueError:
+    return None
+  if time.tzinfo is not None:
+    time = time.astimezone(dt.timezone.utc).replace(tzinfo=None)
+  return time
+
+
+def _tcx_creator(f):
+  """Returns the Creator Name of the last TCX Activity, None if not found.
+
+  Only the last TAIL_BYTES of the file are read.  A Creator is only taken
+  from within an Activity, the Author that follows the Activities names the
+  exporting software, not the recording device.
+  """
+  f.seek(0, os.SEEK_END)
+  f.seek(max(f.tell() - TAIL_BYTES, 0))
+  tail = f.read()
+  name = None
+  for creator in _TCX_CREATOR.finditer(tail):
+    if _TCX_ACTIVITY_END.search(tail, creator.end()):
+      name = _TCX_NAME.search(creator.group(1)) or name
+  if name is None:
+    return None
+  return name.group(1).decode('utf-8', 'replace') or None
+
+
+def probe_file(file_path, max_bytes=PROBE_BYTES):
+  """Reads the metadata of a TCX or GPX file without parsing all of it.
+
+  The file is fed to an incremental XML parser in small chunks, stopping as
+  soon as the sport and start time are known (TCX Activity Sport and Id, GPX
+  first time and track type) or after max_bytes.  The TCX Activity Creator
+  follows the laps, so it is read from the end of the file, see _tcx_creator.
+
+  Args:
+    file_path: The file path of the TCX or GPX file
+    max_bytes: the most bytes to read from the start of the file
+
+  Returns:
+    A dict of the 'path', 'device' (the file name, as used in the reports),
+    'creator' (the recording device named in the file, if found), 'sport' and
+    'start_time' (naive UTC) of the file.
+  """
+  is_tcx = file_path.lower().endswith('.tcx')
+  info = {
+      'path': file_path,
+      'device': os.path.splitext(os.path.basename(file_path))[0],
+      'creator': None,
+      'sport': None,
+      'start_time': None,
+  }
+  first_time = None
+  in_track = False
+  done = False
+
+  xml_parser = ET.XMLPullParser(events=('start', 'end'))
+  with open(file_path, 'rb') as f:
+    bytes_read = 0
+    while not done and bytes_read < max_bytes:
+      chunk = f.read(CHUNK_BYTES)
+      if not chunk:
+        break
+      bytes_read += len(chunk)
+      try:
+        xml_parser.feed(chunk)
+        events = list(xml_parser.read_events())
+      except ET.ParseError:
+        break
+
+      for event, element in events:
+        tag = _local_name(element.tag)
+        if is_tcx:
+          if event == 'start' and tag == 'Activity':
+            info['sport'] = element.get('Sport')
+          elif event == 'end' and tag == 'Id' and not info['start_time']:
+            info['start_time'] = parse_time(element.text)
+          elif event == 'end' and tag == 'Time' and first_time is None:
+            first_time = parse_time(element.text)
+          elif event == 'start' and tag == 'Trackpoint':
+            # The Activity Id is always written before the first lap
+            done = info['start_time'] is not None
+        else:
+          if event == 'start' and tag == 'gpx':
+            info['creator'] = element.get('creator')
+          elif event == 'start' and tag == 'trk':
+            in_track = True
+          elif event == 'end' and tag == 'type' and in_track:
+            info['sport'] = parser_gpx.to_sport(element.text)
+          elif event == 'end' and tag in ('time', 'metadate'):
+            if first_time is None:
+              first_time = parse_time(element.text)
+          elif event == 'start' and tag == 'trkpt':
+            # Track metadata is always written before the first point
+            done = first_time is not None
+        if done:
+          break
+
+    if is_tcx:
+      info['creator'] = _tcx_creator(f)
+
+  if info['start_time'] is None:
+    info['start_time'] = first_time
+  return info
+
+
+def group_sessions(probes, gap_minutes=SESSION_GAP_MINUTES):
+  """Groups probed files into sessions by their start times.
+
+  Args:
+    probes: list of dicts from probe_file
+    gap_minutes: the most minutes after a session's first file that another
+                 file can start and still belong to it
+
+  Returns:
+    A list of sessions, each a list of probes, ordered by start time.  Files
+    without a start time are each their own session.
+  """
+  timed = sorted((p for p in probes if p['start_time']),
+                 key=lambda p: p['start_time'])
+  sessions = []
+  gap = dt.timedelta(minutes=gap_minutes)
+  for probe in timed:
+    if sessions and probe['start_time'] - sessions[-1][0]['start_time'] <= gap:
+      sessions[-1].append(probe)
+    else:
+      sessions.append([probe])
+  sessions.extend([p] for p in probes if not p['start_time'])
+  return sessions
+
+
+def list_sessions(root_folder):
+  """Prints every data file below root_folder grouped into sessions."""
+  probes = []
+  for folder, _, file_names in os.walk(root_folder):
+    for file_name in sorted(file_names):
+      if file_name.lower().endswith(('.tcx', '.gpx')):
+        probes.append(probe_file(os.path.join(folder, file_name)))
+
+  for session in group_sessions(probes):
+    start_time = session[0]['start_time']
+    sport = next((p['sport'] for p in session if p['sport']), 'Unknown')
+    print(f'{start_time or "Unknown Time"}  {sport}')
+    for probe in session:
+      creator = f' ({probe["creator"]})' if probe['creator'] else ''
+      print(f'    {probe["device"]}{creator}: {probe["path"]}')
+  return probes
@@ -1,59 +1,231 @@
 """Process all TCX and GPS files in the given data folder."""
 
+import concurrent.futures
+import contextlib
 import os
 import webbrowser
 
 import pandas as pd
 import plotly.io as pio
 
-from utils import calc_distance, calc_speed, combine_html, map_activity, parser, plot_distance, plot_heart_rate, plot_speed, utils
+from utils import align_devices, binary_traces, calc_distance, calc_speed, catalog, combine_html, elevation, hr_zones, laps, map_activity, memory_budget, metrics, normalize_time, outliers, parse_cache, plot_channel, plot_distance, plot_heart_rate, plot_speed, render_cache, session_store, smooth_track, stationary, trace_pyramid, track_accuracy, utils
 
 
-def process_files(folder_path, output_dir, google_maps_api_key, launch_browser,
-                  ground_truth_device, ref_device, unit_of_measure):
-  """Process each data file in the data folder.
-
-  Args:
-    folder_path: Folder containing the data files
-    output_dir: Folder to save the results
-    google_maps_api_key: Required for the map output to render
-    launch_browser: determines if browser opens automatically
-    ground_truth_device:  the string used to determine GT device
-    ref_device:  the string used to determine the ref device
-    unit_of_measure:  imperial or metric
-  Raises:
-    <Any>:
-  """
-  # Read all TCX and GPX files in the specified folder
-  file_paths = [
+def find_data_files(folder_path):
+  """Lists the TCX and GPX files in the given folder."""
+  return [
       os.path.join(folder_path, f)
       for f in os.listdir(folder_path)
       if f.lower().endswith('.tcx') or f.lower().endswith('.gpx')
   ]
 
+
+def derive_track(df):
+  """Drops the samples without a time and derives distance and speed.
+
+  Distance and speed are only derived when every sample has a position.  The
+  elevation channels are derived alongside them, see elevation.add_elevation.
+
+  Args:
+    df: the DataFrame of a parsed file, see parser.parse_file
+
+  Returns:
+    The DataFrame with calc_distance_meters and speed_kmh when it has a
+    track, and the elevation.ELEVATION_COLUMNS when it has an altitude.
+  """
+  df = df.dropna(subset=['time'])
+  if all(
+      df['position'].apply(
+          lambda pos: pos.get('lat') is not None
+          and pos.get('long') is not None
+      )
+  ):
+    df['calc_distance_meters'] = calc_distance.calc_distance_haversine(df)
+    df['speed_kmh'] = calc_speed.calc_speed(df)
+  return elevation.add_elevation(df)
+
+
+def normalize_file(df, file_name, duplicates):
+  """Sorts a file's samples by time and labels them with the device.
+
+  Unique, sorted times keep every exact-time merge one to one.
+
+  Args:
+    df: the DataFrame of a file, see derive_track
+    file_name: the name of the file without its extension, used as device
+    duplicates: how repeated timestamps are resolved, see
+                normalize_time.DUPLICATE_POLICIES
+
+  Returns:
+    The normalized DataFrame with a device column.
+  """
+  total = len(df)
+  df, changed = normalize_time.resolve_duplicates(df, duplicates)
+  if changed:
+    utils.progress(f'Normalized times: {file_name}, {total - len(df)} '
+                   f'repeated samples resolved ({duplicates})')
+    if 'calc_distance_meters' in df.columns:
+      has_track = df['calc_distance_meters'].notnull()
+      if has_track.all():
+        df['calc_distance_meters'] = calc_distance.calc_distance_haversine(df)
+        df['speed_kmh'] = calc_speed.calc_speed(df)
+    # The elevation channels follow the resolved samples and distance
+    df = elevation.add_elevation(df)
+
+  df['device'] = file_name
+  return df
+
+
+def load_file(file_path, cache_dir=None, catalog_path=None, store=None,
+              duplicates=normalize_time.DEFAULT_DUPLICATE_POLICY):
+  """Parses a data file and derives its distance and speed.
+
+  The parse cache and the store keep the samples as recorded, the samples
+  are sorted by time with one sample per timestamp after they are read.
+
+  Args:
+    file_path: The file path of the TCX or GPX file
+    cache_dir: optional folder of cached parses to reuse
+    catalog_path: optional catalog database the file is recorded in
+    store: optional session_store.SessionStore to read the file from, and
+           append it to when missing
+    duplicates: how repeated timestamps are resolved, see
+                normalize_time.DUPLICATE_POLICIES
+
+  Returns:
+    A tuple of the DataFrame labelled with the device, the sport and the
+    start time of the file.
+  """
+  file_hash = None
+  if catalog_path or store is not None:
+    file_hash = parse_cache.file_hash(file_path)
+  segment = store.find(file_hash) if store is not None else None
+  file_name = os.path.splitext(os.path.basename(file_path))[0]
+
+  if segment is not None:
+    df, sport, start_time = session_store.load_stored_file(store, segment)
+  else:
+    df, sport, start_time = parse_cache.parse_file_cached(file_path,
+                                                          cache_dir)
+    df = derive_track(df)
+    if store is not None and not store.read_only:
+      store.append(os.path.abspath(file_path), file_hash, file_name, sport,
+                   start_time, df)
+
+  df = normalize_file(df, file_name, duplicates)
+
+  if catalog_path:
+    conn = catalog.open_catalog(catalog_path)
+    try:
+      catalog.record_activity(conn, catalog.summarize_activity(
+          os.path.abspath(file_path), file_hash, file_name, sport, df))
+    finally:
+      conn.close()
+  return df, sport, start_time
+
+
+def index_folder(root_folder, catalog_path=None, cache_dir=None,
+                 store_path=None):
+  """Records every data file below root_folder in the catalog and store.
+
+  Files already recorded with the same content are not parsed again.
+
+  Args:
+    root_folder: the folder to walk
+    catalog_path: optional catalog database the files are recorded in
+    cache_dir: optional folder of cached parses to reuse
+    store_path: optional session store folder the files are appended to
+
+  Returns:
+    The number of files parsed and recorded.
+  """
+  store = session_store.SessionStore(store_path) if store_path else None
+  conn = catalog.open_catalog(catalog_path) if catalog_path else None
+  try:
+    pending = []
+    for folder, _, _ in os.walk(root_folder):
+      for file_path in sorted(find_data_files(folder)):
+        file_path = os.path.abspath(file_path)
+        file_hash = parse_cache.file_hash(file_path)
+        if ((conn is not None
+             and not catalog.is_indexed(conn, file_path, file_hash))
+            or (store is not None and store.find(file_hash) is None)):
+          pending.append(file_path)
+  finally:
+    if conn is not None:
+      conn.close()
+
+  for file_path in pending:
+    utils.progress(f'File: {file_path}')
+    try:
+      load_file(file_path, cache_dir, catalog_path, store)
+    except Exception as e:  # pylint: disable=broad-except
+      utils.progress(f'Failed to index {file_path}: {e}')
+  return len(pending)
+
+
+def load_session(file_paths, cache_dir=None, catalog_path=None,
+                 store_path=None, store_read_only=False,
+                 duplicates=normalize_time.DEFAULT_DUPLICATE_POLICY):
+  """Parses the data files of a session into a single DataFrame.
+
+  Args:
+    file_paths: the TCX/GPX files recorded by each device during the session
+    cache_dir: optional folder of cached parses to reuse
+    catalog_path: optional catalog database the files are recorded in
+    store_path: optional session store folder to read the files from, and
+                append them to when missing
+    store_read_only: only read from the session store
+    duplicates: how repeated timestamps are resolved, see
+                normalize_time.DUPLICATE_POLICIES
+
+  Returns:
+    A tuple of the combined DataFrame with local times, the sport and the
+    start time of the session.
+  """
+  store = None
+  if store_path:
+    store = session_store.SessionStore(store_path, store_read_only)
+  files = []
+  for f in file_paths:
+    utils.progress(f'File: {f}')
+    files.append(load_file(f, cache_dir, catalog_path, store, duplicates))
+  return combine_files(files)
+
+
+def combine_files(files):
+  """Combines the loaded files of a session into a single DataFrame.
+
+  Files labelled with the same device, eg. Apple.tcx and Apple.gpx, are
+  numbered, eg. Apple (2), so each device keeps unique times.
+
+  Args:
+    files: list of the (DataFrame, sport, start time) tuple of each file,
+           see load_file
+
+  Returns:
+    A tuple of the combined DataFrame with local times, the sport and the
+    start time of the session.
+  """
   dfs = []
   sports = set()
   start_times = set()
-  sport = None
-  for f in file_paths:
-    print('File: ', f)
-    df, sport, start_time = parser.parse_file(f)
-    df = df.dropna(subset=['time'])
-    if all(
-        df['position'].apply(
-            lambda pos: pos.get('lat') is not None
-            and pos.get('long') is not None
-        )
-    ):
-      df['calc_distance_meters'] = calc_distance.calc_distance_haversine(df)
-      df['speed_kmh'] = calc_speed.calc_speed(df)
+  labels = set()
+  for df, sport, start_time in files:
     if sport and sport != 'Unknown':
       sports.add(sport)
     if start_time:
       start_times.add(start_time)
-
-    file_name = os.path.splitext(os.path.basename(f))[0]
-    df['device'] = file_name
+    device = df['device'].iloc[0] if len(df) else None
+    if device in labels:
+      count = 2
+      while f'{device} ({count})' in labels:
+        count += 1
+      utils.progress(
+          f'Repeated device: {device}, labelled {device} ({count})')
+      df = df.assign(device=f'{device} ({count})')
+      device = f'{device} ({count})'
+    labels.add(device)
     dfs.append(df)
 
   sport = 'Unknown'
@@ -65,75 +237,526 @@ def process_files(folder_path, output_dir, google_maps_api_key, launch_browser,
     sport = sports.pop()
 
   if start_times:
-    start_time = start_times.pop()
+    # The session starts with the earliest device
+    start_time = min(start_times)
   else:
     start_time = None
 
-  start_time_string = 'Unknown Time'
-  if start_time is not None:
-    start_time_string = utils.to_local_time_string(start_time)
-    print('Start Time: ', start_time_string)
-
   # Combine all DataFrames into a single DataFrame
   combined_df = pd.concat(dfs)
 
   # Convert the time column to local time
-  combined_df['time'] = combined_df['time'].apply(utils.to_local_time)
+  combined_df['time'] = utils.to_local_time_series(combined_df['time'])
 
-  heart_rate_fig = plot_heart_rate.plot_heart_rate(
-      combined_df, ground_truth_device, sport, start_time_string
-  )
+  return combined_df, sport, start_time
 
-  distance_fig = plot_distance.plot_distance(
-      combined_df, ref_device, sport, start_time_string, unit_of_measure)
 
-  speed_fig = plot_speed.plot_speed(
-      combined_df, sport, start_time_string, unit_of_measure
-  )
+def analyze_session(combined_df, ground_truth_device, ref_device,
+                    max_offset=align_devices.DEFAULT_MAX_LAG_SECONDS,
+                    outlier_window=outliers.DEFAULT_WINDOW_SECONDS,
+                    outlier_threshold=outliers.DEFAULT_THRESHOLD,
+                    smooth_gps=False,
+                    gps_noise=smooth_track.DEFAULT_GPS_NOISE_METERS,
+                    stationary_mode='keep',
+                    distance_model=calc_distance.DEFAULT_DISTANCE_MODEL,
+                    distance_3d=False):
+  """Runs the analysis stages shared by the report and the metrics.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    ground_truth_device:  the string used to determine GT device
+    ref_device:  the string used to determine the ref device
+    max_offset: largest clock offset in seconds to correct between devices,
+                0 disables the alignment
+    outlier_window: width in seconds of the rolling outlier window
+    outlier_threshold: number of scaled MADs from the rolling median to be
+                       flagged as an outlier
+    smooth_gps: smooth the GPS tracks before distance and speed are used,
+                keeping the distance of the recorded fixes
+    gps_noise: standard deviation of a GPS fix in meters, used to smooth
+    stationary_mode: keep, drop or collapse the stationary runs of each
+                     device, see stationary.STATIONARY_MODES
+    distance_model: the model distances are measured with, see
+                    calc_distance.DISTANCE_MODELS
+    distance_3d: include the climb between points from alt_meters in the
+                 distance
+
+  Returns:
+    A tuple of the analyzed DataFrame and the clock offsets of each device,
+    or None when the alignment is disabled.
+  """
+  # Files are loaded with haversine distances
+  if (distance_model != calc_distance.DEFAULT_DISTANCE_MODEL
+      or distance_3d):
+    combined_df = calc_distance.recalc_distance(combined_df, distance_model,
+                                                distance_3d)
+
+  # Derive distance and speed from the smoothed tracks
+  if smooth_gps:
+    combined_df = smooth_track.smooth_tracks(
+        combined_df, gps_noise, distance_model=distance_model,
+        altitude=distance_3d)
+
+  # Correct clock offsets between devices before any exact-time merges
+  offsets = None
+  if max_offset:
+    combined_df, offsets = align_devices.align_devices(
+        combined_df, ground_truth_device, max_offset)
+
+  # Classify moving samples once, after the devices share a clock
+  combined_df = stationary.classify_moving(combined_df, ref_device)
+  if stationary_mode != 'keep':
+    total = len(combined_df)
+    combined_df = stationary.trim_stationary(combined_df, stationary_mode)
+    utils.progress(f'Stationary ({stationary_mode}): '
+                   f'{total - len(combined_df)} of {total} points removed')
+
+  # Flag speed, heart rate and GPS jump outliers once for all the plots
+  combined_df = outliers.detect_outliers(
+      combined_df, outlier_window, outlier_threshold)
+
+  # Measure each device's GPS track against the ref device track
+  combined_df = track_accuracy.add_track_error(combined_df, ref_device)
+
+  return combined_df, offsets
+
+
+def section_html(section, combined_df, options):
+  """Builds the HTML of a report section.
+
+  Args:
+    section: heart_rate, hr_zones, distance, speed, elevation, laps, power,
+             cadence or map
+    combined_df: the analyzed DataFrame of the session
+    options: dict of the report options, see report_options
+
+  Returns:
+    The HTML string, or None when the section has no output.
+  """
+  unit_of_measure = options['unit_of_measure']
+  if section == 'map':
+    small_ratio = 1.0
+    if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
+      small_ratio = utils.M_TO_FT_RATIO
+    track_metrics = track_accuracy.get_track_metrics(
+        combined_df, options['ref_device'], small_ratio)
+
+    # Create a google map of the activity
+    map_html_string = map_activity.map_activity(
+        combined_df, options['sport'], options['google_maps_api_key'],
+        unit_of_measure, track_metrics, options['binary_traces'])
+    return map_html_string or None
+
+  if section == 'heart_rate':
+    fig = plot_heart_rate.plot_heart_rate(
+        combined_df, options['ground_truth_device'], options['sport'],
+        options['start_time'], options['offsets'], options['window'])
+  elif section == 'hr_zones':
+    fig = hr_zones.plot_hr_zones(
+        combined_df, options['ground_truth_device'],
+        options['hr_zone_bounds'], options['sport'], options['start_time'],
+        options['window'])
+  elif section == 'distance':
+    fig = plot_distance.plot_distance(
+        combined_df, options['ref_device'], options['sport'],
+        options['start_time'], unit_of_measure, options['offsets'],
+        options['window'])
+  elif section == 'speed':
+    fig = plot_speed.plot_speed(
+        combined_df, options['sport'], options['start_time'],
+        unit_of_measure)
+  elif section == 'elevation':
+    fig = elevation.plot_elevation(
+        combined_df, options['ref_device'], options['sport'],
+        options['start_time'], unit_of_measure, options['window'])
+  elif section == 'laps':
+    fig = laps.plot_laps(combined_df, options['sport'],
+                         options['start_time'], unit_of_measure)
+  elif section in plot_channel.CHANNEL_SECTIONS:
+    fig = plot_channel.plot_channel(
+        combined_df, plot_channel.CHANNEL_SECTIONS[section],
+        options[f'{section}_gt'], options['sport'], options['start_time'],
+        options['offsets'], options['window'])
+  else:
+    raise ValueError(f'Unknown report section: {section}')
+
+  if options['trace_levels'] is not None:
+    trace_pyramid.apply_pyramid(fig, options['trace_levels'], section)
+  if options['binary_traces']:
+    binary_traces.encode_figure(fig)
+  return pio.to_html(fig)
+
+
+def render_section(section, combined_df, options, filename):
+  """Builds a report section and writes it to its HTML file.
+
+  Args:
+    section: see section_html
+    combined_df: the analyzed DataFrame of the session
+    options: dict of the report options, see report_options
+    filename: the HTML file of the section
+
+  Returns:
+    The filename, or None when the section has no output.
+  """
+  html = section_html(section, combined_df, options)
+  if html is None:
+    return None
+  with open(filename, 'w') as f:
+    f.write(html)
+  return filename
+
+
+def report_options(combined_df, sport, start_time_string, offsets,
+                   ground_truth_device, ref_device, unit_of_measure,
+                   google_maps_api_key, trace_levels=None, binary=False,
+                   power_gt=None, cadence_gt=None, hr_zone_bounds=None,
+                   window=None):
+  """Chooses the sections of a report and the options they are built with.
+
+  Args:
+    combined_df: the analyzed DataFrame of the session
+    sport: the sport of the session
+    start_time_string: the local start time shown in the titles
+    offsets: the clock offset of each device, see analyze_session
+    ground_truth_device:  the string used to determine GT device
+    ref_device:  the string used to determine the ref device
+    unit_of_measure:  imperial or metric
+    google_maps_api_key: Required for the map output to render
+    trace_levels: optional trace pyramid, see trace_pyramid.build_pyramid
+    binary: encode the traces and map locations as base64 typed arrays
+    power_gt: the string used to determine the power GT device
+              (default: ground_truth_device)
+    cadence_gt: the string used to determine the cadence GT device
+                (default: ground_truth_device)
+    hr_zone_bounds: the lower bound in BPM of each heart rate zone
+                    (default: hr_zones.zone_bounds())
+    window: optional pd.Timedelta, the metric tables of the figures match
+            the devices one time window at a time, see
+            memory_budget.matched_parts
+
+  Returns:
+    A tuple of the options dict, see section_html, and the list of the
+    (section, tab name) of each section in report order.
+  """
+  options = {
+      'ground_truth_device': ground_truth_device,
+      'ref_device': ref_device,
+      'unit_of_measure': unit_of_measure,
+      'google_maps_api_key': google_maps_api_key,
+      'sport': sport,
+      'start_time': start_time_string,
+      'offsets': offsets,
+      'trace_levels': trace_levels,
+      'binary_traces': binary,
+      'hr_zone_bounds': hr_zone_bounds or hr_zones.zone_bounds(),
+      'window': window,
+  }
+  sections = [
+      ('heart_rate', 'Heart Rate'),
+      ('distance', 'Distance'),
+      ('speed', 'Speed'),
+  ]
+  if plot_channel.has_channel(combined_df, 'heart_rate'):
+    sections.insert(1, ('hr_zones', 'HR Zones'))
+  if elevation.has_elevation(combined_df):
+    sections.append(('elevation', 'Elevation'))
+  if laps.has_laps(combined_df):
+    sections.append(('laps', 'Laps'))
+  # Power and cadence tabs are only added when a device records them
+  channel_gts = {'power': power_gt, 'cadence': cadence_gt}
+  for section, column in plot_channel.CHANNEL_SECTIONS.items():
+    if not plot_channel.has_channel(combined_df, column):
+      continue
+    options[f'{section}_gt'] = plot_channel.resolve_ground_truth(
+        combined_df, column, channel_gts[section] or ground_truth_device)
+    sections.append((section, plot_channel.CHANNELS[column][0]))
+  sections.append(('map', 'Map'))
+  return options, sections
+
+
+def render_sections(combined_df, options, sections, jobs=None,
+                    cache_dir=None):
+  """Renders the independent report sections concurrently.
+
+  Each section builds its figure and serializes it in a worker process, so
+  a report takes about as long as its slowest section.  With a cache_dir,
+  sections whose inputs are unchanged since a previous report are reused
+  instead of rendered, and the cache is then pruned to
+  render_cache.MAX_CACHE_BYTES.
+
+  Args:
+    combined_df: the analyzed DataFrame of the session
+    options: dict of the report options, see process_files
+    sections: list of (section, filename) tuples, see render_section
+    jobs: number of worker processes, 1 renders the sections in this process
+          (default: one per section)
+    cache_dir: optional folder of rendered sections to reuse
+
+  Returns:
+    The HTML file of each section, a cached fragment when cache_dir is set,
+    None for sections without output.
+  """
+  results = [None] * len(sections)
+  keys = [None] * len(sections)
+  pending = []
+  for i, (section, filename) in enumerate(sections):
+    if cache_dir:
+      keys[i] = render_cache.section_key(section, combined_df, options)
+      path = render_cache.cached_path(cache_dir, section, keys[i])
+      if os.path.exists(path):
+        utils.progress(f'Reusing cached {section} section')
+        render_cache.touch(path)
+        results[i] = path
+        continue
+    pending.append(i)
+
+  if jobs == 1 or len(pending) <= 1:
+    for i in pending:
+      section, filename = sections[i]
+      results[i] = render_section(section, combined_df, options, filename)
+  else:
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs or len(pending)) as executor:
+      futures = {
+          i: executor.submit(render_section, sections[i][0], combined_df,
+                             options, sections[i][1])
+          for i in pending
+      }
+      for i, future in futures.items():
+        results[i] = future.result()
+
+  if cache_dir:
+    os.makedirs(cache_dir, exist_ok=True)
+    for i in pending:
+      if results[i] is not None:
+        path = render_cache.cached_path(cache_dir, sections[i][0], keys[i])
+        os.replace(results[i], path)
+        results[i] = path
+    # Bound the cache, least recently used sections first
+    render_cache.prune(cache_dir, [path for path in results if path])
+  return results
+
+
+def process_files(folder_path, output_dir, google_maps_api_key, launch_browser,
+                  ground_truth_device, ref_device, unit_of_measure,
+                  max_offset=align_devices.DEFAULT_MAX_LAG_SECONDS,
+                  outlier_window=outliers.DEFAULT_WINDOW_SECONDS,
+                  outlier_threshold=outliers.DEFAULT_THRESHOLD,
+                  metrics_only=False, metrics_format='json',
+                  metrics_file=None, pyramid=False, catalog_path=None,
+                  file_paths=None, store_path=None, jobs=None,
+                  render_cache_dir=None, binary=False, power_gt=None,
+                  cadence_gt=None, memory_limit=None, smooth_gps=False,
+                  gps_noise=smooth_track.DEFAULT_GPS_NOISE_METERS,
+                  stationary_mode='keep', hr_zone_bounds=None,
+                  distance_model=calc_distance.DEFAULT_DISTANCE_MODEL,
+                  distance_3d=False,
+                  duplicates=normalize_time.DEFAULT_DUPLICATE_POLICY,
+                  split_activities=False, session=None, activity=None):
+  """Process each data file in the data folder.
+
+  Args:
+    folder_path: Folder containing the data files
+    output_dir: Folder to save the results
+    google_maps_api_key: Required for the map output to render
+    launch_browser: determines if browser opens automatically
+    ground_truth_device:  the string used to determine GT device
+    ref_device:  the string used to determine the ref device
+    unit_of_measure:  imperial or metric
+    max_offset: largest clock offset in seconds to correct between devices,
+                0 disables the alignment
+    outlier_window: width in seconds of the rolling outlier window
+    outlier_threshold: number of scaled MADs from the rolling median to be
+                       flagged as an outlier
+    metrics_only: only compute the metric tables, skipping every figure,
+                  map and HTML output
+    metrics_format: json or csv, used with metrics_only
+    metrics_file: file the metrics are written to, stdout when not set
+    pyramid: embed min/max/mean trace aggregates at several bucket sizes and
+             plot the finest level that fits, swapping in finer levels on
+             zoom
+    catalog_path: optional catalog database the files are recorded in
+    file_paths: the data files of the session, instead of every file in
+                folder_path
+    store_path: optional session store folder to read the files from, and
+                append them to when missing
+    jobs: number of worker processes rendering the report sections, 1
+          renders them in this process (default: one per section)
+    render_cache_dir: optional folder of rendered sections, sections whose
+                      data, options and code are unchanged are reused
+    binary: embed the trace times and values and the map locations as
+            base64 typed arrays instead of decimal and date text
+    power_gt: the string used to determine the power GT device, when that
+              device records power (default: ground_truth_device)
+    cadence_gt: the string used to determine the cadence GT device, when
+                that device records cadence (default: ground_truth_device)
+    memory_limit: optional memory budget in bytes.  The peak memory of each
+                  stage is reported, and when the projected peak exceeds the
+                  budget the metrics are matched in time windows and the
+                  report sections are rendered one at a time from trace
+                  pyramids, with binary traces
+    smooth_gps: smooth the GPS tracks with a Kalman filter and RTS pass
+                before distance and speed are used, reporting the raw
+                distance too
+    gps_noise: standard deviation of a GPS fix in meters, used to smooth
+    stationary_mode: keep, drop or collapse the stationary runs of each
+                     device before the metrics and plots
+    hr_zone_bounds: the lower bound in BPM of each heart rate zone
+                    (default: hr_zones.zone_bounds())
+    distance_model: the model distances are measured with, see
+                    calc_distance.DISTANCE_MODELS
+    distance_3d: include the climb between points from alt_meters in the
+                 distance
+    duplicates: keep the first or last sample of a repeated timestamp, or
+                their mean, see normalize_time.DUPLICATE_POLICIES
+    split_activities: write a report per activity when the files record
+                      several activities, eg. the legs of a triathlon
+    session: an already loaded (DataFrame, sport, start time) tuple used
+             instead of the files, see load_session
+    activity: the index of the activity the session holds, added to the
+              report file name
+  Raises:
+    <Any>:
+  """
+  # Read all TCX and GPX files in the specified folder
+  if file_paths is None:
+    file_paths = find_data_files(folder_path)
+
+  memory = None
+  window = None
+  if memory_limit:
+    memory = memory_budget.StageMemory(memory_limit)
+    # Without jobs, every section is rendered in a worker of its own
+    workers = (0 if metrics_only or jobs == 1
+               else jobs or len(render_cache.SECTION_INPUTS))
+    projected = memory_budget.project_peak(file_paths, metrics_only, workers)
+    message = (f'Projected peak memory: {memory_budget.format_size(projected)}'
+               f' of {memory_budget.format_size(memory_limit)}')
+    if projected > memory_limit and workers:
+      jobs = 1
+      projected = memory_budget.project_peak(file_paths)
+      message += (', rendering the sections in this process'
+                  f' ({memory_budget.format_size(projected)})')
+    if projected > memory_limit:
+      # Bound the merges and figures instead of holding every sample at once
+      window = memory_budget.CHUNK_WINDOW
+      message += ', processing in time windows'
+    utils.progress(message)
+
+  def stage(name):
+    return memory.stage(name) if memory else contextlib.nullcontext()
+
+  if session is None:
+    with stage('load'):
+      session = load_session(
+          file_paths, catalog_path=catalog_path, store_path=store_path,
+          duplicates=duplicates)
+  combined_df, sport, start_time = session
+
+  if (split_activities and not metrics_only
+      and laps.count_activities(combined_df) > 1):
+    # Each activity is analyzed and reported on its own, from a single load
+    for index, activity_df, activity_sport, activity_start in (
+        laps.split_activities(combined_df, sport)):
+      utils.progress(f'Activity {index + 1}: {activity_sport}')
+      process_files(
+          folder_path, output_dir, google_maps_api_key, launch_browser,
+          ground_truth_device, ref_device, unit_of_measure,
+          max_offset=max_offset, outlier_window=outlier_window,
+          outlier_threshold=outlier_threshold, pyramid=pyramid,
+          file_paths=file_paths, jobs=jobs,
+          render_cache_dir=render_cache_dir, binary=binary,
+          power_gt=power_gt, cadence_gt=cadence_gt,
+          memory_limit=memory_limit, smooth_gps=smooth_gps,
+          gps_noise=gps_noise, stationary_mode=stationary_mode,
+          hr_zone_bounds=hr_zone_bounds, distance_model=distance_model,
+          distance_3d=distance_3d, duplicates=duplicates,
+          session=(activity_df, activity_sport, activity_start),
+          activity=index)
+    return
+
+  start_time_string = 'Unknown Time'
+  if start_time is not None:
+    start_time_string = utils.to_local_time_string(start_time)
+    utils.progress(f'Start Time: {start_time_string}')
+
+  with stage('analyze'):
+    combined_df, offsets = analyze_session(
+        combined_df, ground_truth_device, ref_device, max_offset,
+        outlier_window, outlier_threshold, smooth_gps, gps_noise,
+        stationary_mode, distance_model, distance_3d)
+
+  if metrics_only:
+    with stage('metrics'):
+      tables = metrics.compute_metrics(
+          combined_df, ground_truth_device, ref_device, unit_of_measure,
+          offsets, power_gt, cadence_gt, window, hr_zone_bounds)
+    metrics.write_metrics(
+        tables, metrics_format, metrics_file,
+        {'session': folder_path, 'sport': sport,
+         'start_time': start_time_string})
+    if memory:
+      memory.report()
+    return
+
+  if window is not None:
+    # Plot pyramid levels and encode the traces and map compactly
+    pyramid = True
+    binary = True
+
+  trace_levels = None
+  extra_html = ''
+  if pyramid:
+    # Pre-aggregate the traces so the plots only embed a coarse level
+    with stage('pyramid'):
+      trace_levels = trace_pyramid.build_pyramid(combined_df, unit_of_measure)
+      extra_html = trace_pyramid.pyramid_script_html(trace_levels)
 
   base_filename = os.path.join(
       output_dir, f'{sport}_{utils.to_local_time(start_time).date()}'
   )
+  if activity is not None:
+    base_filename += f'-activity{activity + 1}'
   base_filename = base_filename.replace(' ', '_')
-  hr_filename = base_filename + '-hr.html'
-  distance_filename = base_filename + '-distance.html'
-  speed_filename = base_filename + '-speed.html'
 
-  pio.write_html(speed_fig, speed_filename)
-  map_filename = base_filename + '-map.html'
-
-  pio.write_html(distance_fig, distance_filename)
-  pio.write_html(heart_rate_fig, hr_filename)
+  options, report_sections = report_options(
+      combined_df, sport, start_time_string, offsets, ground_truth_device,
+      ref_device, unit_of_measure, google_maps_api_key, trace_levels, binary,
+      power_gt, cadence_gt, hr_zone_bounds, window)
+  # The heart rate section keeps its short file name
+  sections = [
+      (section,
+       f'{base_filename}-{"hr" if section == "heart_rate" else section}.html')
+      for section, _ in report_sections
+  ]
+  tab_names = [tab_name for _, tab_name in report_sections]
 
-  # Create a google map of the activity
-  map_html_string = map_activity.map_activity(
-      combined_df, sport, google_maps_api_key, unit_of_measure
-  )
-  if map_html_string:
-    with open(map_filename, 'w') as f:
-      f.write(map_html_string)
+  with stage('render'):
+    section_files = render_sections(combined_df, options, sections, jobs,
+                                    render_cache_dir)
 
   combined_filename = base_filename + '.html'
-  combine_html.combine_html(
-      combined_filename,
-      [hr_filename, distance_filename, speed_filename, map_filename],
-      ['Heart Rate', 'Distance', 'Speed', 'Map'])
+  with stage('combine'):
+    combine_html.combine_html(
+        combined_filename,
+        [section_file or filename
+         for section_file, (_, filename) in zip(section_files, sections)],
+        tab_names, extra_html)
 
   if os.path.exists(combined_filename):
     # delete the individual files
-    if os.path.exists(hr_filename):
-      os.remove(hr_filename)
-    if os.path.exists(distance_filename):
-      os.remove(distance_filename)
-    if os.path.exists(speed_filename):
-      os.remove(speed_filename)
-    if os.path.exists(map_filename):
-      os.remove(map_filename)
+    for _, filename in sections:
+      if os.path.exists(filename):
+        os.remove(filename)
+
+  if memory:
+    memory.report()
 
   url = f'file://{os.path.abspath(combined_filename)}'
 
   if launch_browser:
-    print('launching browser with results')
+    utils.progress('launching browser with results')
     webbrowser.open_new_tab(url)
 
 
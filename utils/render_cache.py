@@ -0,0 +1,154 @@
+"""Cache rendered report sections keyed by a hash of their inputs."""
+
+import functools
+import glob
+import hashlib
+import os
+
+import pandas as pd
+import plotly
+
+RENDER_CACHE_DIRNAME = '.render_cache'
+# Size the cache is pruned to, each section embeds its own copy of plotly.js
+MAX_CACHE_BYTES = 512 * 2 ** 20
+
+# The analyzed columns and report options each section is rendered from
+SECTION_INPUTS = {
+    'heart_rate': (
+        ('time', 'device', 'heart_rate', 'heart_rate_outlier'),
+        ('ground_truth_device', 'sport', 'start_time', 'offsets'),
+    ),
+    'hr_zones': (
+        ('time', 'device', 'heart_rate'),
+        ('ground_truth_device', 'hr_zone_bounds', 'sport', 'start_time'),
+    ),
+    'distance': (
+        ('time', 'device', 'position', 'calc_distance_meters',
+         'raw_distance_meters', 'gps_jump_outlier'),
+        ('ref_device', 'unit_of_measure', 'sport', 'start_time', 'offsets'),
+    ),
+    'speed': (
+        ('time', 'device', 'calc_distance_meters', 'speed_kmh',
+         'speed_kmh_outlier', 'moving'),
+        ('unit_of_measure', 'sport', 'start_time'),
+    ),
+    'elevation': (
+        ('time', 'device', 'elevation_meters', 'grade_percent',
+         'vertical_speed_mh'),
+        ('ref_device', 'unit_of_measure', 'sport', 'start_time'),
+    ),
+    'laps': (
+        ('time', 'device', 'activity', 'lap', 'heart_rate',
+         'calc_distance_meters', 'power_watts', 'cadence'),
+        ('unit_of_measure', 'sport', 'start_time'),
+    ),
+    'power': (
+        ('time', 'device', 'power_watts'),
+        ('power_gt', 'sport', 'start_time', 'offsets'),
+    ),
+    'cadence': (
+        ('time', 'device', 'cadence'),
+        ('cadence_gt', 'sport', 'start_time', 'offsets'),
+    ),
+    'map': (
+        ('time', 'device', 'position', 'latitude', 'longitude', 'heart_rate',
+         'alt_meters', 'calc_distance_meters', 'speed_kmh',
+         'track_error_meters'),
+        ('ref_device', 'unit_of_measure', 'sport', 'google_maps_api_key'),
+    ),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+  """Returns a hash of the report code, templates and plotly version."""
+  digest = hashlib.sha1(plotly.__version__.encode())
+  utils_dir = os.path.dirname(__file__)
+  for path in sorted(glob.glob(os.path.join(utils_dir, '*.py'))
+                     + glob.glob(os.path.join(utils_dir, 'html', '*.html'))):
+    with open(path, 'rb') as f:
+      digest.update(f.read())
+  return digest.hexdigest()
+
+
+def _column_values(df, column):
+  if column == 'position':
+    # Hash the coordinates, the position dicts themselves are not hashable
+    return df[column].map(
+        lambda pos: (pos.get('lat'), pos.get('long'))
+        if isinstance(pos, dict) else None).astype(str)
+  return df[column]
+
+
+def section_key(section, combined_df, options):
+  """Derives the cache key of a report section from its actual inputs.
+
+  Args:
+    section: heart_rate, hr_zones, distance, speed, laps, power, cadence or
+             map
+    combined_df: the analyzed DataFrame of the session
+    options: dict of the report options, see process_files.render_section
+
+  Returns:
+    The hex digest identifying the rendered section.
+  """
+  columns, option_names = SECTION_INPUTS[section]
+  digest = hashlib.sha1(f'{section}:{code_version()}\n'.encode())
+  for name in option_names:
+    digest.update(f'{name}={options[name]!r}\n'.encode())
+  # The plotted traces also depend on the pyramid levels and encoding
+  digest.update(f'pyramid={options["trace_levels"] is not None}\n'.encode())
+  digest.update(f'binary={options["binary_traces"]}\n'.encode())
+  for column in columns:
+    if column not in combined_df.columns:
+      continue
+    digest.update(f'{column}\n'.encode())
+    hashes = pd.util.hash_pandas_object(
+        _column_values(combined_df, column), index=False)
+    digest.update(hashes.to_numpy().tobytes())
+  return digest.hexdigest()
+
+
+def cached_path(cache_dir, section, key):
+  """Returns the file a section with this key is cached in."""
+  return os.path.join(cache_dir, f'{section}-{key}.html')
+
+
+def touch(path):
+  """Marks a cached section as used, so pruning keeps it the longest."""
+  os.utime(path)
+
+
+def prune(cache_dir, keep=(), max_bytes=MAX_CACHE_BYTES):
+  """Removes the least recently used sections over max_bytes.
+
+  Args:
+    cache_dir: the folder of rendered sections
+    keep: paths of the sections of the current report, never removed
+    max_bytes: the largest total size of the cached sections
+
+  Returns:
+    The number of sections removed.
+  """
+  keep = {os.path.abspath(path) for path in keep}
+  entries = []
+  for path in glob.glob(os.path.join(cache_dir, '*.html')):
+    try:
+      stat = os.stat(path)
+    except OSError:
+      continue
+    entries.append((stat.st_mtime, stat.st_size, os.path.abspath(path)))
+  total = sum(size for _, size, _ in entries)
+  removed = 0
+  for _, size, path in sorted(entries):
+    if total <= max_bytes:
+      break
+    if path in keep:
+      continue
+    try:
+      os.remove(path)
+    except OSError:
+      continue
+    total -= size
+    removed += 1
+  return removed
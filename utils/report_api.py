@@ -0,0 +1,165 @@
+"""Build a report from in-memory files, for embedding tcxplot in a service."""
+
+import io
+import os
+
+from utils import align_devices, combine_html, metrics, normalize_time, outliers, parser, process_files, trace_pyramid, utils
+
+
+def _read_file(name, data):
+  """Parses an in-memory TCX or GPX file.
+
+  Args:
+    name: the file name, its extension gives the file type and the rest the
+          device
+    data: the file content as bytes, or a binary file object reading it
+
+  Returns:
+    A tuple of the device name, the DataFrame, the sport and the start time.
+  """
+  device, file_type = os.path.splitext(os.path.basename(name))
+  if file_type.lower() not in ('.tcx', '.gpx'):
+    raise ValueError(f'Not a TCX or GPX file: {name}')
+  stream = io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+  df, sport, start_time = parser.parse_file(stream, file_type)
+  return device, df, sport, start_time
+
+
+def load_files(files, duplicates=normalize_time.DEFAULT_DUPLICATE_POLICY):
+  """Parses the in-memory files of a session into a single DataFrame.
+
+  Args:
+    files: list of (file name, content) tuples, see build_report
+    duplicates: how repeated timestamps are resolved, see
+                normalize_time.DUPLICATE_POLICIES
+
+  Returns:
+    The (combined DataFrame, sport, start time) tuple of
+    process_files.combine_files.
+  """
+  loaded = []
+  for name, data in files:
+    device, df, sport, start_time = _read_file(name, data)
+    df = process_files.derive_track(df)
+    df = process_files.normalize_file(df, device, duplicates)
+    loaded.append((df, sport, start_time))
+  if not loaded:
+    raise ValueError('No files to report on')
+  return process_files.combine_files(loaded)
+
+
+def start_time_string(start_time):
+  """Formats the start time of a session as shown in the report titles."""
+  if start_time is None:
+    return 'Unknown Time'
+  return utils.to_local_time_string(start_time)
+
+
+def render_report(combined_df, sport, start_time, offsets,
+                  ground_truth_device, ref_device, unit_of_measure,
+                  google_maps_api_key=None, power_gt=None, cadence_gt=None,
+                  hr_zone_bounds=None, pyramid=False, binary=False):
+  """Renders the combined report of an analyzed session in memory.
+
+  Args:
+    combined_df: the analyzed DataFrame, see process_files.analyze_session
+    sport: the sport of the session
+    start_time: the start time of the session
+    offsets: the clock offset of each device, see analyze_session
+    ground_truth_device: see build_report
+    ref_device: see build_report
+    unit_of_measure: see build_report
+    google_maps_api_key: see build_report
+    power_gt: see build_report
+    cadence_gt: see build_report
+    hr_zone_bounds: see build_report
+    pyramid: see build_report
+    binary: see build_report
+
+  Returns:
+    The report HTML string.
+  """
+  trace_levels = None
+  extra_html = ''
+  if pyramid:
+    trace_levels = trace_pyramid.build_pyramid(combined_df, unit_of_measure)
+    extra_html = trace_pyramid.pyramid_script_html(trace_levels)
+  options, sections = process_files.report_options(
+      combined_df, sport, start_time_string(start_time), offsets,
+      ground_truth_device, ref_device, unit_of_measure, google_maps_api_key,
+      trace_levels, binary, power_gt, cadence_gt, hr_zone_bounds)
+  html = [process_files.section_html(section, combined_df, options) or ''
+          for section, _ in sections]
+  return combine_html.combine_html_string(
+      html, [tab_name for _, tab_name in sections], extra_html)
+
+
+def build_report(files, ground_truth_device='Polar', ref_device='Apple',
+                 unit_of_measure=utils.UnitOfMeasure.IMPERIAL,
+                 google_maps_api_key=None, metrics_format='json',
+                 max_offset=align_devices.DEFAULT_MAX_LAG_SECONDS,
+                 outlier_window=outliers.DEFAULT_WINDOW_SECONDS,
+                 outlier_threshold=outliers.DEFAULT_THRESHOLD,
+                 analysis_options=None, power_gt=None, cadence_gt=None,
+                 hr_zone_bounds=None,
+                 duplicates=normalize_time.DEFAULT_DUPLICATE_POLICY,
+                 pyramid=False, binary=False, metrics_only=False):
+  """Builds the combined report and the metrics of a session in memory.
+
+  Unlike process_files, nothing is read from or written to disk apart from
+  the HTML templates, no browser is launched and no worker processes are
+  started.  Nothing is printed, progress messages go to utils.LOGGER.  Every
+  call works on its own data, so sessions can be built from many threads at
+  once.
+
+  Args:
+    files: list of (file name, content) tuples, one per device.  The
+           content is bytes or a binary file object, the file name gives
+           the device and whether it is a TCX or GPX file
+    ground_truth_device:  the string used to determine GT device
+    ref_device:  the string used to determine the ref device
+    unit_of_measure:  imperial or metric
+    google_maps_api_key: Required for the map output to render
+    metrics_format: json or csv
+    max_offset: largest clock offset in seconds to correct between devices,
+                0 disables the alignment
+    outlier_window: width in seconds of the rolling outlier window
+    outlier_threshold: number of scaled MADs from the rolling median to be
+                       flagged as an outlier
+    analysis_options: optional further keyword arguments for
+                      process_files.analyze_session, eg. stationary_mode
+    power_gt: the string used to determine the power GT device
+              (default: ground_truth_device)
+    cadence_gt: the string used to determine the cadence GT device
+                (default: ground_truth_device)
+    hr_zone_bounds: the lower bound in BPM of each heart rate zone
+                    (default: hr_zones.zone_bounds())
+    duplicates: how repeated timestamps are resolved, see
+                normalize_time.DUPLICATE_POLICIES
+    pyramid: embed trace pyramids, see trace_pyramid
+    binary: embed the traces and map locations as base64 typed arrays
+    metrics_only: only compute the metrics, the report is None
+
+  Returns:
+    A tuple of the UTF-8 encoded report HTML, or None with metrics_only, and
+    the encoded metrics.
+  """
+  combined_df, sport, start_time = load_files(files, duplicates)
+  combined_df, offsets = process_files.analyze_session(
+      combined_df, ground_truth_device, ref_device, max_offset,
+      outlier_window, outlier_threshold, **(analysis_options or {}))
+
+  tables = metrics.compute_metrics(
+      combined_df, ground_truth_device, ref_device, unit_of_measure, offsets,
+      power_gt, cadence_gt, hr_zone_bounds=hr_zone_bounds)
+  metrics_bytes = metrics.format_metrics(
+      tables, metrics_format,
+      {'sport': sport, 'start_time': start_time_string(start_time)}).encode()
+  if metrics_only:
+    return None, metrics_bytes
+
+  report = render_report(
+      combined_df, sport, start_time, offsets, ground_truth_device,
+      ref_device, unit_of_measure, google_maps_api_key, power_gt, cadence_gt,
+      hr_zone_bounds, pyramid, binary)
+  return report.encode(), metrics_bytes
@@ -0,0 +1,273 @@
+"""Serve a report shell that loads trace data on demand over HTTP."""
+
+import http.server
+import json
+import os
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+
+from utils import map_activity, metrics, normalize_time, process_files, utils
+
+DEFAULT_PORT = 8000
+DEFAULT_MAX_POINTS = 2000
+MAP_MAX_POINTS = 1000
+
+TRACE_CHANNELS = ('heart_rate', 'distance', 'speed', 'power', 'cadence')
+
+
+def downsample_trace(times, values, max_points):
+  """Reduces a trace to at most max_points while keeping its peaks.
+
+  The trace is split into equal time buckets and the minimum and maximum
+  sample of each bucket are kept, along with the first and last samples.
+
+  Args:
+    times: sorted int64 array of timestamps
+    values: float array of samples, without missing values
+    max_points: the largest number of points to return
+
+  Returns:
+    The indices of the samples to keep.
+  """
+  if len(times) <= max_points:
+    return np.arange(len(times))
+
+  buckets = max((max_points - 2) // 2, 1)
+  edges = np.linspace(times[0], times[-1], buckets + 1)[1:-1]
+  starts = np.unique(np.concatenate(
+      [[0], np.searchsorted(times, edges, side='left')]))
+  starts = starts[starts < len(times)]
+
+  # Position of the min and max within each bucket
+  ends = np.append(starts[1:], len(times))
+  keep = np.empty(2 * len(starts) + 2, dtype=np.int64)
+  keep[-2:] = (0, len(times) - 1)
+  for i, (start, end) in enumerate(zip(starts, ends)):
+    bucket = values[start:end]
+    keep[2 * i] = start + np.argmin(bucket)
+    keep[2 * i + 1] = start + np.argmax(bucket)
+  return np.unique(keep)
+
+
+class ReportData:
+  """The parsed session held in memory and the views served from it."""
+
+  def __init__(self, combined_df, sport, start_time, ground_truth_device,
+               ref_device, unit_of_measure, offsets=None,
+               google_maps_api_key=None, power_gt=None, cadence_gt=None,
+               hr_zone_bounds=None):
+    self.sport = sport
+    self.start_time_string = 'Unknown Time'
+    if start_time is not None:
+      self.start_time_string = utils.to_local_time_string(start_time)
+    self.unit_of_measure = unit_of_measure
+    self.google_maps_api_key = google_maps_api_key
+    self.df = combined_df
+    self.tables = metrics.compute_metrics(
+        combined_df, ground_truth_device, ref_device, unit_of_measure, offsets,
+        power_gt, cadence_gt, hr_zone_bounds=hr_zone_bounds)
+
+    ratio = 1.0
+    labels = {
+        'heart_rate': 'Heart Rate (BPM)',
+        'distance': 'Distance (km)',
+        'speed': 'Speed (km/h)',
+        'power': 'Power (W)',
+        'cadence': 'Cadence (RPM)',
+    }
+    if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
+      ratio = utils.KM_TO_MILE_RATIO
+      labels['distance'] = 'Distance (mi)'
+      labels['speed'] = 'Speed (mph)'
+    self.labels = labels
+
+    # Wall clock times as int64 ms so zoom ranges from the browser compare
+    # directly, and one sorted array per device and channel
+    self.traces = {}
+    columns = {
+        'heart_rate': ('heart_rate', 1.0),
+        'distance': ('calc_distance_meters', ratio / 1000.0),
+        'speed': ('speed_kmh', ratio),
+        'power': ('power_watts', 1.0),
+        'cadence': ('cadence', 1.0),
+    }
+    for channel, (column, scale) in columns.items():
+      self.traces[channel] = {}
+      if column not in combined_df.columns:
+        continue
+      for device, data in combined_df.groupby('device'):
+        data = data.dropna(subset=[column])
+        if data.empty:
+          continue
+        times = data['time'].dt.tz_localize(None).to_numpy()
+        order = np.argsort(times, kind='stable')
+        self.traces[channel][device] = (
+            times[order].astype('datetime64[ms]').astype(np.int64),
+            data[column].to_numpy(dtype=float)[order] * scale,
+        )
+
+  def session(self):
+    """Returns the session summary and metric tables."""
+    return {
+        'sport': self.sport,
+        'start_time': self.start_time_string,
+        'labels': self.labels,
+        'channels': [c for c in TRACE_CHANNELS if self.traces.get(c)],
+        'metrics': metrics.metrics_records(self.tables),
+    }
+
+  def trace(self, channel, start=None, end=None,
+            max_points=DEFAULT_MAX_POINTS):
+    """Returns each device's samples of a channel within a time range.
+
+    Args:
+      channel: one of TRACE_CHANNELS
+      start: start of the range in wall clock ms, from the first sample when
+             not set
+      end: end of the range in wall clock ms, to the last sample when not set
+      max_points: the largest number of points returned per device
+
+    Returns:
+      A dict of device to its x (ISO wall clock times) and y values.
+    """
+    result = {}
+    for device, (times, values) in self.traces.get(channel, {}).items():
+      lower = 0 if start is None else np.searchsorted(times, start, 'left')
+      upper = len(times) if end is None else np.searchsorted(
+          times, end, 'right')
+      # Include one sample either side so lines reach the plot edges
+      lower = max(lower - 1, 0)
+      upper = min(upper + 1, len(times))
+      window_times = times[lower:upper]
+      window_values = values[lower:upper]
+      keep = downsample_trace(window_times, window_values, max_points)
+      result[device] = {
+          'x': np.datetime_as_string(
+              window_times[keep].astype('datetime64[ms]')).tolist(),
+          'y': np.round(window_values[keep], 4).tolist(),
+      }
+    return result
+
+  def map_html(self):
+    """Returns the map of the session with a bounded number of points."""
+    sampled = []
+    for _, data in self.df.groupby('device'):
+      step = max(len(data) // MAP_MAX_POINTS, 1)
+      sampled.append(data.iloc[::step])
+    return map_activity.map_activity(
+        pd.concat(sampled), self.sport, self.google_maps_api_key,
+        self.unit_of_measure)
+
+
+def _parse_time(value):
+  if not value:
+    return None
+  try:
+    return int(pd.Timestamp(value).value // 1_000_000)
+  except ValueError:
+    return None
+
+
+def make_handler(report):
+  """Creates a request handler class serving the given ReportData."""
+
+  shell_path = os.path.join(os.path.dirname(__file__), 'html',
+                            'report_shell.html')
+
+  class ReportHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the report shell and its JSON endpoints."""
+
+    def _send(self, body, content_type, status=200):
+      body = body.encode('utf-8')
+      self.send_response(status)
+      self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def _send_json(self, value, status=200):
+      self._send(json.dumps(value), 'application/json', status)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+      url = urllib.parse.urlparse(self.path)
+      query = urllib.parse.parse_qs(url.query)
+
+      def param(name):
+        return query.get(name, [None])[0]
+
+      if url.path == '/':
+        with open(shell_path, 'r') as f:
+          shell = f.read()
+        self._send(shell.replace('{title}', f'{report.sport} - '
+                                 f'{report.start_time_string}'), 'text/html')
+      elif url.path == '/api/session':
+        self._send_json(report.session())
+      elif url.path == '/api/trace':
+        channel = param('channel')
+        if channel not in TRACE_CHANNELS:
+          self._send_json({'error': f'unknown channel: {channel}'}, 400)
+          return
+        try:
+          max_points = int(param('points') or DEFAULT_MAX_POINTS)
+        except ValueError:
+          max_points = DEFAULT_MAX_POINTS
+        self._send_json(report.trace(
+            channel, _parse_time(param('start')), _parse_time(param('end')),
+            max(max_points, 2)))
+      elif url.path == '/map':
+        self._send(report.map_html() or 'No gps data found', 'text/html')
+      else:
+        self._send_json({'error': 'not found'}, 404)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+      pass
+
+  return ReportHandler
+
+
+def serve_report(folder_path, google_maps_api_key, ground_truth_device,
+                 ref_device, unit_of_measure, port=DEFAULT_PORT,
+                 analysis_options=None, power_gt=None, cadence_gt=None,
+                 hr_zone_bounds=None, duplicates=None):
+  """Parses a session once and serves it until interrupted.
+
+  Args:
+    folder_path: Folder containing the data files
+    google_maps_api_key: Required for the map output to render
+    ground_truth_device:  the string used to determine GT device
+    ref_device:  the string used to determine the ref device
+    unit_of_measure:  imperial or metric
+    port: the local port to listen on
+    analysis_options: optional keyword arguments for analyze_session
+    power_gt: the string used to determine the power GT device
+              (default: ground_truth_device)
+    cadence_gt: the string used to determine the cadence GT device
+                (default: ground_truth_device)
+    hr_zone_bounds: the lower bound in BPM of each heart rate zone
+                    (default: hr_zones.zone_bounds())
+    duplicates: how repeated timestamps are resolved, see
+                normalize_time.DUPLICATE_POLICIES
+  """
+  combined_df, sport, start_time = process_files.load_session(
+      process_files.find_data_files(folder_path),
+      duplicates=duplicates or normalize_time.DEFAULT_DUPLICATE_POLICY)
+  combined_df, offsets = process_files.analyze_session(
+      combined_df, ground_truth_device, ref_device,
+      **(analysis_options or {}))
+  report = ReportData(combined_df, sport, start_time, ground_truth_device,
+                      ref_device, unit_of_measure, offsets,
+                      google_maps_api_key, power_gt, cadence_gt,
+                      hr_zone_bounds)
+
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', port),
+                                           make_handler(report))
+  print(f'Serving report on http://127.0.0.1:{server.server_port}/ '
+        '(Ctrl+C to stop)')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
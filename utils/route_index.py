@@ -0,0 +1,212 @@
+"""Find catalogued sessions that ride the same route and compare them."""
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import spatial
+
+from utils import catalog, geohash, normalize_time, process_files, session_store, stationary, track_accuracy, utils
+
+# Fixes further than this from the route are off the route
+DEFAULT_MATCH_METERS = 25.0
+# Runs of fewer on route fixes are crossings, not shared segments
+MIN_SEGMENT_POINTS = 10
+# A longer time without a fix on the route starts a new segment
+MAX_GAP_SECONDS = 30
+
+
+def parse_segment(text, unit_of_measure):
+  """Parses a 'start,end' route segment in km, or mi with IMPERIAL.
+
+  Returns:
+    A tuple of the start and end distances in meters.
+  """
+  ratio = 1.0
+  if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
+    ratio = utils.KM_TO_MILE_RATIO
+  start, end = (float(value) * 1000 / ratio for value in text.split(','))
+  if end <= start:
+    raise ValueError(f'the route segment must end after it starts: {text}')
+  return start, end
+
+
+def route_track(df, segment=None):
+  """Returns the GPS fixes of a route, optionally a part of it.
+
+  Args:
+    df: the DataFrame of a single file, see process_files.load_file
+    segment: optional (start, end) distances in meters along the route
+
+  Returns:
+    A DataFrame of latitude, longitude and calc_distance_meters.
+  """
+  if 'latitude' not in df.columns:
+    raise ValueError('The route has no GPS track')
+  route = df[['latitude', 'longitude', 'calc_distance_meters']].dropna()
+  if segment is not None:
+    start, end = segment
+    along = route['calc_distance_meters']
+    route = route[(along >= start) & (along <= end)]
+  if len(route) < 2:
+    raise ValueError('The route segment has fewer than 2 GPS fixes')
+  return route.reset_index(drop=True)
+
+
+def match_segments(route, df, match_meters=DEFAULT_MATCH_METERS,
+                   min_points=MIN_SEGMENT_POINTS,
+                   max_gap=MAX_GAP_SECONDS):
+  """Finds the runs of a track that follow the route.
+
+  Only the fixes in a cell of the route, or next to one, are measured
+  against it.  A run ends when no fix is on the route for longer than
+  max_gap, eg. at a turn off the route or a pause, or at a jump back to the
+  other end of the route, so each lap of a loop is a segment of its own.
+
+  Args:
+    route: the route fixes, see route_track
+    df: the DataFrame of a single file with latitude, longitude and time
+    match_meters: largest distance of a fix from the route
+    min_points: fewest fixes of a segment
+    max_gap: longest time in seconds without a fix on the route within a
+             segment
+
+  Returns:
+    A list of (fixes, nearest route fix) tuples, the positions of the fixes
+    of each segment in df and the index of the route fix nearest each.
+  """
+  latitude = df['latitude'].to_numpy(dtype=float)
+  longitude = df['longitude'].to_numpy(dtype=float)
+  cells = geohash.track_cells(route['latitude'], route['longitude'],
+                              neighbours=True)
+  candidates = np.flatnonzero(
+      np.isin(geohash.encode(latitude, longitude), cells)
+      & ~np.isnan(latitude) & ~np.isnan(longitude))
+  if len(candidates) < min_points:
+    return []
+
+  origin_lat = route['latitude'].mean()
+  origin_long = route['longitude'].mean()
+  route_xy = track_accuracy.to_local_xy(
+      route['latitude'], route['longitude'], origin_lat, origin_long)
+  xy = track_accuracy.to_local_xy(latitude[candidates],
+                                  longitude[candidates], origin_lat,
+                                  origin_long)
+  errors = track_accuracy.cross_track_error(route_xy, xy)
+  _, nearest = spatial.cKDTree(route_xy).query(xy)
+  on_route = errors <= match_meters
+  fixes = candidates[on_route]
+  nearest = nearest[on_route]
+  if len(fixes) < min_points:
+    return []
+
+  seconds = (df['time'].iloc[fixes] - df['time'].iloc[fixes[0]])
+  seconds = seconds.dt.total_seconds().to_numpy()
+  breaks = ((np.diff(seconds) > max_gap)
+            | (np.abs(np.diff(nearest)) > len(route) // 2))
+  starts = np.concatenate([[0], np.flatnonzero(breaks) + 1, [len(fixes)]])
+  return [(fixes[start:end], nearest[start:end])
+          for start, end in zip(starts[:-1], starts[1:])
+          if end - start >= min_points]
+
+
+def segment_metrics(route, df, segments, unit_of_measure):
+  """Measures the distance and speed of each segment vs the route.
+
+  Args:
+    route: the route fixes, see route_track
+    df: the DataFrame of the file the segments were found in
+    segments: the segments, see match_segments
+    unit_of_measure: IMPERIAL or METRIC
+
+  Returns:
+    A list of dicts, one per segment.
+  """
+  ratio = 1.0
+  if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
+    ratio = utils.KM_TO_MILE_RATIO
+  route_along = route['calc_distance_meters'].to_numpy()
+  distance = df['calc_distance_meters'].to_numpy(dtype=float)
+  times = df['time']
+
+  rows = []
+  for fixes, nearest in segments:
+    first, last = nearest.min(), nearest.max()
+    route_meters = route_along[last] - route_along[first]
+    meters = distance[fixes[-1]] - distance[fixes[0]]
+    seconds = (times.iloc[fixes[-1]] - times.iloc[fixes[0]]).total_seconds()
+    start = times.iloc[fixes[0]]
+    if start.tzinfo is not None:
+      start = start.tz_convert('UTC').tz_localize(None)
+    heart_rate = pd.to_numeric(df['heart_rate'].iloc[fixes], errors='coerce')
+    rows.append({
+        'Start': utils.to_local_time_string(start.to_pydatetime()),
+        'Coverage': round((last - first + 1) / len(route) * 100.0, 1),
+        'RouteDistance': round(route_meters / 1000 * ratio, 3),
+        'Distance': round(meters / 1000 * ratio, 3),
+        'DistanceError': (round((meters - route_meters) / route_meters
+                                * 100.0, 2) if route_meters else None),
+        'Duration': stationary.format_duration(seconds),
+        'AvgSpeed': (round(meters / 1000 * ratio / (seconds / 3600), 2)
+                     if seconds else None),
+        'AvgHR': round(heart_rate.mean(), 1) if heart_rate.notna().any()
+                 else None,
+    })
+  return rows
+
+
+def compare_route(catalog_path, route_path, unit_of_measure, segment=None,
+                  sport=None, device=None, since=None, until=None,
+                  match_meters=DEFAULT_MATCH_METERS, cache_dir=None,
+                  store_path=None,
+                  duplicates=normalize_time.DEFAULT_DUPLICATE_POLICY):
+  """Compares every catalogued track that rides the route of a file.
+
+  The candidate files are looked up by the geohash cells of the route in
+  the catalog's cells index, so only files sharing a cell with the route
+  are read.
+
+  Args:
+    catalog_path: the catalog database, see process_files.index_folder
+    route_path: the TCX/GPX file of the route
+    unit_of_measure: IMPERIAL or METRIC
+    segment: optional (start, end) distances in meters of the part of the
+             route to compare
+    sport: exact sport of the compared activities, eg. Biking
+    device: text contained in the device of the compared activities
+    since: compare activities starting on or after this UTC date
+    until: compare activities starting before this UTC date
+    match_meters: largest distance of a fix from the route
+    cache_dir: optional folder of cached parses to reuse
+    store_path: optional session store folder to read the files from
+    duplicates: how repeated timestamps are resolved, see
+                normalize_time.DUPLICATE_POLICIES
+
+  Returns:
+    A DataFrame with a row per segment of each file following the route,
+    ordered by start time.
+  """
+  store = None
+  if store_path:
+    store = session_store.SessionStore(store_path, read_only=True)
+  route_df, _, _ = process_files.load_file(route_path, cache_dir,
+                                           store=store, duplicates=duplicates)
+  route = route_track(route_df, segment)
+  cells = geohash.track_cells(route['latitude'], route['longitude'],
+                              neighbours=True)
+  activities = catalog.query_activities(catalog_path, sport, device, since,
+                                        until, cells)
+
+  rows = []
+  route_path = os.path.abspath(route_path)
+  for activity in activities:
+    if activity['path'] == route_path:
+      continue
+    df, _, _ = process_files.load_file(activity['path'], cache_dir,
+                                       store=store, duplicates=duplicates)
+    if 'latitude' not in df.columns:
+      continue
+    segments = match_segments(route, df, match_meters)
+    for row in segment_metrics(route, df, segments, unit_of_measure):
+      rows.append({'Device': activity['device'], **row,
+                   'File': activity['path']})
+  return pd.DataFrame(rows)
@@ -0,0 +1,274 @@
+"""Append-only columnar store of parsed data files, memory-mapped on read."""
+
+import csv
+import datetime as dt
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils import elevation
+
+INDEX_FILENAME = 'index.csv'
+INDEX_FIELDS = ('hash', 'path', 'device', 'sport', 'start_time', 'offset',
+                'length')
+# Columns added to an existing store and the first row they were stored for
+ADDED_COLUMNS_FILENAME = 'added_columns.csv'
+
+# Column name and the dtype of its raw file, times are int64 UTC nanoseconds
+STORE_COLUMNS = {
+    'time': np.int64,
+    'latitude': np.float64,
+    'longitude': np.float64,
+    'heart_rate': np.float64,
+    'alt_meters': np.float64,
+    'calc_distance_meters': np.float64,
+    'speed_kmh': np.float64,
+    'elevation_meters': np.float64,
+    'grade_percent': np.float64,
+    'vertical_speed_mh': np.float64,
+    'power_watts': np.float64,
+    'cadence': np.float64,
+    'activity': np.float64,
+    'lap': np.float64,
+}
+
+
+class SessionStore:
+  """Columns of every stored file appended end to end in raw binary files.
+
+  Each stored file is a segment of rows at an offset in every column, listed
+  in the index.  Reads memory-map the column files, so slicing a segment
+  reads only its pages.  Only one process may append at a time; a column
+  row written without its index line (eg. an interrupted append) is never
+  read.
+
+  Attributes:
+    store_dir: the folder of the column and index files
+    read_only: True if files missing from the store are not appended, eg. in
+               parallel workers
+  """
+
+  def __init__(self, store_dir, read_only=False):
+    self.store_dir = store_dir
+    self.read_only = read_only
+    self._index = None
+    self._columns = None
+
+  def _column_path(self, column):
+    dtype = np.dtype(STORE_COLUMNS[column])
+    return os.path.join(self.store_dir,
+                        f'{column}.{dtype.kind}{dtype.itemsize}')
+
+  def index(self):
+    """Returns the segment index as a DataFrame, one row per stored file."""
+    if self._index is None:
+      index_path = os.path.join(self.store_dir, INDEX_FILENAME)
+      if os.path.exists(index_path):
+        self._index = pd.read_csv(index_path, keep_default_na=False,
+                                  dtype={'sport': str, 'start_time': str})
+      else:
+        self._index = pd.DataFrame(columns=list(INDEX_FIELDS))
+    return self._index
+
+  def find(self, file_hash):
+    """Returns the index row of the file content, None if not stored.
+
+    Files stored before a column was added are not found, so they are parsed
+    and appended again with every column.
+    """
+    index = self.index()
+    rows = index[index['hash'] == file_hash]
+    if rows.empty:
+      return None
+    row = rows.iloc[-1]
+    stored_rows = min(len(values) for values in self.columns().values())
+    if int(row['offset']) + int(row['length']) > stored_rows:
+      return None
+    if int(row['offset']) < max(self._added_columns().values(), default=0):
+      return None
+    return row
+
+  def _added_columns(self):
+    path = os.path.join(self.store_dir, ADDED_COLUMNS_FILENAME)
+    if not os.path.exists(path):
+      return {}
+    with open(path, newline='') as f:
+      return {column: int(first_row) for column, first_row in csv.reader(f)}
+
+  def select(self, sport=None, device=None, since=None, until=None):
+    """Returns the index rows of the stored files matching every filter.
+
+    Args:
+      sport: exact sport name, eg. Biking
+      device: case insensitive text contained in the device label
+      since: include files starting on or after this ISO date/time (UTC)
+      until: include files starting before this ISO date/time (UTC)
+    """
+    index = self.index()
+    keep = pd.Series(True, index=index.index)
+    if sport:
+      keep &= index['sport'] == sport
+    if device:
+      keep &= index['device'].str.lower().str.contains(device.lower(),
+                                                       regex=False)
+    if since:
+      keep &= (index['start_time'] != '') & (index['start_time'] >= since)
+    if until:
+      keep &= (index['start_time'] != '') & (index['start_time'] < until)
+    return [row for _, row in index[keep].iterrows()]
+
+  def columns(self):
+    """Returns a read-only memory map of each column file."""
+    if self._columns is None:
+      self._columns = {}
+      for column, dtype in STORE_COLUMNS.items():
+        path = self._column_path(column)
+        if os.path.exists(path) and os.path.getsize(path):
+          self._columns[column] = np.memmap(path, dtype=dtype, mode='r')
+        else:
+          self._columns[column] = np.empty(0, dtype=dtype)
+    return self._columns
+
+  def append(self, file_path, file_hash, device, sport, start_time, df):
+    """Appends the rows of a parsed data file.
+
+    Args:
+      file_path: The file path of the TCX or GPX file
+      file_hash: the hash of the file content, used to find it again
+      device: the device label used in the reports
+      sport: the sport of the activity
+      start_time: the start time of the activity as a naive UTC datetime
+      df: the DataFrame from process_files.load_file
+    """
+    os.makedirs(self.store_dir, exist_ok=True)
+    times = df['time']
+    if times.dt.tz is not None:
+      times = times.dt.tz_convert('UTC').dt.tz_localize(None)
+    values = {'time': times.to_numpy(dtype='datetime64[ns]').view(np.int64)}
+    for column in STORE_COLUMNS:
+      if column in df.columns:
+        values.setdefault(
+            column, pd.to_numeric(df[column], errors='coerce').to_numpy(
+                dtype=float, na_value=np.nan))
+    if 'latitude' not in values and 'position' in df.columns:
+      for column, key in (('latitude', 'lat'), ('longitude', 'long')):
+        values[column] = pd.to_numeric(
+            df['position'].map(lambda pos, key=key: pos.get(key)),
+            errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+
+    # Every column file holds the same number of rows once the append ends
+    path = self._column_path('time')
+    offset = os.path.getsize(path) // 8 if os.path.exists(path) else 0
+    for column, dtype in STORE_COLUMNS.items():
+      column_values = values.get(column)
+      if column_values is None:
+        column_values = np.full(len(df), np.nan)
+      column_path = self._column_path(column)
+      size = os.path.getsize(column_path) if os.path.exists(column_path) else 0
+      itemsize = np.dtype(dtype).itemsize
+      with open(column_path, 'ab') as f:
+        if size < offset * itemsize:
+          # A column added since the earlier appends, missing in their rows
+          f.write(np.full(offset - size // itemsize, np.nan,
+                          dtype=dtype).tobytes())
+          with open(os.path.join(self.store_dir, ADDED_COLUMNS_FILENAME), 'a',
+                    newline='') as added:
+            csv.writer(added).writerow([column, offset])
+        f.seek(offset * itemsize)
+        f.truncate()
+        f.write(np.ascontiguousarray(column_values, dtype=dtype).tobytes())
+
+    index_path = os.path.join(self.store_dir, INDEX_FILENAME)
+    new_index = not os.path.exists(index_path)
+    with open(index_path, 'a', newline='') as f:
+      writer = csv.writer(f)
+      if new_index:
+        writer.writerow(INDEX_FIELDS)
+      writer.writerow([
+          file_hash, file_path, device, sport or '',
+          start_time.isoformat() if start_time else '', offset, len(df)])
+    self._index = None
+    self._columns = None
+
+  def frame(self, segments):
+    """Slices stored segments into a single DataFrame.
+
+    Segments stored next to each other are sliced as one range, so a single
+    segment or a run of consecutive ones is a view of the memory maps
+    without copying.
+
+    Args:
+      segments: index rows from index() or find()
+
+    Returns:
+      A DataFrame of the store columns and a 'device' column, with times as
+      UTC timestamps.
+    """
+    columns = self.columns()
+    ranges = []
+    for offset, length, device in sorted(
+        (int(s['offset']), int(s['length']), s['device']) for s in segments):
+      if ranges and ranges[-1][1] == offset:
+        ranges[-1][1] = offset + length
+        ranges[-1][2].append((device, length))
+      else:
+        ranges.append([offset, offset + length, [(device, length)]])
+
+    parts = []
+    for start, end, devices in ranges:
+      data = {}
+      for column, values in columns.items():
+        data[column] = values[start:end]
+        if len(data[column]) < end - start:
+          # A column added since these rows were appended
+          data[column] = np.concatenate(
+              [data[column], np.full(end - start - len(data[column]), np.nan)])
+      data['time'] = pd.DatetimeIndex(
+          data['time'].view('datetime64[ns]')).tz_localize('UTC')
+      part = pd.DataFrame(data, copy=False)
+      codes, labels = pd.factorize(
+          np.array([device for device, _ in devices], dtype=object))
+      part['device'] = pd.Categorical.from_codes(
+          np.repeat(codes, [length for _, length in devices]), labels)
+      parts.append(part)
+    if len(parts) == 1:
+      return parts[0]
+    return pd.concat(parts, ignore_index=True)
+
+
+def to_positions(df):
+  """Rebuilds the parser's position column from latitude and longitude."""
+  return [
+      {'lat': None if np.isnan(lat) else lat,
+       'long': None if np.isnan(lon) else lon}
+      for lat, lon in zip(df['latitude'].to_numpy(),
+                          df['longitude'].to_numpy())
+  ]
+
+
+def load_stored_file(store, segment):
+  """Returns a stored file as the (DataFrame, sport, start time) of a parse.
+
+  The DataFrame matches process_files.load_file, including the position
+  column used by the map.  The sport of each activity is not stored, the
+  activities take the sport of the file.
+  """
+  df = store.frame([segment]).copy()
+  df['device'] = df['device'].astype(str)
+  df['position'] = to_positions(df)
+  # The parsers leave missing altitudes as None
+  df['alt_meters'] = df['alt_meters'].astype(object).where(
+      df['alt_meters'].notna(), None)
+  # The activity and lap indices are stored as floats
+  for column in ('activity', 'lap'):
+    df[column] = df[column].fillna(0).astype(np.int64)
+  if np.isnan(df['elevation_meters'].to_numpy()).all():
+    df = df.drop(columns=list(elevation.ELEVATION_COLUMNS))
+  if np.isnan(df['calc_distance_meters'].to_numpy()).all():
+    df = df.drop(columns=['latitude', 'longitude', 'calc_distance_meters',
+                          'speed_kmh'])
+  start_time = None
+  if segment['start_time']:
+    start_time = dt.datetime.fromisoformat(segment['start_time'])
+  return df, segment['sport'] or None, start_time
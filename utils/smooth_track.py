@@ -0,0 +1,188 @@
+"""Smooth GPS tracks with a constant velocity Kalman filter and RTS pass."""
+
+import numpy as np
+import pandas as pd
+
+from utils import calc_distance, calc_speed, elevation, track_accuracy
+
+# Standard deviation of a GPS fix in meters
+DEFAULT_GPS_NOISE_METERS = 5.0
+# Spectral density of the white noise acceleration in m^2/s^3, larger
+# values follow changes of speed more closely
+DEFAULT_ACCEL_NOISE = 1.0
+# Variance of the unknown speed at the first fix in (m/s)^2
+INITIAL_SPEED_VARIANCE = 100.0
+
+
+def kalman_rts(z, dt, valid, gps_noise=DEFAULT_GPS_NOISE_METERS,
+               accel_noise=DEFAULT_ACCEL_NOISE):
+  """Smooths a batch of position series with a constant velocity model.
+
+  Every series is filtered forward with a Kalman filter and then smoothed
+  backward with the Rauch-Tung-Striebel pass.  Each step updates the whole
+  batch at once, with the 2x2 state covariances written out per element.
+
+  Args:
+    z: (b, n) array of measured positions in meters, one series per row
+    dt: (b, n) array of seconds since the previous sample of each series
+    valid: (b, n) boolean array, False for the padding after a series ends
+    gps_noise: standard deviation of a measured position in meters
+    accel_noise: spectral density of the white noise acceleration
+
+  Returns:
+    A (b, n) array of smoothed positions, padding left as the last position.
+  """
+  b, n = z.shape
+  r = gps_noise ** 2
+  dt = np.where(valid, dt, 0.0)
+  dt[:, 0] = 0.0
+
+  # Filtered and predicted position, speed and covariance [[a, c], [c, d]]
+  filtered = np.empty((5, b, n))
+  predicted = np.empty((5, b, n))
+  pos, vel = z[:, 0].astype(float), np.zeros(b)
+  p00, p01 = np.full(b, r), np.zeros(b)
+  p11 = np.full(b, INITIAL_SPEED_VARIANCE)
+  predicted[:, :, 0] = pos, vel, p00, p01, p11
+  filtered[:, :, 0] = pos, vel, p00, p01, p11
+
+  for k in range(1, n):
+    step = dt[:, k]
+    q = accel_noise * step
+    pos = pos + step * vel
+    p00 = p00 + step * (2 * p01 + step * p11) + q * step ** 2 / 3
+    p01 = p01 + step * p11 + q * step / 2
+    p11 = p11 + q
+    predicted[:, :, k] = pos, vel, p00, p01, p11
+
+    # Padding has no measurement, its prediction is kept
+    gain0 = np.where(valid[:, k], p00 / (p00 + r), 0.0)
+    gain1 = np.where(valid[:, k], p01 / (p00 + r), 0.0)
+    residual = np.where(valid[:, k], z[:, k] - pos, 0.0)
+    pos = pos + gain0 * residual
+    vel = vel + gain1 * residual
+    p11 = p11 - gain1 * p01
+    p01 = (1 - gain0) * p01
+    p00 = (1 - gain0) * p00
+    filtered[:, :, k] = pos, vel, p00, p01, p11
+
+  smoothed_pos = filtered[0].copy()
+  smoothed_vel = filtered[1].copy()
+  for k in range(n - 2, -1, -1):
+    step = dt[:, k + 1]
+    f_pos, f_vel, a, c, d = filtered[:, :, k]
+    p_pos, p_vel, pa, pc, pd_ = predicted[:, :, k + 1]
+    # Gain G = P F^T inv(P_predicted), with F = [[1, step], [0, 1]]
+    m00, m01 = a + step * c, c
+    m10, m11 = c + step * d, d
+    det = pa * pd_ - pc ** 2
+    g00 = (m00 * pd_ - m01 * pc) / det
+    g01 = (m01 * pa - m00 * pc) / det
+    g10 = (m10 * pd_ - m11 * pc) / det
+    g11 = (m11 * pa - m10 * pc) / det
+    d_pos = smoothed_pos[:, k + 1] - p_pos
+    d_vel = smoothed_vel[:, k + 1] - p_vel
+    smoothed_pos[:, k] = f_pos + g00 * d_pos + g01 * d_vel
+    smoothed_vel[:, k] = f_vel + g10 * d_pos + g11 * d_vel
+  return smoothed_pos
+
+
+def smooth_tracks(combined_df, gps_noise=DEFAULT_GPS_NOISE_METERS,
+                  accel_noise=DEFAULT_ACCEL_NOISE,
+                  distance_model=calc_distance.DEFAULT_DISTANCE_MODEL,
+                  altitude=False):
+  """Replaces each device's GPS track with its smoothed track.
+
+  The tracks of every device are smoothed together in local metric
+  coordinates, one batch row per device and axis.  Distance and speed are
+  then derived from the smoothed positions again.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    gps_noise: standard deviation of a GPS fix in meters
+    accel_noise: spectral density of the white noise acceleration
+    distance_model: the model the smoothed distance is measured with, see
+                    calc_distance.DISTANCE_MODELS
+    altitude: include the climb between points from alt_meters
+
+  Returns:
+    A copy of the DataFrame with smoothed position, latitude, longitude,
+    calc_distance_meters, speed_kmh and grade_percent, and the distance of
+    the recorded fixes in raw_distance_meters.  Devices without GPS are left
+    as is.
+  """
+  df = combined_df.copy()
+  if 'calc_distance_meters' not in df.columns:
+    return df
+  df['raw_distance_meters'] = df['calc_distance_meters']
+
+  has_track = df['calc_distance_meters'].notnull().to_numpy()
+  tracks = []
+  times = df['time'].to_numpy()
+  for positions in df.groupby('device').indices.values():
+    positions = positions[has_track[positions]]
+    if len(positions) > 1:
+      # The filter runs forward in time
+      tracks.append(positions[np.argsort(times[positions], kind='stable')])
+  if not tracks:
+    return df
+
+  latitude = df['latitude'].to_numpy(dtype=float, copy=True)
+  longitude = df['longitude'].to_numpy(dtype=float, copy=True)
+  seconds = (df['time'] - df['time'].min()).dt.total_seconds().to_numpy()
+  length = max(len(positions) for positions in tracks)
+  z = np.zeros((2 * len(tracks), length))
+  dt = np.zeros((2 * len(tracks), length))
+  valid = np.zeros((2 * len(tracks), length), dtype=bool)
+  origins = []
+  for i, positions in enumerate(tracks):
+    origin = (latitude[positions].mean(), longitude[positions].mean())
+    origins.append(origin)
+    xy = track_accuracy.to_local_xy(latitude[positions],
+                                    longitude[positions], *origin)
+    size = len(positions)
+    for axis in (0, 1):
+      z[2 * i + axis, :size] = xy[:, axis]
+      dt[2 * i + axis, 1:size] = np.diff(seconds[positions])
+      valid[2 * i + axis, :size] = True
+
+  smoothed = kalman_rts(z, dt, valid, gps_noise, accel_noise)
+
+  distance = df['calc_distance_meters'].to_numpy(dtype=float, copy=True)
+  alt = None
+  if altitude and 'alt_meters' in df.columns:
+    alt = pd.to_numeric(df['alt_meters'], errors='coerce').to_numpy()
+  for i, positions in enumerate(tracks):
+    size = len(positions)
+    track_lat, track_long = track_accuracy.from_local_xy(
+        smoothed[2 * i, :size], smoothed[2 * i + 1, :size], *origins[i])
+    latitude[positions] = track_lat
+    longitude[positions] = track_long
+    steps = calc_distance.distance_steps(
+        track_lat, track_long, distance_model,
+        None if alt is None else alt[positions])
+    distance[positions] = np.concatenate([[0.0], np.cumsum(steps)])
+
+  df['latitude'] = latitude
+  df['longitude'] = longitude
+  df['calc_distance_meters'] = distance
+  positions_column = df['position'].tolist()
+  for row in np.concatenate(tracks):
+    positions_column[row] = {'lat': latitude[row], 'long': longitude[row]}
+  df['position'] = positions_column
+
+  speeds = df['speed_kmh'].to_numpy(dtype=float, copy=True)
+  grade = None
+  if 'grade_percent' in df.columns:
+    smoothed_alt = df['elevation_meters'].to_numpy(dtype=float)
+    grade = df['grade_percent'].to_numpy(dtype=float, copy=True)
+  for positions in tracks:
+    track = df.iloc[positions][['time', 'calc_distance_meters']]
+    speeds[positions] = calc_speed.calc_speed(track).to_numpy(dtype=float)
+    if grade is not None:
+      grade[positions] = elevation.track_grade(
+          seconds[positions], smoothed_alt[positions], distance[positions])
+  df['speed_kmh'] = speeds
+  if grade is not None:
+    df['grade_percent'] = grade
+  return df
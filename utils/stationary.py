@@ -0,0 +1,156 @@
+"""Classify samples as moving or stationary and trim the stationary runs."""
+import numpy as np
+import pandas as pd
+
+from utils import track_accuracy
+
+# Samples are stationary when the median speed over a centered window is
+# below MIN_SPEED_KMH, or the track moves less than MIN_DISPLACEMENT_METERS
+# across the window
+DEFAULT_WINDOW_SECONDS = 30
+DEFAULT_MIN_SPEED_KMH = 2.0
+DEFAULT_MIN_DISPLACEMENT_METERS = 10.0
+# Gaps between samples longer than this are recorder pauses, not moving time
+DEFAULT_PAUSE_GAP_SECONDS = 10
+
+# keep: only classify, drop: remove the stationary samples, collapse: keep
+# the first and last sample of each stationary run
+STATIONARY_MODES = ('keep', 'drop', 'collapse')
+
+
+def rolling_stationary(times, speeds, x, y, window_seconds, min_speed,
+                       min_displacement):
+  """Flags the samples of a single track recorded while stationary.
+
+  Args:
+    times: the sorted timestamps of the samples
+    speeds: the speed of each sample in km/h
+    x: east offset of each sample in meters, see track_accuracy.to_local_xy
+    y: north offset of each sample in meters
+    window_seconds: width of the centered rolling window in seconds
+    min_speed: median speed in km/h below which the window is stationary
+    min_displacement: extent in meters below which the window is stationary
+
+  Returns:
+    A boolean numpy array marking the stationary samples.
+  """
+  index = pd.DatetimeIndex(times)
+  window = f'{window_seconds}s'
+  frame = pd.DataFrame({'speed': np.asarray(speeds, dtype=float),
+                        'x': x, 'y': y}, index=index)
+  rolling = frame.rolling(window, center=True, min_periods=1)
+  median_speed = rolling['speed'].median()
+  extent = np.hypot(rolling['x'].max() - rolling['x'].min(),
+                    rolling['y'].max() - rolling['y'].min())
+  return ((median_speed < min_speed) | (extent < min_displacement)).to_numpy()
+
+
+def classify_moving(combined_df, ref_device,
+                    window_seconds=DEFAULT_WINDOW_SECONDS,
+                    min_speed=DEFAULT_MIN_SPEED_KMH,
+                    min_displacement=DEFAULT_MIN_DISPLACEMENT_METERS,
+                    pause_gap=DEFAULT_PAUSE_GAP_SECONDS):
+  """Marks every sample of every device as moving or stationary.
+
+  Devices with a GPS track are classified from their own speed and track.
+  Devices without one, eg. a chest strap, take the class of the nearest
+  sample of the ref device, or of the GPS device with the most samples.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    ref_device: the string used to determine the ref device
+    window_seconds: width of the centered rolling window in seconds
+    min_speed: median speed in km/h below which a sample is stationary
+    min_displacement: track extent in meters over the window below which a
+                      sample is stationary
+    pause_gap: seconds without a sample of the device that was classified
+               before samples without a track are left as moving
+
+  Returns:
+    A copy of the DataFrame sorted by device and time with a boolean moving
+    column.
+  """
+  df = combined_df.sort_values(['device', 'time'], kind='stable')
+  df = df.reset_index(drop=True)
+  moving = np.ones(len(df), dtype=bool)
+  classified = np.zeros(len(df), dtype=bool)
+
+  if 'speed_kmh' in df.columns and 'latitude' in df.columns:
+    has_track = (df['speed_kmh'].notnull() & df['latitude'].notnull()
+                 & df['longitude'].notnull()).to_numpy()
+    latitude = df['latitude'].to_numpy(dtype=float)
+    longitude = df['longitude'].to_numpy(dtype=float)
+    for positions in df.groupby('device').indices.values():
+      positions = positions[has_track[positions]]
+      if not len(positions):
+        continue
+      xy = track_accuracy.to_local_xy(
+          latitude[positions], longitude[positions],
+          latitude[positions].mean(), longitude[positions].mean())
+      data = df.iloc[positions]
+      moving[positions] = ~rolling_stationary(
+          data['time'], data['speed_kmh'], xy[:, 0], xy[:, 1],
+          window_seconds, min_speed, min_displacement)
+      classified[positions] = True
+
+  if classified.any() and not classified.all():
+    counts = df.loc[classified, 'device'].value_counts()
+    is_ref = counts.index.str.contains(ref_device, case=False, regex=False)
+    source = counts[is_ref].index[0] if is_ref.any() else counts.index[0]
+    is_source = classified & (df['device'] == source).to_numpy()
+    reference = pd.DataFrame({'time': df.loc[is_source, 'time'],
+                              'source_moving': moving[is_source]})
+    pending = df.loc[~classified, ['time']].reset_index()
+    matched = pd.merge_asof(
+        pending.sort_values('time'), reference, on='time',
+        direction='nearest', tolerance=pd.Timedelta(seconds=pause_gap))
+    matched = matched.dropna(subset=['source_moving'])
+    moving[matched['index'].to_numpy()] = (
+        matched['source_moving'].to_numpy(dtype=bool))
+
+  df['moving'] = moving
+  return df
+
+
+def moving_seconds(data, pause_gap=DEFAULT_PAUSE_GAP_SECONDS):
+  """Returns the moving time in seconds of a single device's samples.
+
+  Every interval ending at a moving sample counts, unless it is longer than
+  pause_gap.  Without a moving column every sample counts as moving.
+  """
+  times = data['time'].sort_values()
+  intervals = times.diff().dt.total_seconds().to_numpy()[1:]
+  counted = intervals <= pause_gap
+  if 'moving' in data.columns:
+    counted &= data['moving'].reindex(times.index).to_numpy(dtype=bool)[1:]
+  return float(intervals[counted].sum())
+
+
+def format_duration(seconds):
+  """Formats seconds as H:MM:SS."""
+  minutes, seconds = divmod(int(round(seconds)), 60)
+  hours, minutes = divmod(minutes, 60)
+  return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+
+def trim_stationary(combined_df, mode):
+  """Drops or collapses the stationary runs of every device.
+
+  Args:
+    combined_df: A DataFrame with a moving column, see classify_moving
+    mode: one of STATIONARY_MODES
+
+  Returns:
+    The DataFrame without the trimmed samples.
+  """
+  if mode not in STATIONARY_MODES:
+    raise ValueError(f'Unknown stationary mode: {mode}')
+  if mode == 'keep':
+    return combined_df
+  keep = combined_df['moving']
+  if mode == 'collapse':
+    # The first and last sample of a run differ from a neighbour
+    grouped = combined_df.groupby('device')['moving']
+    keep = (keep | (grouped.shift(1, fill_value=True) != keep)
+            | (grouped.shift(-1, fill_value=True) != keep))
+  return combined_df[keep].reset_index(drop=True)
@@ -0,0 +1,211 @@
+"""Pre-aggregate traces at several bucket sizes for zoomable plots."""
+
+import json
+import os
+
+import numpy as np
+import plotly.colors
+
+from utils import utils
+
+# Bucket sizes in seconds, each a multiple of the previous one
+PYRAMID_LEVELS = (1, 10, 60, 600)
+DEFAULT_MAX_POINTS = 2000
+
+# Channel name, source column and scale to km (or miles) for each plot
+PYRAMID_CHANNELS = {
+    'heart_rate': ('heart_rate', None),
+    'distance': ('calc_distance_meters', 1 / 1000.0),
+    'speed': ('speed_kmh', 1.0),
+    'power': ('power_watts', None),
+    'cadence': ('cadence', None),
+}
+
+DEFAULT_COLORWAY = plotly.colors.qualitative.Plotly
+
+
+def _reduce_buckets(bucket, mins, maxs, sums, counts):
+  """Merges consecutive rows that share a bucket."""
+  starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+  return (
+      bucket[starts],
+      np.minimum.reduceat(mins, starts),
+      np.maximum.reduceat(maxs, starts),
+      np.add.reduceat(sums, starts),
+      np.add.reduceat(counts, starts),
+  )
+
+
+def build_levels(times_ms, values, t0_ms, levels=PYRAMID_LEVELS):
+  """Aggregates a single trace into min/max/mean buckets at every level.
+
+  Args:
+    times_ms: sorted int64 array of wall clock times in ms
+    values: float array of samples, without missing values
+    t0_ms: the time of bucket 0 in ms
+    levels: the bucket sizes in seconds, each a multiple of the previous one
+
+  Returns:
+    A dict of level to a dict of the bucket indices ('b') and the 'min',
+    'max' and 'mean' of each bucket.
+  """
+  bucket = (times_ms - t0_ms) // (levels[0] * 1000)
+  reduced = _reduce_buckets(bucket, values, values, values,
+                            np.ones(len(values), dtype=np.int64))
+  result = {}
+  previous_level = levels[0]
+  for level in levels:
+    if level != previous_level:
+      bucket = reduced[0] * previous_level // level
+      reduced = _reduce_buckets(bucket, *reduced[1:])
+      previous_level = level
+    bucket, mins, maxs, sums, counts = reduced
+    result[level] = {
+        'b': bucket,
+        'min': mins,
+        'max': maxs,
+        'mean': sums / counts,
+    }
+  return result
+
+
+def build_pyramid(combined_df, unit_of_measure, levels=PYRAMID_LEVELS):
+  """Builds the min/max/mean pyramid of every device and channel.
+
+  Values are stored in the units shown on the plots.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    unit_of_measure: IMPERIAL or METRIC
+    levels: the bucket sizes in seconds
+
+  Returns:
+    A dict with the wall clock start time 't0' in ms, the 'levels' and the
+    per 'channels' per device levels from build_levels.
+  """
+  ratio = 1.0
+  if unit_of_measure == utils.UnitOfMeasure.IMPERIAL:
+    ratio = utils.KM_TO_MILE_RATIO
+
+  wall_times = combined_df['time'].dt.tz_localize(None)
+  times_ms = wall_times.to_numpy().astype('datetime64[ms]').astype(np.int64)
+  # Align bucket 0 to the coarsest level so every level shares the origin
+  t0_ms = times_ms.min() // (levels[-1] * 1000) * levels[-1] * 1000
+
+  channels = {}
+  for channel, (column, scale) in PYRAMID_CHANNELS.items():
+    if column not in combined_df.columns:
+      continue
+    scale = 1.0 if scale is None else scale * ratio
+    devices = {}
+    for device, positions in combined_df.groupby('device').indices.items():
+      values = combined_df[column].to_numpy(dtype=float)[positions]
+      device_times = times_ms[positions]
+      valid = ~np.isnan(values)
+      if not valid.any():
+        continue
+      order = np.argsort(device_times[valid], kind='stable')
+      devices[device] = build_levels(device_times[valid][order],
+                                     values[valid][order] * scale, t0_ms,
+                                     levels)
+    if devices:
+      channels[channel] = devices
+
+  return {'t0': int(t0_ms), 'levels': list(levels), 'channels': channels}
+
+
+def pick_level(pyramid, device_levels, span_ms, max_points):
+  """Returns the finest level with at most max_points buckets in the span."""
+  for level in pyramid['levels']:
+    buckets = len(device_levels[level]['b'])
+    if span_ms is not None:
+      buckets = min(buckets, span_ms // (level * 1000) + 1)
+    if buckets <= max_points:
+      return level
+  return pyramid['levels'][-1]
+
+
+def _bucket_times(pyramid, level, buckets):
+  """Returns the wall clock ISO time of the center of each bucket."""
+  times_ms = pyramid['t0'] + (buckets * level * 1000) + level * 500
+  return np.datetime_as_string(times_ms.astype('datetime64[ms]')).tolist()
+
+
+def apply_pyramid(fig, pyramid, channel, max_points=DEFAULT_MAX_POINTS):
+  """Replaces each device's line with the finest level that fits max_points.
+
+  A min/max band is added behind each line.  Both traces are tagged in
+  their meta so the report script can swap in finer levels on zoom.
+
+  Args:
+    fig: the plotly figure with a line trace named after each device
+    pyramid: the pyramid from build_pyramid
+    channel: the pyramid channel plotted by the figure
+    max_points: the largest number of buckets shown per device
+
+  Returns:
+    The updated figure.
+  """
+  devices = pyramid['channels'].get(channel, {})
+  for index, trace in enumerate(list(fig.data)):
+    if (trace.type != 'scatter' or trace.mode != 'lines'
+        or trace.name not in devices):
+      continue
+    device_levels = devices[trace.name]
+    level = pick_level(pyramid, device_levels, None, max_points)
+    buckets = device_levels[level]
+    x = _bucket_times(pyramid, level, buckets['b'])
+    color = trace.line.color or DEFAULT_COLORWAY[index % len(DEFAULT_COLORWAY)]
+    meta = {'pyramid_channel': channel, 'pyramid_device': trace.name}
+
+    trace.update(x=x, y=buckets['mean'], line=dict(color=color),
+                 meta={**meta, 'pyramid_role': 'mean'})
+    fig.add_trace(dict(
+        type='scatter',
+        x=x + x[::-1],
+        y=np.concatenate([buckets['max'], buckets['min'][::-1]]),
+        fill='toself',
+        fillcolor=color,
+        opacity=0.2,
+        line=dict(width=0, color=color),
+        mode='lines',
+        hoverinfo='skip',
+        name=f'{trace.name} range',
+        legendgroup=trace.legendgroup or trace.name,
+        showlegend=False,
+        meta={**meta, 'pyramid_role': 'band'},
+    ))
+  return fig
+
+
+def pyramid_json(pyramid, decimals=3):
+  """Serializes the pyramid compactly for embedding in the report."""
+  channels = {}
+  for channel, devices in pyramid['channels'].items():
+    channels[channel] = {}
+    for device, levels in devices.items():
+      channels[channel][device] = {
+          str(level): {
+              'b': buckets['b'].tolist(),
+              'min': np.round(buckets['min'], decimals).tolist(),
+              'max': np.round(buckets['max'], decimals).tolist(),
+              'mean': np.round(buckets['mean'], decimals).tolist(),
+          }
+          for level, buckets in levels.items()
+      }
+  return json.dumps(
+      {'t0': pyramid['t0'], 'levels': pyramid['levels'],
+       'channels': channels},
+      separators=(',', ':'))
+
+
+def pyramid_script_html(pyramid, max_points=DEFAULT_MAX_POINTS):
+  """Returns the HTML embedding the pyramid and the zoom handler script."""
+  script_path = os.path.join(os.path.dirname(__file__), 'html',
+                             'pyramid_script.html')
+  with open(script_path, 'r') as script_file:
+    script = script_file.read()
+  # Keep device names from closing the script element early
+  embedded = pyramid_json(pyramid).replace('</', '<\\/')
+  script = script.replace('{max_points}', str(max_points))
+  return script.replace('{pyramid_json}', embedded)
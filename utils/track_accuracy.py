@@ -0,0 +1,137 @@
+"""Measure the spatial accuracy of each GPS track vs the ref device."""
+import numpy as np
+import pandas as pd
+from scipy import spatial
+
+from utils import utils
+
+EARTH_RADIUS_METERS = 6371000
+
+
+def to_local_xy(latitude, longitude, origin_lat, origin_long):
+  """Projects GPS coordinates onto a local tangent plane in meters.
+
+  Args:
+    latitude: array of latitudes in decimal degrees
+    longitude: array of longitudes in decimal degrees
+    origin_lat: latitude of the plane origin
+    origin_long: longitude of the plane origin
+
+  Returns:
+    An (n, 2) array of east/north offsets from the origin in meters.
+  """
+  x = (np.radians(np.asarray(longitude, dtype=float) - origin_long)
+       * EARTH_RADIUS_METERS * np.cos(np.radians(origin_lat)))
+  y = (np.radians(np.asarray(latitude, dtype=float) - origin_lat)
+       * EARTH_RADIUS_METERS)
+  return np.column_stack([x, y])
+
+
+def from_local_xy(x, y, origin_lat, origin_long):
+  """Converts local tangent plane offsets back into GPS coordinates.
+
+  Args:
+    x: array of east offsets from the origin in meters
+    y: array of north offsets from the origin in meters
+    origin_lat: latitude of the plane origin
+    origin_long: longitude of the plane origin
+
+  Returns:
+    A tuple of the latitude and longitude arrays in decimal degrees, the
+    inverse of to_local_xy.
+  """
+  latitude = origin_lat + np.degrees(np.asarray(y) / EARTH_RADIUS_METERS)
+  longitude = origin_long + np.degrees(
+      np.asarray(x) / (EARTH_RADIUS_METERS * np.cos(np.radians(origin_lat))))
+  return latitude, longitude
+
+
+def cross_track_error(ref_xy, xy):
+  """Calculates the distance from each point to the reference track.
+
+  The nearest reference fix is found with a KD-tree, then the distance is
+  refined against the two track segments adjacent to that fix.
+
+  Args:
+    ref_xy: (m, 2) array of reference track points in meters
+    xy: (n, 2) array of points to measure in meters
+
+  Returns:
+    An array of n cross-track errors in meters.
+  """
+  tree = spatial.cKDTree(ref_xy)
+  errors, nearest = tree.query(xy)
+
+  for neighbour in (nearest - 1, nearest + 1):
+    valid = (neighbour >= 0) & (neighbour < len(ref_xy))
+    start = ref_xy[nearest[valid]]
+    segment = ref_xy[neighbour[valid]] - start
+    offset = xy[valid] - start
+    length_sq = np.einsum('ij,ij->i', segment, segment)
+    t = np.divide(np.einsum('ij,ij->i', offset, segment), length_sq,
+                  out=np.zeros_like(length_sq), where=length_sq > 0)
+    t = np.clip(t, 0.0, 1.0)
+    distance = np.linalg.norm(offset - segment * t[:, None], axis=1)
+    errors[valid] = np.minimum(errors[valid], distance)
+
+  return errors
+
+
+def add_track_error(combined_df, ref_device):
+  """Adds a track_error_meters column measured against the ref device track.
+
+  Args:
+    combined_df: A combined DataFrame containing the data of all devices.
+    ref_device: the string used to determine the ref device
+
+  Returns:
+    A copy of the DataFrame with the cross-track error of every fix.  Rows of
+    the ref device and rows without a position are left empty.
+  """
+  df = combined_df.copy()
+  df['track_error_meters'] = np.nan
+  if 'latitude' not in df.columns or 'longitude' not in df.columns:
+    return df
+
+  has_position = df['latitude'].notnull() & df['longitude'].notnull()
+  is_ref = df['device'].str.contains(ref_device, case=False)
+  ref_data = df[is_ref & has_position]
+  if ref_data.empty:
+    utils.progress(f'No gps data for ref device: {ref_device}')
+    return df
+
+  origin_lat = ref_data['latitude'].mean()
+  origin_long = ref_data['longitude'].mean()
+  ref_xy = to_local_xy(ref_data['latitude'], ref_data['longitude'],
+                       origin_lat, origin_long)
+
+  # Measure the fixes of every other device in a single bulk query
+  rows = (~is_ref & has_position).to_numpy()
+  if rows.any():
+    xy = to_local_xy(df['latitude'].to_numpy()[rows],
+                     df['longitude'].to_numpy()[rows],
+                     origin_lat, origin_long)
+    errors = df['track_error_meters'].to_numpy(copy=True)
+    errors[rows] = cross_track_error(ref_xy, xy)
+    df['track_error_meters'] = errors
+  return df
+
+
+def get_track_metrics(combined_df, ref_device, small_ratio):
+  """Gets the cross-track error summary for each device vs the ref device."""
+
+  rows = []
+  for device, data in combined_df.groupby('device'):
+    if device.lower().startswith(ref_device.lower()):
+      continue
+    errors = data['track_error_meters'].dropna() * small_ratio
+    if errors.empty:
+      continue
+    rows.append({
+        'Device': device,
+        'Mean': round(errors.mean(), 2),
+        'P95': round(errors.quantile(0.95), 2),
+        'Max': round(errors.max(), 2),
+    })
+
+  return pd.DataFrame(rows, columns=['Device', 'Mean', 'P95', 'Max'])
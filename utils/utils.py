@@ -1,6 +1,9 @@
 """Enum class for unit of measure."""
 
 import enum
+import logging
+import sys
+
 from dateutil import tz
 
 
@@ -11,6 +14,48 @@ class UnitOfMeasure(enum.Enum):
 KM_TO_MILE_RATIO = 0.621371
 M_TO_FT_RATIO = 3.28084
 
+# Progress messages of the analysis and rendering stages.  The library stays
+# silent unless a handler is added, the command line prints them, see
+# print_progress.
+LOGGER = logging.getLogger('tcxplot')
+LOGGER.addHandler(logging.NullHandler())
+
+
+class _PrintHandler(logging.Handler):
+  """Writes each message to a stream, the current sys.stdout by default."""
+
+  def __init__(self, stream=None):
+    super().__init__()
+    self.stream = stream
+
+  def emit(self, record):
+    try:
+      (self.stream or sys.stdout).write(self.format(record) + '\n')
+    except Exception:  # pylint: disable=broad-except
+      self.handleError(record)
+
+
+def progress(message):
+  """Reports a progress message, see LOGGER."""
+  LOGGER.info(message)
+
+
+def print_progress(stream=None):
+  """Prints the progress messages, as the command line does.
+
+  Args:
+    stream: optional file to print to instead of sys.stdout, eg. sys.stderr
+            to keep them out of metrics written to stdout
+  """
+  handler = next((handler for handler in LOGGER.handlers
+                  if isinstance(handler, _PrintHandler)), None)
+  if handler is None:
+    LOGGER.addHandler(_PrintHandler(stream))
+  else:
+    handler.stream = stream
+  LOGGER.setLevel(logging.INFO)
+  LOGGER.propagate = False
+
 
 def to_local_time(time):
   # Set the timezone of the datetime object to UTC
@@ -21,3 +66,9 @@ def to_local_time(time):
 
 def to_local_time_string(time):
   return to_local_time(time).strftime('%Y-%m-%d %I:%M:%S %p')
+
+
+def to_local_time_series(times):
+  # Vectorized to_local_time for a whole column of timestamps
+  times = times.dt.tz_localize(None) if times.dt.tz is not None else times
+  return times.dt.tz_localize(tz.tzutc()).dt.tz_convert(tz.tzlocal())